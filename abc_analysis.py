@@ -0,0 +1,205 @@
+# Clasificación ABC (Pareto) de todo el catálogo
+#
+# El reporte "Top 10 Productos Más Valiosos" solo muestra diez productos. La clasificación
+# ABC reparte TODOS los productos en tres clases según cuánto aportan al total:
+#
+#     A   los primeros productos que suman el ABC_A_SHARE del total (80%): pocos y clave
+#     B   los siguientes hasta el ABC_B_SHARE (95%)
+#     C   el resto: muchos productos que aportan poco
+#
+# Se calcula con dos criterios, cada uno con su clase:
+#     value_class      valor del stock (quantity * price)
+#     velocity_class   unidades que salieron en los últimos ABC_VELOCITY_DAYS días
+#                      (incluidos los meses archivados)
+#
+# El cálculo es una sola pasada con NumPy por criterio: ordenar de mayor a menor, suma
+# acumulada (cumsum) y comparar la parte acumulada con los límites de cada clase.
+#
+# Es una tarea programada que guarda el resultado en la tabla abc_classification (los
+# reportes personalizados solo la leen). Solo recalcula si cambiaron los datos desde la
+# última vez (generación de data_generation) o si pasaron ABC_MAX_AGE_HOURS horas (la
+# ventana de velocidad avanza sola con los días), y solo reescribe los productos cuya fila
+# cambió:
+#     python abc_analysis.py            # cron, ej: cada 15 minutos
+#     python abc_analysis.py --force    # recalcular aunque nada haya cambiado
+#
+# Requiere NumPy (pip install numpy). La aplicación web no lo necesita: solo lee la tabla.
+import os
+import time
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from db import current_generation
+from movement_archive import movement_source
+
+ABC_A_SHARE = float(os.environ.get('ABC_A_SHARE', '0.80'))
+ABC_B_SHARE = float(os.environ.get('ABC_B_SHARE', '0.95'))
+# Días de salidas con los que se mide la velocidad de cada producto
+ABC_VELOCITY_DAYS = int(os.environ.get('ABC_VELOCITY_DAYS', '90'))
+# Horas tras las que se recalcula aunque no haya cambios (la ventana de velocidad avanza)
+ABC_MAX_AGE_HOURS = float(os.environ.get('ABC_MAX_AGE_HOURS', '24'))
+
+ABC_CLASSES = ('A', 'B', 'C')
+
+
+def classify(values, a_share=ABC_A_SHARE, b_share=ABC_B_SHARE):
+    """
+    Clase ABC de cada valor
+
+    Un producto es A si lo acumulado ANTES de él (ordenando de mayor a menor) no llega a
+    a_share del total; así el primero siempre es A aunque él solo supere el 80%. Los
+    productos que no aportan nada (valor 0) son siempre C.
+
+    Args:
+        values (numpy.ndarray): Un valor por producto
+
+    Returns:
+        tuple: (clases como array de 'A'/'B'/'C', parte acumulada hasta cada producto)
+    """
+    total = values.sum()
+    order = np.argsort(-values, kind='stable')
+    cumulative = np.cumsum(values[order])
+    share = np.empty_like(values, dtype=np.float64)
+    before = np.empty_like(values, dtype=np.float64)
+    if total > 0:
+        share[order] = cumulative / total
+        before[order] = (cumulative - values[order]) / total
+    else:
+        share[:] = 0.0
+        before[:] = 1.0
+    classes = np.where(before < a_share, 'A', np.where(before < b_share, 'B', 'C'))
+    classes[values <= 0] = 'C'
+    return classes, share
+
+
+def load_velocity(db, product_ids, days=ABC_VELOCITY_DAYS):
+    """Unidades que salieron de cada producto (en el orden de product_ids) en los últimos `days` días"""
+    start = (date.today() - timedelta(days=days)).isoformat()
+    source = movement_source(db, start, '')
+    units = np.zeros(len(product_ids), dtype=np.float64)
+    rows = db.query(f"""
+        SELECT product_id, SUM(-quantity_change) AS units
+        FROM {source}
+        WHERE movement_type = 'salida' AND {db.dialect.to_date('created_at')} >= ?
+        GROUP BY product_id
+    """, (start,))
+    if rows:
+        moved_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        moved_units = np.array([row[1] for row in rows], dtype=np.float64)
+        # Posición de cada producto con salidas en product_ids (ordenado); los eliminados se descartan
+        positions = np.searchsorted(product_ids, moved_ids)
+        valid = positions < len(product_ids)
+        valid[valid] = product_ids[positions[valid]] == moved_ids[valid]
+        units[positions[valid]] = moved_units[valid]
+    return units
+
+
+def is_stale(db, max_age_hours=ABC_MAX_AGE_HOURS):
+    """True si los datos cambiaron desde el último cálculo o si este es demasiado viejo"""
+    last = db.query_one("SELECT generation, computed_at FROM abc_runs")
+    if last is None or last['generation'] != current_generation(db):
+        return True
+    computed_at = last['computed_at']
+    if not isinstance(computed_at, datetime):
+        computed_at = datetime.fromisoformat(str(computed_at))
+    return datetime.utcnow() - computed_at > timedelta(hours=max_age_hours)
+
+
+def compute_classification(db, force=False):
+    """
+    Recalcula abc_classification si hace falta
+
+    La lectura y el cálculo se hacen FUERA de la transacción de escritura: en SQLite,
+    BEGIN IMMEDIATE bloquearía los ajustes de stock durante todo el cálculo (y
+    load_velocity puede cargar meses archivados). La transacción solo cubre el DELETE/INSERT
+    de las filas que cambiaron. El resultado siempre se guarda, con la generación leída al
+    empezar: si los datos cambiaron mientras se calculaba, is_stale lo detecta y la próxima
+    ejecución recalcula (descartarlo dejaría la tabla sin actualizar con tráfico constante).
+
+    Returns:
+        dict: Resumen del cálculo, o None si no hacía falta recalcular
+    """
+    if np is None:
+        raise RuntimeError("La clasificación ABC requiere NumPy: pip install numpy")
+
+    started = time.perf_counter()
+    try:
+        if not force and not is_stale(db):
+            db.rollback()
+            return None
+        # La generación se lee ANTES que los datos: si alguien escribe durante la lectura,
+        # la generación guardada queda atrás y la próxima ejecución recalcula
+        generation = current_generation(db)
+        rows = db.query("SELECT id, quantity, price FROM products ORDER BY id")
+        product_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        stock_values = np.array([row[1] * row[2] for row in rows], dtype=np.float64)
+        units = load_velocity(db, product_ids)
+        current = {row[0]: tuple(row[1:]) for row in db.query("""
+            SELECT product_id, stock_value, value_share, value_class, units_moved, velocity_share, velocity_class
+            FROM abc_classification
+        """)}
+        # Fin de la lectura: libera el bloqueo de lectura de SQLite durante el cálculo
+        db.rollback()
+
+        value_classes, value_shares = classify(stock_values)
+        velocity_classes, velocity_shares = classify(units)
+        computed_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        # Solo se reescriben las filas que cambiaron
+        changed = []
+        for row in zip(product_ids.tolist(), np.round(stock_values, 2).tolist(),
+                       np.round(value_shares, 6).tolist(), value_classes.tolist(), units.tolist(),
+                       np.round(velocity_shares, 6).tolist(), velocity_classes.tolist()):
+            if current.pop(row[0], None) != row[1:]:
+                changed.append(row + (computed_at,))
+
+        db.begin_write()
+        if changed:
+            db.executemany("DELETE FROM abc_classification WHERE product_id = ?",
+                           [(row[0],) for row in changed])
+            db.executemany("""
+                INSERT INTO abc_classification
+                (product_id, stock_value, value_share, value_class, units_moved, velocity_share, velocity_class,
+                 computed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, changed)
+        # Lo que queda en current son productos eliminados
+        if current:
+            db.executemany("DELETE FROM abc_classification WHERE product_id = ?", [(pid,) for pid in current])
+        db.execute("DELETE FROM abc_runs")
+        db.execute("INSERT INTO abc_runs (generation, computed_at) VALUES (?, ?)", (generation, computed_at))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {
+        'products': len(product_ids),
+        'changed': len(changed),
+        'removed': len(current),
+        'value_classes': {c: int((value_classes == c).sum()) for c in ABC_CLASSES},
+        'velocity_classes': {c: int((velocity_classes == c).sum()) for c in ABC_CLASSES},
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import get_db
+
+    parser = argparse.ArgumentParser(description="Clasificación ABC del catálogo por valor y por velocidad")
+    parser.add_argument('--force', action='store_true', help="Recalcular aunque los datos no hayan cambiado")
+    args = parser.parse_args()
+
+    with get_db() as database:
+        summary = compute_classification(database, force=args.force)
+    if summary is None:
+        print("Clasificación ABC al día (sin cambios desde el último cálculo)")
+    else:
+        print(f"Clasificación ABC de {summary['products']} productos en {summary['seconds']}s "
+              f"({summary['changed']} filas actualizadas, {summary['removed']} eliminadas)")
+        print("Por valor:     " + ', '.join(f"{c}: {n}" for c, n in summary['value_classes'].items()))
+        print("Por velocidad: " + ', '.join(f"{c}: {n}" for c, n in summary['velocity_classes'].items()))
@@ -0,0 +1,466 @@
+# API JSON versionada para integraciones (POS, e-commerce)
+#
+# Hasta ahora las integraciones "raspaban" la página principal y /export_csv, descargando
+# el catálogo completo cada pocos minutos. Esta API ofrece:
+#
+#   GET  /api/v1/products/<id>              Un producto por ID
+#   GET  /api/v1/products/sku/<sku>         Un producto por SKU
+#   POST /api/v1/products/batch             Varios productos: {"skus": [...], "ids": [...]}
+#   GET  /api/v1/products                   Listado filtrado con paginación por cursor
+#   GET  /api/v1/movements                  Movimientos filtrados con paginación por cursor
+#   POST /api/v1/scan                       Lecturas de lectores de códigos (token de
+#                                           editor; ver scanning.py)
+#
+# AUTENTICACIÓN: cabecera "Authorization: Bearer <token>". Los tokens se crean con
+#     flask --app wsgi api create-token "POS tienda 1" --role viewer
+#     flask --app wsgi api create-token "Lector recepción" --role editor --user editor
+# y se guardan como hash SHA-256 (tabla api_tokens), igual que las contraseñas.
+#
+# PAGINACIÓN POR CURSOR (keyset): en lugar de OFFSET (que recorre todas las filas
+# anteriores), cada página pide las filas con id mayor al último recibido:
+#     GET /api/v1/products?limit=500            -> {"products": [...], "next_after": 500}
+#     GET /api/v1/products?limit=500&after=500  -> siguiente página
+# El costo de cada página es el mismo sea la primera o la número mil.
+#
+# GET CONDICIONAL: las respuestas llevan un ETag basado en la generación de los datos
+# (tabla data_generation). Si la integración envía If-None-Match con el ETag anterior y
+# nada cambió, la respuesta es 304 sin cuerpo y sin consultar los productos.
+import os
+import json
+import time
+import hashlib
+import secrets
+from functools import wraps
+
+import click
+from flask import Blueprint, Response, g, request
+
+from db import get_db, current_generation, records
+from movement_archive import movement_source
+import scanning
+from stock_alerts import ALERTED_PRODUCT_IDS
+
+# Serialización rápida con orjson si está instalado (pip install orjson)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Máximo de productos por llamada a /products/batch y de filas por página
+API_BATCH_LIMIT = int(os.environ.get('API_BATCH_LIMIT', '500'))
+API_PAGE_LIMIT = int(os.environ.get('API_PAGE_LIMIT', '1000'))
+# Parámetros por consulta IN (...): SQLite antiguo admite hasta 999
+_IN_CHUNK = 500
+
+PRODUCT_COLUMNS = "id, sku, name, category, quantity, price, provider, stock_min, created_at"
+MOVEMENT_TYPES = ('entrada', 'salida', 'ajuste', 'creacion', 'eliminacion', 'transferencia')
+
+
+def _dumps(data):
+    if orjson is not None:
+        # orjson serializa fechas y decimales de los drivers de PostgreSQL/MySQL directamente
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def json_response(data, status=200, headers=None):
+    """Respuesta JSON (con orjson si está disponible)"""
+    return Response(_dumps(data), status=status, headers=headers, mimetype='application/json')
+
+
+def api_error(message, status):
+    return json_response({'error': message}, status)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def token_required(role='viewer'):
+    """
+    Decorador: exige un token válido en "Authorization: Bearer <token>"
+
+    Con role='editor' solo aceptan tokens de editor (escrituras, ej: escaneos), que
+    siempre tienen un usuario asociado: los movimientos se registran a su nombre.
+    El token validado queda en g.api_token (id, name, role, user_id, username).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            authorization = request.headers.get('Authorization', '')
+            if not authorization.startswith('Bearer '):
+                return api_error('Falta el token (Authorization: Bearer <token>)', 401)
+            with get_db() as db:
+                token = db.query_one("""
+                    SELECT t.id, t.name, t.role, t.user_id, u.username
+                    FROM api_tokens t
+                    LEFT JOIN users u ON u.id = t.user_id
+                    WHERE t.token_hash = ? AND t.revoked_at IS NULL
+                """, (hash_token(authorization[7:].strip()),))
+            if token is None:
+                return api_error('Token inválido o revocado', 401)
+            if role == 'editor' and (token['role'] != 'editor' or token['user_id'] is None):
+                return api_error('El token no tiene permisos de escritura', 403)
+            g.api_token = token
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def conditional(f):
+    """
+    Decorador: GET condicional con ETag derivado de la generación de los datos
+
+    La generación se lee ANTES de la consulta: si los datos cambian mientras tanto,
+    el ETag ya es viejo y la próxima petición recibirá la versión nueva.
+    El ETag incluye la URL completa (con filtros): cada listado tiene el suyo.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        generation = current_generation()
+        digest = hashlib.sha1(request.full_path.encode('utf-8')).hexdigest()[:12]
+        etag = f'g{generation}-{digest}'
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers={'ETag': f'W/"{etag}"'})
+        response = f(*args, **kwargs)
+        if response.status_code == 200:
+            # ETag débil: identifica los datos, no los bytes exactos (ej: comprimidos)
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return decorated_function
+
+
+def _products_json(rows):
+    products = records(rows)
+    for product in products:
+        product['low_stock'] = product['quantity'] <= product['stock_min']
+    return products
+
+
+def _product_json(row):
+    return _products_json([row])[0]
+
+
+def _parse_int(name, default=None, minimum=None, maximum=None):
+    """Lee un parámetro entero de la URL; ValueError con mensaje si no es válido"""
+    value = request.args.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' debe ser un número entero")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"'{name}' debe ser al menos {minimum}")
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def fetch_products(db, column, values):
+    """
+    Productos cuyo `column` (id o sku) está en `values`, en consultas de hasta 500 valores
+
+    Returns:
+        dict: valor -> fila
+    """
+    found = {}
+    values = list(dict.fromkeys(values))  # Sin duplicados, conservando el orden
+    for start in range(0, len(values), _IN_CHUNK):
+        chunk = values[start:start + _IN_CHUNK]
+        placeholders = ', '.join('?' for _ in chunk)
+        for row in db.query(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE {column} IN ({placeholders})", chunk):
+            found[row[column]] = row
+    return found
+
+
+@bp.route('/products/<int:product_id>')
+@token_required()
+@conditional
+def get_product(product_id):
+    with get_db() as db:
+        row = db.query_one(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
+    if row is None:
+        return api_error('Producto no encontrado', 404)
+    return json_response(_product_json(row))
+
+
+@bp.route('/products/sku/<path:sku>')
+@token_required()
+@conditional
+def get_product_by_sku(sku):
+    with get_db() as db:
+        row = db.query_one(f"SELECT {PRODUCT_COLUMNS} FROM products WHERE sku = ?", (sku,))
+    if row is None:
+        return api_error('Producto no encontrado', 404)
+    return json_response(_product_json(row))
+
+
+@bp.route('/products/batch', methods=['POST'])
+@token_required()
+def get_products_batch():
+    """
+    Varios productos en una sola llamada
+
+    Cuerpo: {"skus": ["SKU-1", ...], "ids": [1, 2, ...]} (hasta API_BATCH_LIMIT en total)
+    Respuesta: {"products": [...], "missing": {"skus": [...], "ids": [...]}}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return api_error('El cuerpo debe ser un objeto JSON', 400)
+    skus = data.get('skus') or []
+    ids = data.get('ids') or []
+    if not isinstance(skus, list) or not isinstance(ids, list):
+        return api_error("'skus' e 'ids' deben ser listas", 400)
+    if len(skus) + len(ids) > API_BATCH_LIMIT:
+        return api_error(f'Máximo {API_BATCH_LIMIT} productos por llamada', 400)
+    try:
+        ids = [int(value) for value in ids]
+    except (TypeError, ValueError):
+        return api_error("'ids' debe contener números enteros", 400)
+    skus = [str(value) for value in skus]
+
+    with get_db() as db:
+        by_id = fetch_products(db, 'id', ids) if ids else {}
+        by_sku = fetch_products(db, 'sku', skus) if skus else {}
+    products = {row['id']: row for row in list(by_id.values()) + list(by_sku.values())}
+    return json_response({
+        'products': _products_json(list(products.values())),
+        'missing': {
+            'ids': [value for value in dict.fromkeys(ids) if value not in by_id],
+            'skus': [value for value in dict.fromkeys(skus) if value not in by_sku],
+        },
+    })
+
+
+@bp.route('/products')
+@token_required()
+@conditional
+def list_products():
+    """
+    Listado de productos por orden de ID con paginación por cursor
+
+    Parámetros: category, provider, low_stock=1, after (último id recibido),
+    limit (por defecto 100, máximo API_PAGE_LIMIT)
+    """
+    try:
+        after = _parse_int('after', default=0)
+        limit = _parse_int('limit', default=100, minimum=1, maximum=API_PAGE_LIMIT)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    query = f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id > ?"
+    params = [after]
+    if request.args.get('category'):
+        query += " AND category = ?"
+        params.append(request.args['category'])
+    if request.args.get('provider'):
+        query += " AND provider = ?"
+        params.append(request.args['provider'])
+    if request.args.get('low_stock') == '1':
+        query += f" AND id IN ({ALERTED_PRODUCT_IDS})"
+    # Se pide una fila más de las necesarias para saber si hay otra página
+    query += " ORDER BY id LIMIT ?"
+    params.append(limit + 1)
+
+    with get_db() as db:
+        rows = db.query(query, params)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'products': _products_json(rows),
+        'next_after': rows[-1]['id'] if has_more else None,
+    })
+
+
+@bp.route('/movements')
+@token_required()
+@conditional
+def list_movements():
+    """
+    Movimientos por orden de ID con paginación por cursor
+
+    Parámetros: product_id, sku, movement_type, location_id, since / until (YYYY-MM-DD),
+    after (último id recibido), limit.
+
+    Sin since/until solo se consultan los movimientos no archivados (ver movement_archive.py);
+    para leer meses archivados hay que indicar el rango de fechas.
+    """
+    try:
+        after = _parse_int('after', default=0)
+        limit = _parse_int('limit', default=100, minimum=1, maximum=API_PAGE_LIMIT)
+        product_id = _parse_int('product_id')
+        location_id = _parse_int('location_id')
+    except ValueError as e:
+        return api_error(str(e), 400)
+    movement_type = request.args.get('movement_type')
+    if movement_type and movement_type not in MOVEMENT_TYPES:
+        return api_error(f"'movement_type' debe ser uno de: {', '.join(MOVEMENT_TYPES)}", 400)
+    since = request.args.get('since') or None
+    until = request.args.get('until') or None
+
+    with get_db() as db:
+        source = movement_source(db, since, until) if since or until else 'inventory_movements'
+        query = f"""
+            SELECT im.id, im.product_id, p.sku, COALESCE(d.name, im.product_name) AS product_name,
+                   im.movement_type, im.quantity_before, im.quantity_after, im.quantity_change,
+                   im.reason, im.username, im.created_at, im.location_id, im.location_delta
+            FROM {source} im
+            LEFT JOIN product_dim d ON d.product_id = im.product_id
+            LEFT JOIN products p ON p.id = im.product_id
+            WHERE im.id > ?
+        """
+        params = [after]
+        if product_id is not None:
+            query += " AND im.product_id = ?"
+            params.append(product_id)
+        if request.args.get('sku'):
+            query += " AND p.sku = ?"
+            params.append(request.args['sku'])
+        if movement_type:
+            query += " AND im.movement_type = ?"
+            params.append(movement_type)
+        if location_id is not None:
+            query += " AND im.location_id = ?"
+            params.append(location_id)
+        if since:
+            query += f" AND {db.dialect.to_date('im.created_at')} >= ?"
+            params.append(since)
+        if until:
+            query += f" AND {db.dialect.to_date('im.created_at')} <= ?"
+            params.append(until)
+        query += " ORDER BY im.id LIMIT ?"
+        params.append(limit + 1)
+        rows = db.query(query, params)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'movements': records(rows),
+        'next_after': rows[-1]['id'] if has_more else None,
+    })
+
+
+# ESCANEO DE CÓDIGOS: lectores de mano en la recepción de mercancía (ver scanning.py)
+# app.py entrega con init_scanning el índice SKU -> producto del proceso y la función
+# que aplica cada lote (registra los movimientos con log_inventory_movement)
+_sku_index = None
+_scan_coalescer = None
+
+
+def init_scanning(apply_batch, sku_index):
+    """Configura el índice de SKU y el agrupador de lecturas de POST /scan"""
+    global _sku_index, _scan_coalescer
+    _sku_index = sku_index
+    _scan_coalescer = scanning.ScanCoalescer(apply_batch)
+
+
+@bp.route('/scan', methods=['POST'])
+@token_required('editor')  # Token de API con rol editor (tiene usuario asociado)
+def scan():
+    """
+    Registra lecturas de un lector de códigos
+
+    Cuerpo: {"scans": [{"sku": "ABC-1", "delta": 1, "id": "lectura-17"}, ...]}
+    (o una sola lectura: {"sku": "ABC-1"}). delta es +1 por defecto; "id" es opcional
+    y se devuelve en la confirmación para que el lector sepa a qué lectura corresponde.
+
+    Las lecturas se agrupan con las de otros lectores durante unos milisegundos y se
+    aplican en una transacción (ver scanning.py). La respuesta tiene una confirmación por
+    lectura, en el mismo orden: {"acks": [{"id", "sku", "status", "quantity", ...}]}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return api_error('El cuerpo debe ser un objeto JSON', 400)
+    scans = data['scans'] if 'scans' in data else [data]
+    if not isinstance(scans, list) or not scans or len(scans) > API_BATCH_LIMIT:
+        return api_error(f"'scans' debe ser una lista de 1 a {API_BATCH_LIMIT} lecturas", 400)
+    for item in scans:
+        if not isinstance(item, dict) or not item.get('sku'):
+            return api_error("Cada lectura necesita 'sku'", 400)
+        delta = item.get('delta', 1)
+        if not isinstance(delta, int) or isinstance(delta, bool) or delta == 0:
+            return api_error("'delta' debe ser un entero distinto de cero", 400)
+
+    token = g.api_token
+    actor = (token['user_id'], token['username'], token['name'])
+    products = _sku_index.lookup([item['sku'] for item in scans])
+
+    # Se encolan todas las lecturas antes de esperar: las de una misma petición
+    # (y las de otros lectores) caen en la misma ventana de agrupación
+    pending = []
+    for item in scans:
+        sku = scanning.normalize_sku(item['sku'])
+        product_id = products.get(sku)
+        ticket = _scan_coalescer.submit(product_id, item.get('delta', 1), actor) if product_id else None
+        pending.append((item, sku, ticket))
+
+    deadline = time.monotonic() + scanning.SCAN_ACK_TIMEOUT
+    acks = []
+    for item, sku, ticket in pending:
+        ack = {'id': item.get('id'), 'sku': sku}
+        if ticket is None:
+            ack['status'] = 'unknown_sku'
+        elif ticket.wait(max(0, deadline - time.monotonic())):
+            ack['product_id'] = ticket.product_id
+            ack.update(ticket.result)
+        else:
+            # Sigue en cola: se aplicará, pero el lector no tiene confirmación
+            ack['status'] = 'timeout'
+        acks.append(ack)
+    return json_response({'acks': acks})
+
+
+# COMANDOS DE CONSOLA: flask --app wsgi api create-token / list-tokens / revoke-token
+
+@bp.cli.command('create-token')
+@click.argument('name')
+@click.option('--role', type=click.Choice(['viewer', 'editor']), default='viewer',
+              help="viewer: solo lectura; editor: también escaneos (por defecto viewer)")
+@click.option('--user', 'username', help="Usuario a cuyo nombre se registran los movimientos (obligatorio para editor)")
+def create_token_command(name, role, username):
+    """Crea un token de la API y lo muestra (una sola vez)"""
+    user_id = None
+    with get_db() as db:
+        if username:
+            user_id = db.scalar("SELECT id FROM users WHERE username = ?", (username,))
+            if user_id is None:
+                raise click.ClickException(f"No existe el usuario '{username}'")
+        elif role == 'editor':
+            raise click.ClickException("Los tokens de editor necesitan --user (auditoría de movimientos)")
+        token = secrets.token_urlsafe(32)
+        token_id = db.insert("INSERT INTO api_tokens (name, token_hash, role, user_id) VALUES (?, ?, ?, ?)",
+                             (name, hash_token(token), role, user_id))
+        db.commit()
+    print(f"Token #{token_id} ({role}) para '{name}':")
+    print(token)
+    print("Guárdelo ahora: no se puede volver a mostrar.")
+
+
+@bp.cli.command('list-tokens')
+def list_tokens_command():
+    """Lista los tokens de la API (sin su valor)"""
+    with get_db() as db:
+        for row in db.query("""
+            SELECT t.id, t.name, t.role, t.created_at, t.revoked_at, u.username
+            FROM api_tokens t
+            LEFT JOIN users u ON u.id = t.user_id
+            ORDER BY t.id
+        """):
+            state = f"revocado {row['revoked_at']}" if row['revoked_at'] else 'activo'
+            user = f", usuario {row['username']}" if row['username'] else ''
+            print(f"#{row['id']:<4} {row['role']:<7} {state:<30} {row['name']} (creado {row['created_at']}{user})")
+
+
+@bp.cli.command('revoke-token')
+@click.argument('token_id', type=int)
+def revoke_token_command(token_id):
+    """Revoca un token de la API por su número"""
+    with get_db() as db:
+        updated = db.execute("UPDATE api_tokens SET revoked_at = CURRENT_TIMESTAMP WHERE id = ? AND revoked_at IS NULL",
+                             (token_id,)).rowcount
+        db.commit()
+    print(f"Token #{token_id} revocado" if updated else f"No hay un token activo #{token_id}")
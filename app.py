@@ -1,5 +1,5 @@
 # Importaciones necesarias para la aplicación Flask
-from flask import Flask, render_template, request, redirect, session, flash, url_for, Response
+from flask import Flask, render_template, request, redirect, session, flash, url_for, Response, jsonify, send_from_directory
 # Flask: framework web de Python
 # render_template: renderiza plantillas HTML con datos dinámicos (usa Jinja2)
 # request: accede a datos de peticiones HTTP (formularios, parámetros URL)
@@ -8,12 +8,13 @@ from flask import Flask, render_template, request, redirect, session, flash, url
 # flash: mensajes temporales que se muestran una vez (ej: "Usuario creado")
 # url_for: genera URLs de manera segura usando nombres de funciones
 # Response: crear respuestas HTTP personalizadas
+# jsonify: convierte diccionarios de Python en respuestas JSON
 
 import os
 import csv         # Para exportar datos en formato CSV
 import io          # Para operaciones de entrada/salida en memoria
 import hashlib     # Para hashear contraseñas
-import sqlite3     # Para interactuar directamente con la base de datos SQLite
+import threading   # Para proteger la comprobación del esquema entre hilos
 from functools import wraps  # Para crear decoradores (funciones que modifican otras funciones)
 from datetime import datetime, timedelta  # Para manejar fechas y tiempos
 
@@ -40,15 +41,80 @@ except ImportError:
         print("AVISO: Módulo de configuración no encontrado. Usando configuración predeterminada interna.")
         config_loaded = False
 
-# Importar funciones de database.py con compatibilidad hacia atrás
-try:
-    from database import init_db, get_db_connection, DB_NAME
-except ImportError:
-    from database import init_db, DB_NAME
-    # Definir get_db_connection para compatibilidad si no existe
-    def get_db_connection():
-        conn = sqlite3.connect(DB_NAME)
-        return conn, True
+# Particiones archivadas del historial de movimientos (ver movement_archive.py)
+from movement_archive import movement_source, load_manifest
+# Stock a una fecha pasada a partir de fotos + movimientos (ver stock_history.py)
+from stock_history import stock_as_of
+# Escritura diferida opcional del historial de movimientos (ver movement_spool.py)
+import movement_spool
+
+# Importar funciones de database.py
+from database import init_db, ensure_schema, get_schema_version, SCHEMA_VERSION
+# Capa de consultas independiente del motor (SQLite, PostgreSQL, MySQL), ver db.py
+from db import get_db, is_lock_error, current_generation, records
+# Medición de peticiones, consultas y plantillas (Server-Timing, consultas lentas)
+import instrumentation
+# Métricas en formato Prometheus sumadas entre workers (ver metrics.py)
+import metrics
+# Perfilado bajo demanda de peticiones reales con ?_profile=1 (ver profiling.py)
+import profiling
+# Caché de bytecode de plantillas y de fragmentos {% cache %} (ver template_cache.py)
+import template_cache
+from template_cache import uses_fragment_cache
+# Compresión gzip/brotli de las respuestas (ver compression.py)
+import compression
+# API JSON /api/v1 con tokens para integraciones (ver api.py)
+import api
+# Índice de SKU en memoria y agrupación de lecturas de lectores de códigos (ver scanning.py)
+import scanning
+# Estado de alerta de stock mantenido por triggers (ver stock_alerts.py)
+import stock_alerts
+from stock_alerts import ALERTED_PRODUCT_IDS
+# Envío en segundo plano de las notificaciones de alertas de stock (ver notifications.py)
+import notifications
+# Stock por ubicación y transferencias entre ubicaciones (ver locations.py)
+import locations
+# Réplica de lectura para reportes, dashboard y exportaciones (ver replica.py)
+import replica
+# Texto SQL canónico de reportes e historial (ver query_builder.py)
+import query_builder
+from query_builder import MOVEMENT_COLUMNS
+
+# Comprobación perezosa del esquema: una vez por proceso, en la primera petición
+# (importar la aplicación no abre la base de datos; ver wsgi.py)
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+def _check_schema():
+    """
+    Verifica en la primera petición de cada proceso que la base esté migrada
+    
+    Con AUTO_MIGRATE=1 (por defecto) aplica init_db() si el esquema está desactualizado,
+    cómodo en desarrollo. En producción conviene migrar antes de arrancar los workers
+    ("flask --app wsgi migrate", como hace el Dockerfile) y usar AUTO_MIGRATE=0.
+    """
+    global _schema_checked
+    if _schema_checked:
+        return
+    with _schema_lock:
+        if _schema_checked:
+            return
+        if os.environ.get('AUTO_MIGRATE', '1') == '1':
+            ensure_schema()
+        else:
+            with get_db() as db:
+                version = get_schema_version(db)
+            if version < SCHEMA_VERSION:
+                print(f"AVISO: La base está en la versión {version} del esquema y la aplicación "
+                      f"espera la {SCHEMA_VERSION}. Ejecutar: flask --app wsgi migrate")
+        _schema_checked = True
+
+def migrate_command():
+    """Crea o actualiza el esquema de la base de datos (flask --app wsgi migrate)"""
+    with get_db() as db:
+        previous = get_schema_version(db)
+    init_db()
+    print(f"Esquema de la base de datos: versión {previous} -> {SCHEMA_VERSION}")
 
 # Crear la aplicación Flask
 def create_app(config_name=None):
@@ -87,8 +153,34 @@ def create_app(config_name=None):
         app.config['SESSION_COOKIE_SECURE'] = False
         app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
     
-    # Inicializar la base de datos al arrancar la aplicación
-    init_db()
+    # Tiempos por petición: total, base de datos y plantillas (ver instrumentation.py)
+    instrumentation.init_app(app)
+    # Contadores e histogramas por ruta y rol para /metrics
+    metrics.init_app(app)
+    # Perfilado de peticiones de administradores (?_profile=1 o cabecera X-Profile)
+    profiling.init_app(app)
+    # Plantillas compiladas en disco (compartidas entre workers) y etiqueta {% cache %}
+    template_cache.init_app(app)
+    # Middleware WSGI de compresión (negocia Accept-Encoding, admite streaming)
+    compression.init_app(app)
+    # API JSON para integraciones (autenticación por token, no por sesión)
+    app.register_blueprint(api.bp)
+    # Hilo que envía las notificaciones de stock (nunca dentro de la petición)
+    notifications.init_app(app)
+    # Lecturas de reportes en la réplica: recuerda las escrituras de cada usuario (leer lo
+    # propio) y renueva la copia SQLite en segundo plano
+    replica.init_app(app)
+    
+    # La base de datos NO se inicializa aquí: create_app() se ejecuta al importar el módulo
+    # (en cada worker, cada prueba, cada recarga). El esquema se crea/actualiza con el
+    # comando "migrate" y cada proceso solo verifica la versión en su primera petición.
+    app.before_request(_check_schema)
+    app.cli.command('migrate')(migrate_command)
+    app.cli.command('reevaluate-alerts')(stock_alerts.reevaluate_command)
+    app.cli.command('dispatch-notifications')(notifications.dispatch_command)
+    app.cli.command('create-location')(locations.create_location_command)
+    app.cli.command('list-locations')(locations.list_locations_command)
+    app.cli.command('refresh-replica')(replica.refresh_command)
     
     return app
 
@@ -96,7 +188,8 @@ def create_app(config_name=None):
 app = create_app()
 
 # Función para registrar movimientos de inventario
-def log_inventory_movement(product_id, product_name, movement_type, quantity_before, quantity_after, reason=None):
+def log_inventory_movement(product_id, product_name, movement_type, quantity_before, quantity_after, reason=None,
+                           actor=None, db=None, location_id=locations.MAIN_LOCATION_ID, location_delta=None):
     """
     Registra todos los cambios en el inventario para auditoría
     
@@ -109,42 +202,80 @@ def log_inventory_movement(product_id, product_name, movement_type, quantity_bef
     
     Args:
         product_id (int): ID del producto modificado
-        product_name (str): Nombre del producto (para historiales legibles)
+        product_name (str): Nombre del producto. Solo se guarda en las eliminaciones,
+            como foto histórica; el resto de movimientos toma el nombre vigente de product_dim
         movement_type (str): Tipo de movimiento ('entrada', 'salida', 'ajuste', etc.)
         quantity_before (int): Cantidad antes del cambio
         quantity_after (int): Cantidad después del cambio
         reason (str, optional): Motivo del cambio
+        actor (tuple, optional): (user_id, username) de quien hizo el cambio. Por defecto
+            el usuario de la sesión; se indica cuando no hay sesión (ej: escaneos con token)
+        db (Database, optional): Conexión con una transacción abierta. El movimiento se
+            inserta en ella y el commit queda a cargo de quien llama (mismo commit que el
+            cambio de stock), también en modo spool: si la transacción se revierte, el
+            movimiento desaparece con ella. Sin db se abre una conexión y se confirma aquí mismo.
+        location_id (int, optional): Ubicación donde ocurrió (por defecto la principal;
+            None en las eliminaciones, que afectan a todas las ubicaciones)
+        location_delta (int, optional): Diferencia en esa ubicación. Por defecto la misma
+            que la del total; en una transferencia el total no cambia y aquí van las unidades
     """
-    # Verificar que hay un usuario logueado antes de registrar
-    if 'user_id' not in session:
-        return  # Si no hay sesión, no registrar el movimiento
+    if actor is None:
+        # Verificar que hay un usuario logueado antes de registrar
+        if 'user_id' not in session:
+            return  # Si no hay sesión, no registrar el movimiento
+        actor = (session['user_id'], session['username'])
+    user_id, username = actor
     
     # Calcular la diferencia de cantidad (puede ser positiva o negativa)
     quantity_change = quantity_after - quantity_before
-    
-    # Conectar a la base de datos usando la función abstracta
-    conn, is_sqlite = get_db_connection()
-    cursor = conn.cursor()
+    if location_delta is None and location_id is not None:
+        location_delta = quantity_change
+    
+    # El nombre solo se guarda cuando el producto deja de existir
+    if movement_type != 'eliminacion':
+        product_name = None
+    
+    # MODO SPOOL: el movimiento se escribe en un archivo local (con fsync) y un hilo
+    # lo inserta en la base de datos en lotes; la fecha se fija ahora, no al volcar.
+    # Con db no: el spool no sabe si la transacción de quien llama se confirmará, y un
+    # movimiento ya escrito en el spool se insertaría aunque el cambio de stock se revierta
+    if movement_spool.enabled() and db is None:
+        movement_spool.spool.append({
+            'product_id': product_id,
+            'product_name': product_name,
+            'movement_type': movement_type,
+            'quantity_before': quantity_before,
+            'quantity_after': quantity_after,
+            'quantity_change': quantity_change,
+            'reason': reason,
+            'user_id': user_id,
+            'username': username,
+            'created_at': movement_spool.utc_timestamp(),
+            'location_id': location_id,
+            'location_delta': location_delta,
+        })
+        return
+    
+    # Conectar a la base de datos (SQLite, PostgreSQL o MySQL, ver db.py)
+    # salvo que quien llama ya tenga una transacción abierta
+    own_connection = db is None
+    if own_connection:
+        db = get_db()
     
     # Insertar registro de movimiento en la tabla inventory_movements
-    # Los ? son placeholders para prevenir inyección SQL en SQLite
-    # Para PostgreSQL/MySQL, los marcadores dependen del driver
-    if is_sqlite:
-        cursor.execute("""
-            INSERT INTO inventory_movements 
-            (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, user_id, username)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, session['user_id'], session['username']))
-    else:
-        # Para PostgreSQL/MySQL, usamos %s como marcador de posición
-        cursor.execute("""
-            INSERT INTO inventory_movements 
-            (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, user_id, username)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, session['user_id'], session['username']))
-    
-    conn.commit()  # Confirmar cambios
-    conn.close()   # Cerrar conexión
+    # Los ? son placeholders para prevenir inyección SQL; db.py los traduce
+    # al formato del driver configurado (%s en PostgreSQL/MySQL)
+    db.execute("""
+        INSERT INTO inventory_movements 
+        (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, user_id, username,
+         location_id, location_delta)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change, reason, user_id, username,
+          location_id, location_delta))
+    
+    if own_connection:
+        db.commit()  # Confirmar cambios
+        db.close()   # Cerrar conexión
 
 # Función para hashear contraseñas (duplicada de database.py por consistencia)
 def hash_password(password):
@@ -276,6 +407,20 @@ def role_required(required_role):
         return decorated_function
     return decorator  # Retornar el decorador
 
+@app.errorhandler(500)
+def internal_error(error):
+    """
+    Errores internos: distingue los bloqueos de la base de datos del resto
+    
+    Con varios workers escribiendo a la vez, SQLite puede responder "database is locked".
+    En ese caso se devuelve 503 (el cliente puede reintentar) con la cabecera
+    X-DB-Error: locked, que usan scripts/load_test.py y el monitoreo para contarlos.
+    """
+    if is_lock_error(getattr(error, 'original_exception', None)):
+        return ('La base de datos está ocupada. Intente nuevamente en unos segundos.', 503,
+                {'X-DB-Error': 'locked', 'Retry-After': '1'})
+    return error
+
 # RUTAS (ENDPOINTS): Funciones que responden a URLs específicas
 # Flask usa el decorador @app.route() para asociar URLs con funciones
 
@@ -302,13 +447,11 @@ def login():
         password_hash = hash_password(password)
         
         # Buscar usuario en la base de datos
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        db = get_db()
         
         # Consulta SQL con placeholder ? para seguridad (previene inyección SQL)
-        cursor.execute("SELECT id, role, password_hash FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()  # Obtener primera fila o None si no existe
-        conn.close()
+        user = db.query_one("SELECT id, role, password_hash FROM users WHERE username = ?", (username,))  # Primera fila o None
+        db.close()
         
         # Verificar si usuario existe y contraseña es correcta
         if user and user[2] == password_hash:
@@ -323,10 +466,12 @@ def login():
             # flash(): mensaje temporal que se muestra en la siguiente página
             flash('Inicio de sesión exitoso!', 'success')
             
+            metrics.LOGIN_ATTEMPTS.inc(result='success')
             # Redirigir al dashboard después del login
             return redirect(url_for('dashboard'))
         else:
             # Login fallido
+            metrics.LOGIN_ATTEMPTS.inc(result='failure')
             flash('Usuario o contraseña incorrectos', 'error')
     
     # Si es GET o si el login falló, mostrar el formulario
@@ -377,6 +522,10 @@ def renew_session():
     session.permanent = True
     return '', 204
 
+# Productos con su estado de alerta de stock ('normal', 'warning' o 'critical')
+# Uso: f"SELECT {PRODUCT_WITH_ALERT} WHERE ... ORDER BY ..."
+PRODUCT_WITH_ALERT = "p.*, a.state AS alert_state FROM products p LEFT JOIN stock_alerts a ON a.product_id = p.id"
+
 @app.route("/")  # Ruta raíz - página principal
 @login_required  # Solo usuarios logueados pueden ver esta página
 def home():
@@ -394,33 +543,28 @@ def home():
     search_query = request.args.get('search', '')
     
     # Conectar a la base de datos
-    conn = sqlite3.connect(DB_NAME)
-    # row_factory = sqlite3.Row hace que los resultados sean diccionarios
-    # En lugar de tuplas: row['name'] en lugar de row[0]
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    # Las filas se comportan como diccionarios: row['name'] en lugar de row[0]
+    db = get_db()
     
     if search_query:
         # Si hay búsqueda, filtrar productos
         # LIKE %término% busca el término en cualquier parte del texto
         # Se busca en nombre, categoría y proveedor
-        cursor.execute("""
-            SELECT * FROM products 
-            WHERE name LIKE ? OR category LIKE ? OR provider LIKE ?
+        like = db.dialect.like  # LIKE (SQLite/MySQL) o ILIKE (PostgreSQL): sin distinguir mayúsculas
+        productos = db.query(f"""
+            SELECT {PRODUCT_WITH_ALERT} 
+            WHERE name {like} ? OR category {like} ? OR provider {like} ?
             ORDER BY created_at DESC
         """, (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'))
     else:
         # Sin búsqueda, mostrar todos los productos ordenados por fecha
-        cursor.execute("SELECT * FROM products ORDER BY created_at DESC")
-    
-    productos = cursor.fetchall()  # Obtener todos los resultados
+        productos = db.query(f"SELECT {PRODUCT_WITH_ALERT} ORDER BY created_at DESC")
     
     # Calcular estadística adicional: productos con stock bajo
-    # quantity < stock_min significa que el stock está por debajo del mínimo
-    cursor.execute("SELECT COUNT(*) as low_stock_count FROM products WHERE quantity < stock_min")
-    low_stock_count = cursor.fetchone()['low_stock_count']
+    # Se cuentan en stock_alerts (índice por estado) sin recorrer todos los productos
+    low_stock_count = db.scalar("SELECT COUNT(*) as low_stock_count FROM stock_alerts WHERE state IN ('warning', 'critical')")
     
-    conn.close()
+    db.close()
     
     # render_template() es donde entra Jinja2
     # Jinja2: Motor de plantillas que mezcla HTML con datos dinámicos
@@ -457,29 +601,24 @@ def add_product():
             provider = request.form["provider"]
             stock_min = int(request.form["stock_min"])
 
-            conn = sqlite3.connect(DB_NAME)
-            cursor = conn.cursor()
+            db = get_db()
             
             # Verificar unicidad del SKU si se proporcionó
             if sku:
-                cursor.execute("SELECT id FROM products WHERE sku = ? AND sku IS NOT NULL", (sku,))
-                existing_product = cursor.fetchone()
+                existing_product = db.query_one("SELECT id FROM products WHERE sku = ? AND sku IS NOT NULL", (sku,))
                 if existing_product:
                     flash(f'Ya existe un producto con el SKU: {sku}', 'error')
-                    conn.close()
+                    db.close()
                     return render_template("add_product.html")  # Volver al formulario
             
             # Insertar nuevo producto en la base de datos
-            cursor.execute("""
+            # insert() devuelve el ID autogenerado (lastrowid o RETURNING id según el motor)
+            product_id = db.insert("""
                 INSERT INTO products (name, sku, category, quantity, price, provider, stock_min)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (name, sku, category, quantity, price, provider, stock_min))
-            
-            # Obtener el ID del producto recién creado
-            # lastrowid: ID autogenerado de la última inserción
-            product_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            db.commit()
+            db.close()
 
             # Registrar movimiento de inventario (creación del producto)
             log_inventory_movement(product_id, name, 'creacion', 0, quantity, f'Producto creado con stock inicial de {quantity}')
@@ -507,18 +646,37 @@ def manage_users():
     Returns:
         Template con lista de usuarios para mostrar en la interfaz
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row  # Para acceder a columnas por nombre
-    cursor = conn.cursor()
+    db = get_db()
     
     # Obtener todos los usuarios ordenados alfabéticamente
     # No incluimos password_hash por seguridad
-    cursor.execute("SELECT id, username, role FROM users ORDER BY username")
-    users = cursor.fetchall()
-    conn.close()
+    users = db.query("SELECT id, username, role FROM users ORDER BY username")
+    db.close()
     
     return render_template("manage_users.html", users=users)
 
+@app.route("/profiles")
+@role_required('admin')
+def profiles():
+    """
+    Lista de perfiles de rendimiento guardados (data/profiles)
+    
+    Un administrador genera un perfil agregando ?_profile=1 (cProfile + muestreo)
+    o ?_profile=sample (solo muestreo) a cualquier URL de la aplicación.
+    """
+    return render_template("profiles.html", profiles=profiling.list_profiles(),
+                           max_count=profiling.PROFILE_MAX_COUNT, max_age_days=profiling.PROFILE_MAX_AGE_DAYS)
+
+@app.route("/profiles/<profile_id>/<any(pstats, collapsed):kind>")
+@role_required('admin')
+def download_profile(profile_id, kind):
+    """
+    Descarga el archivo .pstats o .collapsed de un perfil
+    
+    send_from_directory rechaza rutas fuera del directorio (ej: ../)
+    """
+    return send_from_directory(os.path.abspath(profiling.PROFILE_DIR), f'{profile_id}.{kind}', as_attachment=True)
+
 @app.route("/create_user", methods=["POST"])
 @role_required('admin')  # Solo administradores pueden crear usuarios
 def create_user():
@@ -542,21 +700,22 @@ def create_user():
     # Hashear contraseña antes de almacenar (NUNCA guardar en texto plano)
     password_hash = hash_password(password)
     
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    db = get_db()
     
     try:
         # Intentar insertar nuevo usuario
-        cursor.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)", 
-                      (username, password_hash, role))
-        conn.commit()
+        db.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)", 
+                   (username, password_hash, role))
+        db.commit()
         flash(f'Usuario {username} creado exitosamente!', 'success')
-    except sqlite3.IntegrityError:
+    except db.IntegrityError:
         # Error de integridad: username ya existe (constraint UNIQUE)
+        # db.IntegrityError es la excepción equivalente del driver en uso
+        db.rollback()
         flash('El nombre de usuario ya existe', 'error')
     finally:
         # Siempre cerrar la conexión, sin importar si hubo error
-        conn.close()
+        db.close()
     
     # Redirigir de vuelta a la página de gestión de usuarios
     return redirect(url_for('manage_users'))
@@ -583,44 +742,66 @@ def delete_user(user_id):
         flash('No puedes eliminar tu propia cuenta', 'error')
         return redirect(url_for('manage_users'))
     
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    db = get_db()
     
     # Verificar que el usuario existe y obtener su rol
-    cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
-    user_to_delete = cursor.fetchone()
+    user_to_delete = db.query_one("SELECT role FROM users WHERE id = ?", (user_id,))
     
     if not user_to_delete:
         flash('Usuario no encontrado', 'error')
-        conn.close()
+        db.close()
         return redirect(url_for('manage_users'))
     
     # VALIDACIÓN 2: Evitar que los administradores se eliminen entre sí
     # Esto previene que un admin malicioso elimine a otros admins
     if user_to_delete[0] == 'admin':
         flash('No se puede eliminar a otro administrador por seguridad', 'error')
-        conn.close()
+        db.close()
         return redirect(url_for('manage_users'))
     
     # VALIDACIÓN 3: Verificar que no es el último usuario del sistema
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
+    total_users = db.scalar("SELECT COUNT(*) FROM users")
     
     if total_users <= 1:
         flash('No se puede eliminar el último usuario del sistema', 'error')
-        conn.close()
+        db.close()
         return redirect(url_for('manage_users'))
     
     # Si pasa todas las validaciones, proceder con la eliminación
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    db.commit()
+    db.close()
     
     flash('Usuario eliminado exitosamente', 'success')
     return redirect(url_for('manage_users'))
 
+@app.route("/admin/movement_spool")
+@role_required('admin')
+def movement_spool_status():
+    """
+    Métricas del spool de movimientos de este proceso (JSON)
+    
+    Útil para vigilar el retraso del volcado en modo MOVEMENT_WRITE_MODE=spool:
+    movimientos pendientes, antigüedad del más antiguo, lotes volcados y errores.
+    """
+    return jsonify(movement_spool.spool.stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Métricas de todos los workers en formato de texto de Prometheus
+    
+    Sin sesión: la consultan herramientas de monitoreo. Si se define METRICS_TOKEN,
+    se exige la cabecera "Authorization: Bearer <token>".
+    """
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('No autorizado\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route("/reports")
 @login_required  # Cualquier usuario logueado puede ver reportes
+@uses_fragment_cache  # report.html guarda tablas y datos de gráficos con {% cache %}
 def reports():
     """
     Página de reportes completos del inventario
@@ -639,17 +820,20 @@ def reports():
     - Subconsultas y JOINs
     - Filtros por fechas
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    db = get_db(readonly=True)
+    # Las expresiones de fechas dependen del motor (date() en SQLite, CAST en PostgreSQL...)
+    dialect = db.dialect
+    
+    # Las tablas de la plantilla usan las filas tal cual (product['name']); solo los datos
+    # de los gráficos, que se serializan con |tojson, se convierten a diccionarios (records)
     
     # REPORTE 1: Productos con bajo stock (críticos)
-    cursor.execute("SELECT * FROM products WHERE quantity < stock_min ORDER BY quantity ASC")
-    low_stock = [dict(row) for row in cursor.fetchall()]
+    # Los productos en alerta salen de stock_alerts (ver stock_alerts.py)
+    low_stock = db.query(f"SELECT * FROM products WHERE id IN ({ALERTED_PRODUCT_IDS}) ORDER BY quantity ASC")
     
     # REPORTE 2: Estadísticas generales del inventario
     # Esta consulta calcula múltiples métricas en una sola pasada
-    cursor.execute("""
+    stats = dict(db.query_one("""
         SELECT 
             COUNT(*) as total_products,           -- Total de productos únicos
             SUM(quantity) as total_items,         -- Total de unidades en inventario
@@ -658,12 +842,11 @@ def reports():
             MAX(price) as max_price,              -- Precio más alto
             SUM(quantity * price) as total_value  -- Valor total del inventario
         FROM products
-    """)
-    stats = dict(cursor.fetchone())
+    """))
     
     # REPORTE 3: Análisis por categoría
     # GROUP BY agrupa filas por categoría y calcula métricas para cada grupo
-    cursor.execute("""
+    categories = records(db.query("""
         SELECT 
             category, 
             COUNT(*) as product_count,                    -- Productos por categoría
@@ -674,12 +857,11 @@ def reports():
         WHERE category IS NOT NULL AND category != ''     -- Excluir categorías vacías
         GROUP BY category 
         ORDER BY product_count DESC                       -- Ordenar por cantidad de productos
-    """)
-    categories = [dict(row) for row in cursor.fetchall()]
+    """))
     
     # REPORTE 4: Top 10 productos más valiosos
     # Calculamos valor = cantidad × precio
-    cursor.execute("""
+    top_products = db.query("""
         SELECT 
             name, 
             category, 
@@ -690,68 +872,104 @@ def reports():
         ORDER BY total_value DESC 
         LIMIT 10
     """)
-    top_products = [dict(row) for row in cursor.fetchall()]
     
     # REPORTE 5: Productos sin stock (cantidad = 0)
-    cursor.execute("SELECT * FROM products WHERE quantity = 0 ORDER BY name")
-    no_stock = [dict(row) for row in cursor.fetchall()]
+    no_stock = db.query("""
+        SELECT * FROM products
+        WHERE id IN (SELECT product_id FROM stock_alerts WHERE state = 'critical')
+        ORDER BY name
+    """)
     
     # REPORTE 6: Productos agregados recientemente (últimos 30 días)
-    # date() convierte timestamp a fecha, 'now' es la fecha actual
-    cursor.execute("""
+    # to_date() convierte timestamp a fecha, days_ago(30) es la fecha de hace 30 días
+    recent_products = db.query(f"""
         SELECT * FROM products 
-        WHERE date(created_at) >= date('now', '-30 days')
+        WHERE {dialect.to_date('created_at')} >= {dialect.days_ago(30)}
         ORDER BY created_at DESC
     """)
-    recent_products = [dict(row) for row in cursor.fetchall()]
     
     # DATOS PARA GRÁFICOS (Chart.js en el frontend)
     
     # GRÁFICO 1: Tendencias de movimientos por día (últimos 30 días)
     # CASE WHEN es como un if/else en SQL
-    cursor.execute("""
+    movement_trends = records(db.query(f"""
         SELECT 
-            date(created_at) as date,
+            {dialect.to_date('created_at')} as date,
             COUNT(*) as movement_count,
             SUM(CASE WHEN movement_type = 'entrada' THEN quantity_change ELSE 0 END) as total_entries,
             SUM(CASE WHEN movement_type = 'salida' THEN ABS(quantity_change) ELSE 0 END) as total_exits
         FROM inventory_movements 
-        WHERE date(created_at) >= date('now', '-30 days')
-        GROUP BY date(created_at)
-        ORDER BY date(created_at)
-    """)
-    movement_trends = [dict(row) for row in cursor.fetchall()]
+        WHERE {dialect.to_date('created_at')} >= {dialect.days_ago(30)}
+        GROUP BY {dialect.to_date('created_at')}
+        ORDER BY {dialect.to_date('created_at')}
+    """))
+    for trend in movement_trends:
+        trend['date'] = str(trend['date'])  # PostgreSQL/MySQL devuelven objetos date
     
     # GRÁFICO 2: Productos más movidos (mayor actividad)
-    cursor.execute("""
+    # Se agrupa por product_id (entero, resuelto con el índice idx_movements_product)
+    # y solo al final se buscan los nombres en product_dim: un producto renombrado
+    # sigue contando como uno solo. Incluye los totales de los meses ya archivados
+    # (movement_archive_rollups), sin descomprimir segmentos
+    most_moved_products = records(db.query("""
         SELECT 
-            product_name,
-            COUNT(*) as movement_count,              -- Número de movimientos
-            SUM(ABS(quantity_change)) as total_moved -- Total de unidades movidas
-        FROM inventory_movements 
-        GROUP BY product_name
-        ORDER BY movement_count DESC
-        LIMIT 10
-    """)
-    most_moved_products = [dict(row) for row in cursor.fetchall()]
+            totals.product_id,
+            d.name as product_name,
+            totals.movement_count,                   -- Número de movimientos
+            totals.total_moved                       -- Total de unidades movidas
+        FROM (
+            SELECT product_id, SUM(movement_count) as movement_count, SUM(total_moved) as total_moved
+            FROM (
+                SELECT product_id, COUNT(*) as movement_count, SUM(ABS(quantity_change)) as total_moved
+                FROM inventory_movements
+                GROUP BY product_id
+                UNION ALL
+                SELECT product_id, movement_count, total_moved
+                FROM movement_archive_rollups
+            ) all_movements
+            GROUP BY product_id
+            ORDER BY movement_count DESC
+            LIMIT 10
+        ) totals
+        LEFT JOIN product_dim d ON d.product_id = totals.product_id
+        ORDER BY totals.movement_count DESC
+    """))
+    # Productos sin nombre conocido (ej: eliminados antes de existir deleted_products)
+    for product in most_moved_products:
+        product['product_name'] = product['product_name'] or f"Producto #{product['product_id']}"
     
     # GRÁFICO 3: Distribución de niveles de stock
     # CASE WHEN crea categorías basadas en condiciones
-    cursor.execute("""
+    # Sin stock / bajo según el estado de alerta; normal / alto según el doble del mínimo
+    stock_distribution = records(db.query("""
         SELECT 
             CASE 
-                WHEN quantity = 0 THEN 'Sin stock'
-                WHEN quantity < stock_min THEN 'Stock bajo'
-                WHEN quantity >= stock_min AND quantity < stock_min * 2 THEN 'Stock normal'
+                WHEN a.state = 'critical' THEN 'Sin stock'
+                WHEN a.state = 'warning' THEN 'Stock bajo'
+                WHEN p.quantity < p.stock_min * 2 THEN 'Stock normal'
                 ELSE 'Stock alto'
             END as stock_level,
             COUNT(*) as product_count
-        FROM products
+        FROM products p
+        JOIN stock_alerts a ON a.product_id = p.id
         GROUP BY stock_level
+    """))
+    
+    # REPORTE 7: Puntos de reorden sugeridos por el pronóstico de demanda
+    # Los calcula la tarea programada forecasting.py (tabla reorder_suggestions); aquí
+    # solo se muestran los productos cuyo stock_min más se aleja del sugerido
+    reorder_suggestions = db.query("""
+        SELECT 
+            p.id, p.name, p.sku, p.quantity, p.stock_min,
+            r.forecast_daily_demand, r.safety_stock, r.reorder_point, r.computed_at
+        FROM reorder_suggestions r
+        JOIN products p ON p.id = r.product_id
+        WHERE r.reorder_point <> p.stock_min
+        ORDER BY ABS(r.reorder_point - p.stock_min) DESC
+        LIMIT 20
     """)
-    stock_distribution = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
+    db.close()
     
     # Pasar todos los datos al template para renderizar
     # Chart.js usará estos datos para crear gráficos interactivos
@@ -764,7 +982,8 @@ def reports():
                          recent_products=recent_products,
                          movement_trends=movement_trends,
                          most_moved_products=most_moved_products,
-                         stock_distribution=stock_distribution)
+                         stock_distribution=stock_distribution,
+                         reorder_suggestions=reorder_suggestions)
 
 @app.route("/edit_product/<int:product_id>", methods=["GET", "POST"])
 @role_required('editor')  # Solo editores y administradores pueden editar
@@ -784,8 +1003,7 @@ def edit_product(product_id):
     - Preserva datos originales para comparación
     - Manejo de errores si el producto no existe
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    db = get_db()
     
     if request.method == "POST":
         # Procesar formulario de edición
@@ -796,22 +1014,33 @@ def edit_product(product_id):
         provider = request.form["provider"]
         stock_min = int(request.form["stock_min"])
         
+        # Transacción de escritura desde la lectura: una transferencia que se confirme entre la
+        # comprobación de stock y el UPDATE dejaría la ubicación principal en negativo
+        db.begin_write()
+        
         # Obtener datos anteriores para comparación y auditoría
-        cursor.execute("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
-        old_product = cursor.fetchone()
+        old_product = db.query_one("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
         old_quantity = old_product[1] if old_product else 0
         old_name = old_product[0] if old_product else name
         
+        # Un cambio de cantidad desde aquí se aplica a la ubicación principal (ver locations.py):
+        # una baja mayor que su stock tiene que hacerse en la ubicación donde está la mercancía
+        main_quantity = locations.level(db, product_id, locations.MAIN_LOCATION_ID) or 0
+        if quantity < old_quantity and old_quantity - quantity > main_quantity:
+            db.rollback()
+            db.close()
+            flash(f'La ubicación principal solo tiene {main_quantity} unidades: '
+                  'usa el ajuste rápido en la ubicación correspondiente', 'error')
+            return redirect(url_for('edit_product', product_id=product_id))
+        
         # Actualizar producto en la base de datos
-        cursor.execute("""
+        db.execute("""
             UPDATE products 
             SET name = ?, category = ?, quantity = ?, price = ?, provider = ?, stock_min = ?
             WHERE id = ?
         """, (name, category, quantity, price, provider, stock_min, product_id))
-        conn.commit()
-        conn.close()
         
-        # Registrar movimiento de inventario si cambió la cantidad
+        # Registrar movimiento de inventario si cambió la cantidad (en la misma transacción)
         if quantity != old_quantity:
             if quantity > old_quantity:
                 # Aumentó la cantidad - es una entrada
@@ -823,17 +1052,16 @@ def edit_product(product_id):
                 reason = f'Actualización de producto: salida de {old_quantity - quantity} unidades'
             
             # Registrar el movimiento para auditoría
-            log_inventory_movement(product_id, name, movement_type, old_quantity, quantity, reason)
+            log_inventory_movement(product_id, name, movement_type, old_quantity, quantity, reason, db=db)
+        db.commit()
+        db.close()
         
         flash('Producto actualizado exitosamente!', 'success')
         return redirect(url_for('home'))
     
     # GET request: mostrar formulario con datos actuales
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    conn.close()
+    product = db.query_one("SELECT * FROM products WHERE id = ?", (product_id,))
+    db.close()
     
     # Verificar que el producto existe
     if not product:
@@ -861,31 +1089,37 @@ def delete_product(product_id):
     3. Registrar movimiento de eliminación (cantidad final = 0)
     4. Redirigir con mensaje de confirmación
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    db = get_db()
     
     # Obtener información del producto antes de eliminarlo
     # Necesitamos estos datos para el registro de movimiento
-    cursor.execute("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
+    product = db.query_one("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
     
     if product:
         product_name, quantity = product
         
         # Eliminar producto de la base de datos
-        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        conn.commit()
+        # y conservar su nombre en deleted_products para los reportes históricos
+        # (ON CONFLICT ... DO UPDATE funciona igual en SQLite y PostgreSQL)
+        db.execute("""
+            INSERT INTO deleted_products (product_id, name, category)
+            SELECT id, name, category FROM products WHERE id = ?
+            ON CONFLICT (product_id) DO UPDATE SET name = excluded.name, category = excluded.category
+        """, (product_id,))
+        db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        db.commit()
         
         # Registrar movimiento de eliminación para auditoría
         # La cantidad final es 0 porque el producto ya no existe
-        log_inventory_movement(product_id, product_name, 'eliminacion', quantity, 0, 'Producto eliminado del inventario')
+        log_inventory_movement(product_id, product_name, 'eliminacion', quantity, 0, 'Producto eliminado del inventario',
+                               location_id=None)
         
         flash('Producto eliminado exitosamente', 'success')
     else:
         # El producto no existe
         flash('Producto no encontrado', 'error')
     
-    conn.close()
+    db.close()
     return redirect(url_for('home'))
 
 @app.route("/inventory_movements")
@@ -909,6 +1143,7 @@ def inventory_movements():
     - movement_type: filtro por tipo ('entrada', 'salida', etc.)
     - date_from: fecha desde (YYYY-MM-DD)
     - date_to: fecha hasta (YYYY-MM-DD)
+    - location_id: filtro por ubicación (ver locations.py)
     """
     # Obtener parámetros de paginación y filtros de la URL
     page = request.args.get('page', 1, type=int)  # Página actual, por defecto 1
@@ -920,54 +1155,53 @@ def inventory_movements():
     movement_type_filter = request.args.get('movement_type', '')
     date_from = request.args.get('date_from', '')
     date_to = request.args.get('date_to', '')
+    location_filter = request.args.get('location_id', None, type=int)
     
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # CONSTRUCCIÓN DINÁMICA DE CONSULTA SQL
-    # Empezamos con una query base y agregamos WHERE según filtros
-    query = "SELECT * FROM inventory_movements WHERE 1=1"  # 1=1 siempre es true
-    params = []  # Lista de parámetros para la consulta
-    
-    # Agregar filtros dinámicamente
-    if product_filter:
-        query += " AND product_name LIKE ?"
-        params.append(f'%{product_filter}%')  # %texto% busca texto en cualquier posición
+    db = get_db(readonly=True)
     
-    if movement_type_filter:
-        query += " AND movement_type = ?"
-        params.append(movement_type_filter)
-    
-    if date_from:
-        query += " AND date(created_at) >= ?"  # date() extrae solo la fecha
-        params.append(date_from)
-    
-    if date_to:
-        query += " AND date(created_at) <= ?"
-        params.append(date_to)
+    # Solo se leen las particiones archivadas que se solapan con el rango de fechas.
+    # Sin rango de fechas se lee solo la tabla viva (los meses recientes), como en la API:
+    # la página por defecto no descomprime todo el archivo en cada visita
+    if date_from or date_to:
+        source = movement_source(db, date_from, date_to)
+    else:
+        source = 'inventory_movements'
+    # Meses archivados que no se muestran: la plantilla indica que hay que filtrar por fechas
+    archived_hidden = not (date_from or date_to) and bool(load_manifest()['segments'])
+    
+    # CONSULTA SQL CANÓNICA (ver query_builder.py)
+    # Los filtros vacíos no se agregan; cada combinación de filtros produce siempre el
+    # mismo texto SQL y los valores van como parámetros
+    filters = {
+        'product': f'%{product_filter}%' if product_filter else '',  # %texto% busca texto en cualquier posición
+        'movement_type': movement_type_filter,
+        'location_id': location_filter,
+        'date_from': date_from,  # Se compara solo la fecha, sin hora
+        'date_to': date_to,
+    }
     
     # CALCULAR TOTAL DE REGISTROS para la paginación
-    # Reemplazamos SELECT * por SELECT COUNT(*) en la misma query
-    count_query = query.replace("SELECT *", "SELECT COUNT(*)")
-    cursor.execute(count_query, params)
-    total_records = cursor.fetchone()[0]
+    # El JOIN con product_dim solo hace falta para contar si se filtra por nombre
+    count_query, params = query_builder.build('movement_history', db.dialect, filters, source, count=True)
+    total_records = db.scalar(count_query, params)
     
     # OBTENER REGISTROS DE LA PÁGINA ACTUAL
     # LIMIT: máximo registros a devolver
     # OFFSET: cuántos registros saltar desde el inicio
-    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    query, params = query_builder.build('movement_history', db.dialect, filters, source)
     params.extend([per_page, offset])
     
-    cursor.execute(query, params)
-    movements = cursor.fetchall()
+    movements = db.query(query, params)
     
     # CALCULAR INFORMACIÓN DE PAGINACIÓN
     total_pages = (total_records + per_page - 1) // per_page  # División con redondeo hacia arriba
     has_prev = page > 1                    # ¿Hay página anterior?
     has_next = page < total_pages          # ¿Hay página siguiente?
     
-    conn.close()
+    # Nombres de las ubicaciones para el filtro y la columna de ubicación
+    location_names = {row['id']: row['name'] for row in locations.list_locations(db)}
+    
+    db.close()
     
     # Pasar todos los datos al template
     # El template usará esta información para mostrar:
@@ -984,7 +1218,10 @@ def inventory_movements():
                          product_filter=product_filter,
                          movement_type_filter=movement_type_filter,
                          date_from=date_from,
-                         date_to=date_to)
+                         date_to=date_to,
+                         location_filter=location_filter,
+                         location_names=location_names,
+                         archived_hidden=archived_hidden)
 
 @app.route("/quick_stock_adjustment/<int:product_id>", methods=["GET", "POST"])
 @role_required('editor')  # Solo editores y administradores
@@ -1010,59 +1247,181 @@ def quick_stock_adjustment(product_id):
         adjustment_type = request.form["adjustment_type"]  # 'add' o 'subtract'
         quantity = int(request.form["quantity"])           # Cantidad a ajustar
         reason = request.form["reason"]                    # Motivo del ajuste
+        # Ubicación donde entra o sale la mercancía (por defecto la principal)
+        location_id = request.form.get("location_id", locations.MAIN_LOCATION_ID, type=int)
         
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+        db = get_db()
+        db.begin_write()
         
         # Obtener información actual del producto
-        cursor.execute("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
-        product = cursor.fetchone()
+        product = db.query_one("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
         
-        if not product:
-            flash('Producto no encontrado', 'error')
+        if not product or locations.get_location(db, location_id) is None:
+            db.rollback()
+            db.close()
+            flash('Producto o ubicación no encontrados', 'error')
             return redirect(url_for('home'))
         
         product_name, current_quantity = product
         
-        # Calcular nueva cantidad según el tipo de ajuste
+        # Calcular el cambio según el tipo de ajuste
         if adjustment_type == 'add':
             # Agregar stock
-            new_quantity = current_quantity + quantity
+            delta = quantity
             movement_type = 'entrada'
             reason = f'Ajuste de inventario: +{quantity} - {reason}'
         else:  # subtract
-            # Quitar stock (no permitir cantidad negativa)
-            new_quantity = max(0, current_quantity - quantity)
+            # Quitar stock (la ubicación nunca queda en negativo, ver locations.adjust)
+            delta = -quantity
             movement_type = 'salida'
             reason = f'Ajuste de inventario: -{quantity} - {reason}'
         
-        # Actualizar cantidad en la base de datos
-        cursor.execute("UPDATE products SET quantity = ? WHERE id = ?", (new_quantity, product_id))
-        conn.commit()
-        conn.close()
-        
-        # Registrar movimiento para auditoría
-        log_inventory_movement(product_id, product_name, movement_type, current_quantity, new_quantity, reason)
+        # Actualizar la ubicación y el total, y registrar el movimiento en la misma transacción
+        level_before, level_after = locations.adjust(db, product_id, location_id, delta)
+        new_quantity = current_quantity + level_after - level_before
+        log_inventory_movement(product_id, product_name, movement_type, current_quantity, new_quantity, reason,
+                               db=db, location_id=location_id)
+        db.commit()
+        db.close()
+        metrics.STOCK_ADJUSTMENTS.inc(movement_type=movement_type)
         
         flash('Ajuste de inventario realizado exitosamente', 'success')
         return redirect(url_for('home'))
     
     # GET request: mostrar formulario de ajuste
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    conn.close()
+    db = get_db()
+    product = db.query_one("SELECT * FROM products WHERE id = ?", (product_id,))
+    stock_levels = locations.levels(db, product_id)  # Stock en cada ubicación
+    db.close()
+    
+    if not product:
+        flash('Producto no encontrado', 'error')
+        return redirect(url_for('home'))
+    
+    return render_template("quick_stock_adjustment.html", product=product, stock_levels=stock_levels)
+
+@app.route("/stock_transfer/<int:product_id>", methods=["GET", "POST"])
+@role_required('editor')  # Solo editores y administradores
+def stock_transfer(product_id):
+    """
+    Transferencia de stock de un producto entre dos ubicaciones
+    
+    Las dos partes (salida del origen y entrada en el destino) se guardan en una sola
+    transacción junto con sus dos movimientos 'transferencia': si algo falla no queda
+    ninguna. El total del producto no cambia (ver locations.py).
+    
+    Args:
+        product_id (int): ID del producto a transferir
+    """
+    db = get_db()
+    
+    if request.method == "POST":
+        source_id = request.form.get("source_id", type=int)
+        target_id = request.form.get("target_id", type=int)
+        quantity = request.form.get("quantity", 0, type=int)
+        note = request.form.get("reason", "").strip()
+        
+        db.begin_write()
+        try:
+            product = db.query_one("SELECT name, quantity FROM products WHERE id = ?", (product_id,))
+            if not product:
+                raise ValueError('Producto no encontrado')
+            total = product['quantity']
+            locations.transfer(db, product_id, source_id, target_id, quantity)
+            names = {row['id']: row['name'] for row in locations.list_locations(db)}
+            reason = f"Transferencia: {quantity} de {names[source_id]} a {names[target_id]}"
+            if note:
+                reason += f" - {note}"
+            # Un movimiento por ubicación: el total queda igual, la ubicación cambia en ±quantity
+            log_inventory_movement(product_id, None, 'transferencia', total, total, reason,
+                                   db=db, location_id=source_id, location_delta=-quantity)
+            log_inventory_movement(product_id, None, 'transferencia', total, total, reason,
+                                   db=db, location_id=target_id, location_delta=quantity)
+            db.commit()
+        except ValueError as e:
+            db.rollback()
+            db.close()
+            flash(str(e), 'error')
+            return redirect(url_for('stock_transfer', product_id=product_id))
+        except Exception:
+            db.rollback()
+            db.close()
+            raise
+        db.close()
+        metrics.STOCK_ADJUSTMENTS.inc(movement_type='transferencia')
+        
+        flash('Transferencia realizada exitosamente', 'success')
+        return redirect(url_for('stock_transfer', product_id=product_id))
+    
+    # GET request: stock en cada ubicación y formulario de transferencia
+    product = db.query_one("SELECT * FROM products WHERE id = ?", (product_id,))
+    stock_levels = locations.levels(db, product_id)
+    db.close()
     
     if not product:
         flash('Producto no encontrado', 'error')
         return redirect(url_for('home'))
     
-    return render_template("quick_stock_adjustment.html", product=product)
+    return render_template("stock_transfer.html", product=product, stock_levels=stock_levels)
+
+# ESCANEO DE CÓDIGOS: lectores de mano en la recepción de mercancía (ver scanning.py)
+# Índice SKU -> producto de este proceso y agrupador de lecturas
+sku_index = scanning.SkuIndex()
+
+def apply_scans(groups):
+    """
+    Aplica un lote de lecturas agrupadas en una sola transacción
+    
+    Por cada (producto, usuario): un cambio de stock y un movimiento con el total de sus lecturas.
+    
+    Args:
+        groups (dict): {(product_id, actor): [ScanTicket, ...]} donde actor es
+            (user_id, username, nombre del token)
+    
+    Returns:
+        dict: {(product_id, actor): confirmación que recibe cada lectura del grupo}
+    """
+    results = {}
+    with get_db() as db:
+        db.begin_write()
+        try:
+            # Generación antes y después de escribir, dentro de la misma transacción:
+            # si nadie más escribió, el índice de SKU sigue vigente (aquí solo cambian cantidades)
+            before = current_generation(db)
+            for (product_id, actor), tickets in groups.items():
+                row = db.query_one("SELECT quantity FROM products WHERE id = ?", (product_id,))
+                if row is None:
+                    # Eliminado después de que se armó el índice
+                    results[(product_id, actor)] = {'status': 'not_found'}
+                    continue
+                current_quantity = row[0]
+                total = sum(ticket.delta for ticket in tickets)
+                # Las lecturas se reciben en la ubicación principal; igual que en el ajuste
+                # rápido, la cantidad nunca queda negativa (ver locations.adjust)
+                level_before, level_after = locations.adjust(db, product_id, locations.MAIN_LOCATION_ID, total)
+                new_quantity = current_quantity + level_after - level_before
+                if new_quantity != current_quantity:
+                    movement_type = 'entrada' if new_quantity > current_quantity else 'salida'
+                    reason = f'Escaneo: {total:+d} ({len(tickets)} lecturas, {actor[2]})'
+                    log_inventory_movement(product_id, None, movement_type, current_quantity, new_quantity, reason,
+                                           actor=actor[:2], db=db)
+                    metrics.STOCK_ADJUSTMENTS.inc(movement_type=movement_type)
+                results[(product_id, actor)] = {'status': 'ok', 'quantity': new_quantity, 'coalesced': len(tickets)}
+            after = current_generation(db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    sku_index.advance(before, after)
+    return results
+
+# La ruta POST /api/v1/scan está en api.py; aquí se le entregan el índice y la
+# función que aplica los lotes (usa log_inventory_movement de este módulo)
+api.init_scanning(apply_scans, sku_index)
 
 @app.route("/dashboard")
 @login_required  # Cualquier usuario puede ver el dashboard
+@uses_fragment_cache  # dashboard.html guarda alertas y movimientos con {% cache %}
 def dashboard():
     """
     Panel de control principal del sistema
@@ -1078,63 +1437,69 @@ def dashboard():
     Está diseñado para dar una vista panorámica del estado del inventario
     y permitir identificar problemas rápidamente.
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    db = get_db(readonly=True)
     
     # MÉTRICAS PRINCIPALES del inventario
     # Esta consulta calcula todas las estadísticas clave en una sola pasada
-    cursor.execute("""
+    dashboard_stats = db.query_one("""
         SELECT 
             COUNT(*) as total_products,                                    -- Total de productos únicos
             SUM(quantity) as total_items,                                  -- Total de unidades
-            SUM(quantity * price) as total_value,                          -- Valor total del inventario
-            COUNT(CASE WHEN quantity < stock_min THEN 1 END) as low_stock_count,    -- Productos con stock bajo
-            COUNT(CASE WHEN quantity = 0 THEN 1 END) as out_of_stock_count          -- Productos sin stock
+            SUM(quantity * price) as total_value                           -- Valor total del inventario
         FROM products
     """)
-    dashboard_stats = cursor.fetchone()
+    # Productos en alerta: un conteo por estado en stock_alerts (ver stock_alerts.py)
+    alert_counts = stock_alerts.counts(db)
+    dashboard_stats = dict(dashboard_stats,
+                           low_stock_count=alert_counts['warning'] + alert_counts['critical'],  # Stock bajo o sin stock
+                           out_of_stock_count=alert_counts['critical'])                        # Productos sin stock
     
     # ACTIVIDAD RECIENTE - últimos 10 movimientos
     # Permite ver qué ha pasado recientemente en el inventario
-    cursor.execute("""
-        SELECT * FROM inventory_movements 
-        ORDER BY created_at DESC 
+    recent_movements = db.query(f"""
+        SELECT {MOVEMENT_COLUMNS}
+        FROM inventory_movements im
+        LEFT JOIN product_dim d ON d.product_id = im.product_id
+        ORDER BY im.created_at DESC 
         LIMIT 10
     """)
-    recent_movements = cursor.fetchall()
     
     # PRODUCTOS QUE NECESITAN ATENCIÓN
-    # Solo productos con stock bajo o sin stock, con nivel de alerta
-    cursor.execute("""
-        SELECT *, 
-               CASE 
-                   WHEN quantity = 0 THEN 'critical'      -- Sin stock: crítico (rojo)
-                   WHEN quantity < stock_min THEN 'warning'   -- Stock bajo: advertencia (amarillo)
-                   ELSE 'normal'                          -- Stock normal: OK (verde)
-               END as alert_level
-        FROM products 
-        WHERE quantity <= stock_min    -- Solo productos con problemas
-        ORDER BY quantity ASC          -- Los más críticos primero
+    # Solo productos con stock bajo o sin stock, con nivel de alerta de stock_alerts:
+    # 'critical' = sin stock (rojo), 'warning' = en el mínimo o por debajo (amarillo)
+    alert_products = db.query("""
+        SELECT p.*, a.state as alert_level
+        FROM stock_alerts a
+        JOIN products p ON p.id = a.product_id
+        WHERE a.state IN ('warning', 'critical')   -- Solo productos con problemas (usa el índice)
+        ORDER BY p.quantity ASC                    -- Los más críticos primero
         LIMIT 10
     """)
-    alert_products = cursor.fetchall()
     
     # ACTIVIDAD POR USUARIO (últimos 7 días)
     # Permite ver quién está usando el sistema activamente
-    cursor.execute("""
+    # Se agrupa por user_id (entero) y el nombre se toma de la tabla users;
+    # el username guardado en el movimiento se usa si el usuario fue eliminado
+    user_activity = db.query(f"""
         SELECT 
-            username,
-            COUNT(*) as movement_count,                    -- Número de movimientos
-            SUM(ABS(quantity_change)) as total_quantity_moved  -- Total de unidades movidas
-        FROM inventory_movements 
-        WHERE date(created_at) >= date('now', '-7 days')   -- Solo últimos 7 días
-        GROUP BY username
-        ORDER BY movement_count DESC                       -- Los más activos primero
+            COALESCE(u.username, activity.last_username) as username,
+            activity.movement_count,
+            activity.total_quantity_moved
+        FROM (
+            SELECT 
+                user_id,
+                MAX(username) as last_username,
+                COUNT(*) as movement_count,                    -- Número de movimientos
+                SUM(ABS(quantity_change)) as total_quantity_moved  -- Total de unidades movidas
+            FROM inventory_movements 
+            WHERE {db.dialect.to_date('created_at')} >= {db.dialect.days_ago(7)}   -- Solo últimos 7 días
+            GROUP BY user_id
+        ) activity
+        LEFT JOIN users u ON u.id = activity.user_id
+        ORDER BY activity.movement_count DESC                  -- Los más activos primero
     """)
-    user_activity = cursor.fetchall()
     
-    conn.close()
+    db.close()
     
     # Pasar todos los datos al template del dashboard
     # El template organizará esta información en widgets/cards visuales
@@ -1154,57 +1519,68 @@ def export_csv():
     Puede abrirse en Excel, Google Sheets, o cualquier programa de hojas de cálculo.
     
     ¿Cómo funciona?
-    1. Obtener todos los productos de la base de datos
-    2. Crear archivo CSV en memoria (no en disco)
-    3. Escribir encabezados y datos
-    4. Devolver archivo como descarga
+    1. Leer los productos de la base de datos por lotes
+    2. Escribir encabezados y datos en un buffer en memoria (no en disco)
+    3. Enviar el buffer cada ~64 KB mientras se siguen leyendo productos
+    4. El navegador lo recibe como descarga
     
     Ventajas del CSV:
     - Compatible con todos los programas de hojas de cálculo
     - Formato ligero y rápido
     - Fácil de procesar por otros sistemas
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Obtener todos los productos ordenados por nombre
-    cursor.execute("SELECT * FROM products ORDER BY name")
-    products = cursor.fetchall()
-    conn.close()
-    
-    # Crear archivo CSV en memoria usando StringIO
-    # StringIO permite trabajar con texto como si fuera un archivo
-    output = io.StringIO()
-    writer = csv.writer(output)  # Objeto para escribir CSV
-    
-    # Escribir fila de encabezados (nombres de columnas)
-    writer.writerow(['ID', 'Nombre', 'Categoría', 'Cantidad', 'Precio', 'Proveedor', 'Stock Mínimo', 'Fecha de Creación'])
-    
-    # Escribir datos de cada producto
-    for product in products:
-        writer.writerow([
-            product['id'],
-            product['name'],
-            product['category'],
-            product['quantity'],
-            product['price'],
-            product['provider'],
-            product['stock_min'],
-            product['created_at']
-        ])
-    
-    # Volver al inicio del archivo en memoria
-    output.seek(0)
+    # La conexión se elige aquí, dentro de la petición (réplica o primario según las escrituras
+    # del usuario en su sesión); el generador la usa y la cierra mientras se envía la respuesta,
+    # cuando la vista ya terminó
+    db = get_db(readonly=True)
+
+    def product_rows():
+        with db:
+            # Productos ordenados por nombre, leídos por lotes (no todos a la vez en memoria)
+            # Las columnas del SELECT van en el orden del CSV: cada fila (una tupla simple)
+            # se escribe tal cual, sin armar una lista por producto
+            yield from db.iterate(
+                "SELECT id, name, category, quantity, price, provider, stock_min, created_at "
+                "FROM products ORDER BY name",
+                plain=True
+            )
+    
+    headers = ['ID', 'Nombre', 'Categoría', 'Cantidad', 'Precio', 'Proveedor', 'Stock Mínimo', 'Fecha de Creación']
     
     # Crear respuesta HTTP con el archivo CSV
     # Response: clase de Flask para respuestas personalizadas
+    # Con un generador como contenido, Flask envía el CSV por partes (streaming):
+    # la descarga empieza enseguida aunque el inventario sea grande
     return Response(
-        output.getvalue(),                    # Contenido del archivo
+        _csv_stream(headers, product_rows()),  # Contenido del archivo, por partes
         mimetype='text/csv',                  # Tipo de contenido
         headers={'Content-Disposition': 'attachment; filename=inventario.csv'}  # Forzar descarga
     )
 
+def _csv_stream(headers, rows, chunk_size=64 * 1024):
+    """
+    Genera un archivo CSV por partes de ~64 KB
+    
+    csv.writer convierte cada valor a texto (None queda vacío): las filas pueden ser
+    tuplas o filas de la base tal cual, sin convertirlas antes.
+    
+    Args:
+        headers (list): Fila de encabezados
+        rows (iterable): Filas de datos (se recorren una sola vez)
+    """
+    # StringIO permite trabajar con texto como si fuera un archivo (en memoria, no en disco)
+    output = io.StringIO()
+    writer = csv.writer(output)  # Objeto para escribir CSV
+    writer.writerow(headers)
+    for row in rows:
+        writer.writerow(row)
+        if output.tell() >= chunk_size:
+            # Enviar lo acumulado y vaciar el buffer
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
 @app.route("/custom_reports")
 @login_required  # Cualquier usuario puede acceder a reportes personalizados
 def custom_reports():
@@ -1219,26 +1595,88 @@ def custom_reports():
     - Prepara formulario dinámico para selección de criterios
     - No genera datos hasta que el usuario envía el formulario
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    db = get_db(readonly=True)
     
     # Obtener listas únicas para filtros dinámicos
     # DISTINCT elimina duplicados
-    cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
-    categories = [row['category'] for row in cursor.fetchall()]
-    
-    cursor.execute("SELECT DISTINCT provider FROM products ORDER BY provider")
-    providers = [row['provider'] for row in cursor.fetchall()]
+    categories = [row['category'] for row in db.query("SELECT DISTINCT category FROM products ORDER BY category")]
+    providers = [row['provider'] for row in db.query("SELECT DISTINCT provider FROM products ORDER BY provider")]
+    location_list = locations.list_locations(db)
     
-    conn.close()
+    db.close()
     
     # Renderizar formulario con listas para dropdowns
     return render_template('custom_reports.html', 
                          categories=categories, 
                          providers=providers,
+                         locations=location_list,
                          filters={})  # Sin filtros aplicados inicialmente
 
+def _stock_as_of_rows(db, as_of, category='', provider=''):
+    """
+    Filas del reporte 'stock_as_of' con los filtros de categoría y proveedor aplicados
+    
+    Args:
+        db: Conexión abierta a la base de datos (db.Database)
+        as_of (str): Fecha YYYY-MM-DD (vacía = hoy)
+        category (str): Filtro opcional de categoría
+        provider (str): Filtro opcional de proveedor
+    """
+    rows = stock_as_of(db, as_of or datetime.now().strftime('%Y-%m-%d'))
+    return [
+        row for row in rows
+        if (not category or row['category'] == category)
+        and (not provider or row['provider'] == provider)
+    ]
+
+def _report_query(db, report_type, form, export=False):
+    """
+    Consulta de un reporte personalizado según el formulario (ver query_builder.py)
+    
+    Cada tipo de reporte se describe una sola vez en query_builder.REPORTS; generar
+    y exportar usan la misma consulta (la exportación con sus propias columnas).
+    
+    Tipos de reportes disponibles:
+    - inventory_by_category: Inventario agrupado por categoría
+    - low_stock: Productos con stock bajo
+    - movements_by_period: Movimientos en un período de tiempo
+    - value_by_provider: Valor de inventario por proveedor
+    - stock_as_of: Stock de cada producto en una fecha pasada (date_to), sin consulta SQL
+    - abc_classification: Clasificación ABC por valor y velocidad (ver abc_analysis.py)
+    - general: Reporte general con filtros múltiples (cualquier otro valor)
+    
+    Args:
+        db: Conexión abierta a la base de datos (db.Database)
+        report_type (str): Tipo de reporte del formulario
+        form: Campos del formulario (request.form)
+        export (bool): Columnas de la exportación CSV
+    
+    Returns:
+        tuple: (consulta SQL o None para stock_as_of, parámetros, encabezados del CSV)
+    """
+    stock_level = form.get('stock_level', '')
+    values = {
+        'date_from': form.get('date_from', ''),
+        'date_to': form.get('date_to', ''),
+        'category': form.get('category', ''),
+        'provider': form.get('provider', ''),
+        'value_class': form.get('value_class', ''),
+        'velocity_class': form.get('velocity_class', ''),
+        'location_id': form.get('location_id', None, type=int),  # Ubicación (ver locations.py)
+        'stock_low': stock_level == 'low',
+        'stock_high': stock_level == 'high',
+    }
+    name = query_builder.report_name(report_type, values['location_id'])
+    if name is None:
+        return None, [], ['ID', 'Producto', 'Categoría', 'Proveedor', 'Cantidad']
+    source = 'inventory_movements'
+    if '{source}' in query_builder.REPORTS[name]['source'] and (values['date_from'] or values['date_to']):
+        # Solo se leen las particiones archivadas que se solapan con el rango de fechas.
+        # Sin fechas solo la tabla viva, como en el historial: no se descomprime todo el archivo
+        source = movement_source(db, values['date_from'], values['date_to'])
+    query, params = query_builder.build(name, db.dialect, values, source, export=export)
+    return query, params, query_builder.REPORTS[name]['headers']
+
 @app.route("/generate_custom_report", methods=["POST"])
 @login_required
 def generate_custom_report():
@@ -1247,7 +1685,7 @@ def generate_custom_report():
     
     Esta es una de las funciones más complejas del sistema porque:
     1. Maneja múltiples tipos de reportes diferentes
-    2. Construye consultas SQL dinámicamente según los filtros
+    2. Arma la consulta según los filtros (texto SQL canónico, ver query_builder.py)
     3. Proporciona mensajes contextuales cuando no hay resultados
     4. Mantiene el estado del formulario para facilitar ajustes
     
@@ -1256,6 +1694,8 @@ def generate_custom_report():
     - low_stock: Productos con stock bajo
     - movements_by_period: Movimientos en un período de tiempo
     - value_by_provider: Valor de inventario por proveedor
+    - stock_as_of: Stock de cada producto en una fecha pasada (date_to)
+    - abc_classification: Clasificación ABC por valor y velocidad (ver abc_analysis.py)
     - general: Reporte general con filtros múltiples
     """
     # Obtener todos los parámetros del formulario
@@ -1265,118 +1705,22 @@ def generate_custom_report():
     category = request.form.get('category', '')
     provider = request.form.get('provider', '')
     stock_level = request.form.get('stock_level', '')
-    
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # CONSTRUCCIÓN DINÁMICA DE CONSULTAS por tipo de reporte
-    # Cada tipo tiene su propia lógica SQL optimizada
-    
-    if report_type == 'inventory_by_category':
-        # Reporte: Inventario agrupado por categoría
-        query = """
-            SELECT category, 
-                   COUNT(*) as total_products, 
-                   SUM(quantity) as total_quantity, 
-                   SUM(quantity * price) as total_value
-            FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        query += " GROUP BY category ORDER BY total_value DESC"
-        
-    elif report_type == 'low_stock':
-        # Reporte: Productos con stock bajo
-        query = """
-            SELECT name, category, quantity, stock_min, provider, 
-                   (stock_min - quantity) as deficit
-            FROM products 
-            WHERE quantity <= stock_min
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        query += " ORDER BY deficit DESC"
-        
-    elif report_type == 'movements_by_period':
-        # Reporte: Movimientos de inventario en período específico
-        # Usa JOINs para obtener información relacionada
-        query = """
-            SELECT im.*, p.name as product_name, p.category, u.username
-            FROM inventory_movements im
-            JOIN products p ON im.product_id = p.id      -- Relacionar con productos
-            JOIN users u ON im.user_id = u.id            -- Relacionar con usuarios
-            WHERE 1=1
-        """
-        params = []
-        
-        if date_from:
-            query += " AND date(im.created_at) >= ?"
-            params.append(date_from)
-            
-        if date_to:
-            query += " AND date(im.created_at) <= ?"
-            params.append(date_to)
-            
-        if category:
-            query += " AND p.category = ?"
-            params.append(category)
-            
-        query += " ORDER BY im.created_at DESC"
-        
-    elif report_type == 'value_by_provider':
-        # Reporte: Valor de inventario agrupado por proveedor
-        query = """
-            SELECT provider, 
-                   COUNT(*) as total_products, 
-                   SUM(quantity) as total_quantity,
-                   SUM(quantity * price) as total_value
-            FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if provider:
-            query += " AND provider = ?"
-            params.append(provider)
-            
-        query += " GROUP BY provider ORDER BY total_value DESC"
-        
+    value_class = request.form.get('value_class', '')
+    velocity_class = request.form.get('velocity_class', '')
+    location_id = request.form.get('location_id', None, type=int)  # Ubicación (ver locations.py)
+    
+    db = get_db(readonly=True)
+    
+    # CONSULTA DEL TIPO DE REPORTE (ver _report_query)
+    query, params, _ = _report_query(db, report_type, request.form)
+    # Sin fechas, los movimientos por período no incluyen los meses archivados: la
+    # plantilla indica que hay que filtrar por fechas (igual que en el historial)
+    archived_hidden = (report_type == 'movements_by_period' and not (date_from or date_to)
+                       and bool(load_manifest()['segments']))
+    if query is None:
+        results = _stock_as_of_rows(db, date_to, category, provider)
     else:
-        # Reporte general de inventario con filtros múltiples
-        query = """
-            SELECT * FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        if provider:
-            query += " AND provider = ?"
-            params.append(provider)
-            
-        if stock_level == 'low':
-            query += " AND quantity <= stock_min"
-        elif stock_level == 'high':
-            query += " AND quantity > stock_min * 2"
-            
-        query += " ORDER BY name"
-    
-    # Ejecutar la consulta construida dinámicamente
-    cursor.execute(query, params)
-    results = cursor.fetchall()
+        results = db.query(query, params)
     
     # MANEJO DE RESULTADOS VACÍOS con mensajes contextuales
     if not results:
@@ -1397,8 +1741,15 @@ def generate_custom_report():
             
             category_text = f" en la categoría '{category}'" if category else ""
             no_results_message = f"No se encontraron movimientos de inventario{period_text}{category_text}"
+        elif report_type == 'stock_as_of':
+            no_results_message = f"No había productos en inventario al {date_to or 'día de hoy'}"
         elif report_type == 'value_by_provider':
             no_results_message = f"No se encontraron productos del proveedor '{provider}'" if provider else "No hay productos agrupados por proveedor"
+        elif report_type == 'abc_classification':
+            if value_class or velocity_class or category:
+                no_results_message = "No hay productos de esa clase ABC con los filtros seleccionados"
+            else:
+                no_results_message = "La clasificación ABC aún no se calculó (ejecuta python abc_analysis.py)"
         else:
             # Mensaje para reporte general con múltiples filtros
             filters_applied = []
@@ -1410,6 +1761,8 @@ def generate_custom_report():
                 filters_applied.append("stock bajo")
             elif stock_level == 'high':
                 filters_applied.append("stock alto")
+            if location_id:
+                filters_applied.append("la ubicación seleccionada")
             
             if filters_applied:
                 filters_text = " y ".join(filters_applied)
@@ -1420,13 +1773,11 @@ def generate_custom_report():
         flash(f'No se encontraron resultados. {no_results_message}', 'info')
     
     # Obtener listas actualizadas para mantener los dropdowns
-    cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
-    categories = [row['category'] for row in cursor.fetchall()]
-    
-    cursor.execute("SELECT DISTINCT provider FROM products ORDER BY provider")
-    providers = [row['provider'] for row in cursor.fetchall()]
+    categories = [row['category'] for row in db.query("SELECT DISTINCT category FROM products ORDER BY category")]
+    providers = [row['provider'] for row in db.query("SELECT DISTINCT provider FROM products ORDER BY provider")]
+    location_list = locations.list_locations(db)
     
-    conn.close()
+    db.close()
     
     # Renderizar template con resultados y mantener estado del formulario
     return render_template('custom_reports.html', 
@@ -1434,14 +1785,19 @@ def generate_custom_report():
                          report_type=report_type,
                          categories=categories,
                          providers=providers,
+                         locations=location_list,
                          filters={
                              'date_from': date_from,
                              'date_to': date_to,
                              'category': category,
                              'provider': provider,
-                             'stock_level': stock_level
+                             'stock_level': stock_level,
+                             'value_class': value_class,
+                             'velocity_class': velocity_class,
+                             'location_id': location_id
                          },
-                         total_results=len(results) if results else 0)
+                         total_results=len(results) if results else 0,
+                         archived_hidden=archived_hidden)
 
 @app.route("/export_custom_report", methods=["POST"])
 @login_required
@@ -1457,142 +1813,39 @@ def export_custom_report():
     1. Reutiliza la misma lógica de consultas que generate_custom_report
     2. Genera encabezados apropiados para cada tipo de reporte
     3. Crea nombre de archivo único con timestamp
-    4. Convierte todos los valores a string para compatibilidad CSV
+    4. Envía el CSV por partes mientras lee las filas (sin cargarlas todas en memoria)
     
     Ventaja: Los usuarios pueden analizar los datos en Excel o otras herramientas
     """
     # Reutilizar la lógica del reporte personalizado
     # Obtener los mismos parámetros que en generate_custom_report
+    # (los filtros los lee _report_query; aquí solo los que usa el reporte stock_as_of)
     report_type = request.form['report_type']
-    date_from = request.form.get('date_from', '')
     date_to = request.form.get('date_to', '')
     category = request.form.get('category', '')
     provider = request.form.get('provider', '')
-    stock_level = request.form.get('stock_level', '')
-    
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
     
-    # REPETIR LA MISMA LÓGICA DE CONSULTAS pero definir encabezados para CSV
-    # (código repetido para mantener la funcionalidad independiente)
-    
-    if report_type == 'inventory_by_category':
-        query = """
-            SELECT category, COUNT(*) as total_products, SUM(quantity) as total_quantity, 
-                   SUM(quantity * price) as total_value
-            FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        query += " GROUP BY category ORDER BY total_value DESC"
-        headers = ['Categoría', 'Total Productos', 'Total Cantidad', 'Valor Total']
-        
-    elif report_type == 'low_stock':
-        query = """
-            SELECT name, category, quantity, stock_min, provider, 
-                   (stock_min - quantity) as deficit
-            FROM products 
-            WHERE quantity <= stock_min
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        query += " ORDER BY deficit DESC"
-        headers = ['Producto', 'Categoría', 'Cantidad', 'Stock Mínimo', 'Proveedor', 'Déficit']
-        
-    elif report_type == 'movements_by_period':
-        query = """
-            SELECT im.created_at, p.name as product_name, p.category, im.movement_type,
-                   im.quantity_change as quantity, im.reason, u.username
-            FROM inventory_movements im
-            JOIN products p ON im.product_id = p.id
-            JOIN users u ON im.user_id = u.id
-            WHERE 1=1
-        """
-        params = []
-        
-        if date_from:
-            query += " AND date(im.created_at) >= ?"
-            params.append(date_from)
-            
-        if date_to:
-            query += " AND date(im.created_at) <= ?"
-            params.append(date_to)
-            
-        if category:
-            query += " AND p.category = ?"
-            params.append(category)
-            
-        query += " ORDER BY im.created_at DESC"
-        headers = ['Fecha', 'Producto', 'Categoría', 'Tipo', 'Cantidad', 'Motivo', 'Usuario']
-        
-    elif report_type == 'value_by_provider':
-        query = """
-            SELECT provider, COUNT(*) as total_products, SUM(quantity) as total_quantity,
-                   SUM(quantity * price) as total_value
-            FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if provider:
-            query += " AND provider = ?"
-            params.append(provider)
-            
-        query += " GROUP BY provider ORDER BY total_value DESC"
-        headers = ['Proveedor', 'Total Productos', 'Total Cantidad', 'Valor Total']
-        
+    db = get_db(readonly=True)
+    
+    # MISMA CONSULTA que generate_custom_report, con las columnas y encabezados del CSV
+    query, params, headers = _report_query(db, report_type, request.form, export=True)
+    
+    def report_rows():
+        # Como en export_csv: las filas se leen por lotes mientras se envía el archivo
+        # y la conexión se cierra al terminar (la vista ya respondió)
+        with db:
+            yield from db.iterate(query, params, plain=True)
+    
+    # GENERAR ARCHIVO CSV (por partes, ver _csv_stream)
+    # Las filas son tuplas simples y csv.writer convierte cada valor a texto
+    if query is None:
+        rows = [
+            (row['product_id'], row['name'], row['category'], row['provider'], row['quantity'])
+            for row in _stock_as_of_rows(db, date_to, category, provider)
+        ]
+        db.close()
     else:
-        # Reporte general con todos los campos principales
-        query = """
-            SELECT name, category, quantity, price, provider, stock_min, created_at
-            FROM products 
-            WHERE 1=1
-        """
-        params = []
-        
-        if category:
-            query += " AND category = ?"
-            params.append(category)
-            
-        if provider:
-            query += " AND provider = ?"
-            params.append(provider)
-            
-        if stock_level == 'low':
-            query += " AND quantity <= stock_min"
-        elif stock_level == 'high':
-            query += " AND quantity > stock_min * 2"
-            
-        query += " ORDER BY name"
-        headers = ['Producto', 'Categoría', 'Cantidad', 'Precio', 'Proveedor', 'Stock Mínimo', 'Fecha Creación']
-    
-    # Ejecutar consulta y obtener resultados
-    cursor.execute(query, params)
-    results = cursor.fetchall()
-    conn.close()
-    
-    # GENERAR ARCHIVO CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Escribir fila de encabezados
-    writer.writerow(headers)
-    
-    # Escribir datos (convertir todo a string para evitar problemas de formato)
-    for row in results:
-        writer.writerow([str(value) for value in row])
-    
-    output.seek(0)
+        rows = report_rows()
     
     # Crear nombre de archivo único con timestamp
     # Formato: reporte_tiporeporte_YYYYMMDD_HHMMSS.csv
@@ -1600,7 +1853,7 @@ def export_custom_report():
     
     # Devolver archivo como descarga
     return Response(
-        output.getvalue(),
+        _csv_stream(headers, rows),
         mimetype='text/csv',
         headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
@@ -0,0 +1,151 @@
+# Punto de entrada ASGI (uvicorn) para conexiones lentas y exportaciones largas
+#
+#   flask --app wsgi migrate                                       # una vez por despliegue
+#   uvicorn asgi:application --workers 4 --host 0.0.0.0 --port 8000
+#
+# Con gunicorn y workers síncronos cada conexión ocupa un worker completo mientras dura:
+# una exportación CSV grande hacia un cliente lento (ej: un celular en la bodega) deja al
+# worker esperando al socket, y con 4 workers bastan 4 descargas lentas para que el
+# resto de usuarios espere.
+#
+# Este módulo sirve la MISMA aplicación Flask (wsgi.py) como aplicación ASGI:
+# - La vista (Flask, síncrona) se ejecuta en un pool de hilos acotado (ASGI_THREADS):
+#   el acceso a la base sigue siendo el de db.py y las conexiones simultáneas a la base
+#   quedan acotadas por el tamaño del pool
+# - El cuerpo de la respuesta se genera por partes: cada parte (ej: los 64 KB de CSV de
+#   _csv_stream) se produce en un hilo del pool y, mientras el cliente la recibe
+#   (await send), no se ocupa ningún hilo. Una descarga lenta cuesta una corrutina, no
+#   un worker
+# - Si el cliente se desconecta a mitad de una descarga se deja de generar (y se cierra
+#   el generador, que cierra su conexión a la base)
+#
+# asgiref.wsgi.WsgiToAsgi sirve cualquier aplicación WSGI, pero mantiene un hilo ocupado
+# durante toda la respuesta (también mientras espera al cliente); por eso este adaptador
+# propio, que suelta el hilo entre partes.
+#
+# Las conexiones SQLite se abren con check_same_thread=False (database.py): las partes
+# de una misma descarga se generan en hilos distintos del pool, aunque nunca en dos a la vez.
+#
+# Comparación con el modo síncrono: la misma prueba de carga contra cada servidor
+# (ver scripts/load_test.py, opciones --slow-downloads y --compare).
+import io
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from wsgi import app
+
+# Hilos para las vistas y para generar las partes de las respuestas
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '16'))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+
+def _environ(scope, body):
+    """Entorno WSGI (PEP 3333) equivalente a una petición HTTP de ASGI"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        # Cabeceras repetidas: se unen con comas, como hacen los servidores WSGI
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def _wait_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def _http(scope, receive, send):
+    body = await _read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    response = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+        # write() de WSGI (en desuso): lo escrito se envía antes del cuerpo
+        return written.append
+
+    iterable = await loop.run_in_executor(executor, app, _environ(scope, body), start_response)
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(_wait_disconnect(receive, disconnected))
+    try:
+        iterator = iter(iterable)
+        # Algunas aplicaciones llaman a start_response al generar la primera parte
+        chunk = await loop.run_in_executor(executor, next, iterator, None)
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': response['headers']})
+        for data in written:
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        while chunk is not None and not disconnected.is_set():
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        watcher.cancel()
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(executor, close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """Aplicación ASGI: peticiones HTTP y ciclo de vida del servidor (websockets no)"""
+    if scope['type'] == 'http':
+        await _http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
@@ -0,0 +1,308 @@
+# Copias de seguridad en línea de la base SQLite (sin detener la aplicación)
+#
+# Copiar data/inventory.db con cp mientras la aplicación escribe puede dejar una copia
+# rota (la mitad de las páginas de antes de una transacción y la mitad de después). La
+# API de backup de SQLite copia página a página y garantiza una copia consistente:
+#
+# 1. COPIA POR PASOS: se copian BACKUP_PAGES páginas por paso y se espera BACKUP_PAUSE
+#    segundos entre pasos. Cada paso toma un bloqueo de lectura breve y lo suelta al
+#    terminar, así las escrituras (ajustes de stock, escaneos) siguen entrando durante la
+#    copia en lugar de esperar a que termine
+# 2. Si otra conexión escribe durante la copia, SQLite la reinicia para que siga siendo
+#    consistente. Con mucha escritura podría no terminar nunca: tras BACKUP_MAX_RESTARTS
+#    reinicios se abandona el intento, se espera (BACKUP_RETRY_DELAY, el doble en cada
+#    intento) y se vuelve a copiar por pasos, cada vez con pasos más grandes (menos pasos
+#    = menos ocasiones de reinicio) hasta BACKUP_MAX_STEP_PAGES páginas. Tras
+#    BACKUP_ATTEMPTS intentos falla con BackupError. Nunca se copia toda la base en un
+#    solo paso: la base usa el journal clásico (no WAL) y ese bloqueo de lectura, que dura
+#    lo que tarde copiar la base entera, frenaría todas las escrituras; con el límite de
+#    páginas, cada paso bloquea como mucho lo que se tarda en copiar 64 MB
+# 3. VERIFICACIÓN: PRAGMA integrity_check sobre la copia antes de darla por buena
+# 4. COMPRESIÓN Y ROTACIÓN: la copia se guarda con gzip en BACKUP_DIR con la fecha en el
+#    nombre (inventory-AAAAMMDD-HHMMSS.db.gz) y se conservan las BACKUP_KEEP más recientes
+#
+# La misma copia sirve de réplica de lectura (ver replica.py): si REPLICA_PATH está
+# configurado, la copia sin comprimir reemplaza a la réplica en lugar de borrarse.
+# Cada copia es también el estado completo de la base en su fecha (productos, precios,
+# movimientos): "extract" la descomprime para consultarla con DATABASE_PATH.
+#
+#     python backup.py create                     # cron, ej: cada hora
+#     python backup.py list
+#     python backup.py verify data/backups/inventory-20250101-030000.db.gz
+#     python backup.py extract data/backups/inventory-20250101-030000.db.gz data/asof.db
+#     python backup.py restore data/backups/inventory-20250101-030000.db.gz --yes
+import os
+import glob
+import gzip
+import time
+import shutil
+import sqlite3
+from datetime import datetime
+
+import database
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'data/backups')
+# Copias comprimidas que se conservan
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', '24'))
+# Páginas copiadas por paso (4 KB cada una) y pausa entre pasos en segundos
+BACKUP_PAGES = int(os.environ.get('BACKUP_PAGES', '1024'))
+BACKUP_PAUSE = float(os.environ.get('BACKUP_PAUSE', '0.02'))
+# Reinicios por escrituras concurrentes antes de abandonar un intento
+BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', '5'))
+# Intentos de copia por pasos y espera antes del segundo (se duplica en cada intento)
+BACKUP_ATTEMPTS = int(os.environ.get('BACKUP_ATTEMPTS', '4'))
+BACKUP_RETRY_DELAY = float(os.environ.get('BACKUP_RETRY_DELAY', '5'))
+# Páginas por paso en los reintentos: se multiplican por 4 en cada intento hasta este límite
+BACKUP_MAX_STEP_PAGES = int(os.environ.get('BACKUP_MAX_STEP_PAGES', '16384'))
+
+BACKUP_PREFIX = 'inventory-'
+BACKUP_SUFFIX = '.db.gz'
+
+
+class BackupError(RuntimeError):
+    """La copia por pasos no pudo terminar (demasiadas escrituras concurrentes)"""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def online_backup(target_path, source_path=None, pages=BACKUP_PAGES, pause=BACKUP_PAUSE,
+                  max_restarts=BACKUP_MAX_RESTARTS, attempts=BACKUP_ATTEMPTS, retry_delay=BACKUP_RETRY_DELAY,
+                  max_step_pages=BACKUP_MAX_STEP_PAGES):
+    """
+    Copia consistente de la base SQLite en target_path, por pasos y sin bloquear escrituras
+
+    Returns:
+        dict: Pasos, reinicios, intentos y segundos
+
+    Raises:
+        BackupError: Si ningún intento terminó antes de max_restarts reinicios
+    """
+    state = {'steps': 0, 'restarts': 0, 'attempts': 0, 'remaining': None}
+    attempt_restarts = 0
+
+    def progress(status, remaining, total):
+        nonlocal attempt_restarts
+        state['steps'] += 1
+        # Si no quedan menos páginas que en el paso anterior, otra conexión escribió y
+        # SQLite reinició la copia desde el principio
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            attempt_restarts += 1
+            if attempt_restarts > max_restarts:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        if remaining:
+            # Entre pasos no hay ningún bloqueo tomado: las escrituras pasan
+            time.sleep(pause)
+
+    started = time.perf_counter()
+    source = sqlite3.connect(source_path or database.DB_NAME)
+    try:
+        while True:
+            state['attempts'] += 1
+            state['remaining'] = None
+            attempt_restarts = 0
+            # pages=-1 (restore) copia todo de una vez a propósito
+            step_pages = pages if pages <= 0 else max(pages, min(pages * 4 ** (state['attempts'] - 1), max_step_pages))
+            # Una conexión de destino por intento: la copia interrumpida deja la anterior
+            # con su transacción a medias
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=step_pages, progress=progress)
+                break
+            except _TooManyRestarts:
+                if state['attempts'] >= attempts:
+                    raise BackupError(f"La copia no terminó tras {state['attempts']} intentos "
+                                      f"({state['restarts']} reinicios por escrituras concurrentes)")
+            finally:
+                target.close()
+            # Esperar a que baje la escritura antes de volver a empezar
+            time.sleep(retry_delay * 2 ** (state['attempts'] - 1))
+    finally:
+        source.close()
+    state['seconds'] = round(time.perf_counter() - started, 3)
+    del state['remaining']
+    return state
+
+
+def _integrity(path):
+    """Resultado de PRAGMA integrity_check ('ok' si la base está sana)"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return '; '.join(row[0] for row in conn.execute("PRAGMA integrity_check"))
+    finally:
+        conn.close()
+
+
+def _compress(source_path, target_path):
+    temporary = f"{target_path}.tmp"
+    with open(source_path, 'rb') as source, gzip.open(temporary, 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(temporary, target_path)
+
+
+def extract(snapshot_path, target_path):
+    """Descomprime una copia en target_path (archivo temporal + os.replace)"""
+    temporary = f"{target_path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(snapshot_path, 'rb') as source, open(temporary, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(temporary, target_path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def list_snapshots(backup_dir=BACKUP_DIR):
+    """Copias comprimidas de la más reciente a la más antigua"""
+    return sorted(glob.glob(os.path.join(backup_dir, f"{BACKUP_PREFIX}*{BACKUP_SUFFIX}")), reverse=True)
+
+
+def rotate(keep=BACKUP_KEEP, backup_dir=BACKUP_DIR):
+    """Borra las copias más antiguas y deja las `keep` más recientes (0 = conservar todas)"""
+    removed = list_snapshots(backup_dir)[keep:] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def create_snapshot(keep=BACKUP_KEEP, backup_dir=BACKUP_DIR, replica_path=None):
+    """
+    Copia en línea, verificada, comprimida y rotada
+
+    Args:
+        replica_path: Si se indica, la copia sin comprimir pasa a ser la réplica de lectura
+
+    Returns:
+        dict: Ruta de la copia, tamaños, datos de la copia por pasos y copias borradas
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.time()
+    name = f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    temporary = os.path.join(backup_dir, f"{name}.db.{os.getpid()}.tmp")
+    try:
+        summary = online_backup(temporary)
+        integrity = _integrity(temporary)
+        if integrity != 'ok':
+            raise RuntimeError(f"La copia no pasó integrity_check: {integrity}")
+        path = os.path.join(backup_dir, name + BACKUP_SUFFIX)
+        _compress(temporary, path)
+        summary.update(path=path, size=os.path.getsize(temporary), compressed_size=os.path.getsize(path))
+        if replica_path:
+            # Misma convención que replica.refresh(): la fecha del archivo es la de sus datos
+            os.utime(temporary, (started, started))
+            os.replace(temporary, replica_path)
+            summary['replica'] = replica_path
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    summary['removed'] = rotate(keep, backup_dir)
+    return summary
+
+
+def verify(snapshot_path):
+    """
+    Descomprime una copia en un archivo temporal y la revisa
+
+    Returns:
+        dict: integrity ('ok' si está sana), versión del esquema, productos y movimientos
+    """
+    temporary = f"{snapshot_path}.{os.getpid()}.verify"
+    try:
+        try:
+            extract(snapshot_path, temporary)
+        except (OSError, EOFError) as e:
+            # Archivo gzip dañado o truncado
+            return {'integrity': f"no se pudo descomprimir: {e}"}
+        result = {'integrity': _integrity(temporary)}
+        if result['integrity'] == 'ok':
+            conn = sqlite3.connect(f"file:{temporary}?mode=ro", uri=True)
+            try:
+                result['schema_version'] = conn.execute("SELECT version FROM schema_version").fetchone()[0]
+                result['products'] = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+                result['movements'] = conn.execute("SELECT COUNT(*) FROM inventory_movements").fetchone()[0]
+            finally:
+                conn.close()
+        return result
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def restore(snapshot_path, target_path=None):
+    """
+    Reemplaza el contenido de la base por el de una copia verificada
+
+    Se restaura con la misma API de backup (de la copia hacia la base) en lugar de
+    sobrescribir el archivo: SQLite toma el bloqueo de escritura y las conexiones
+    abiertas ven la base restaurada completa, nunca un archivo a medio copiar.
+    Conviene detener la aplicación antes: las escrituras posteriores a la copia se pierden.
+    """
+    target_path = target_path or database.DB_NAME
+    temporary = f"{snapshot_path}.{os.getpid()}.restore"
+    try:
+        extract(snapshot_path, temporary)
+        integrity = _integrity(temporary)
+        if integrity != 'ok':
+            raise RuntimeError(f"La copia no pasó integrity_check: {integrity}")
+        online_backup(target_path, source_path=temporary, pages=-1)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from replica import REPLICA_PATH
+
+    parser = argparse.ArgumentParser(description="Copias de seguridad en línea de la base SQLite")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    create_parser = subparsers.add_parser('create', help="Crea una copia verificada y comprimida")
+    create_parser.add_argument('--keep', type=int, default=BACKUP_KEEP,
+                               help="Copias a conservar (0 = todas, por defecto %(default)s)")
+    subparsers.add_parser('list', help="Lista las copias")
+    verify_parser = subparsers.add_parser('verify', help="Revisa la integridad de una copia")
+    verify_parser.add_argument('snapshot')
+    extract_parser = subparsers.add_parser('extract', help="Descomprime una copia para consultarla")
+    extract_parser.add_argument('snapshot')
+    extract_parser.add_argument('target')
+    restore_parser = subparsers.add_parser('restore', help="Restaura la base desde una copia")
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('--yes', action='store_true', help="Confirmar (reemplaza los datos actuales)")
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        try:
+            summary = create_snapshot(keep=args.keep, replica_path=REPLICA_PATH or None)
+        except BackupError as e:
+            print(f"Copia NO creada: {e}")
+            sys.exit(1)
+        print(f"Copia creada: {summary['path']} ({summary['size'] / 1048576:.1f} MB -> "
+              f"{summary['compressed_size'] / 1048576:.1f} MB) en {summary['seconds']}s, "
+              f"{summary['steps']} pasos, {summary['restarts']} reinicios, {summary['attempts']} intento(s)")
+        if summary.get('replica'):
+            print(f"Réplica de lectura actualizada: {summary['replica']}")
+        for path in summary['removed']:
+            print(f"Copia antigua borrada: {path}")
+    elif args.command == 'list':
+        for path in list_snapshots():
+            print(f"{os.path.getsize(path) / 1048576:>8.1f} MB  {path}")
+    elif args.command == 'verify':
+        result = verify(args.snapshot)
+        if result['integrity'] != 'ok':
+            print(f"Copia DAÑADA: {result['integrity']}")
+            sys.exit(1)
+        print(f"Copia correcta: esquema v{result['schema_version']}, {result['products']} productos, "
+              f"{result['movements']} movimientos")
+    elif args.command == 'extract':
+        extract(args.snapshot, args.target)
+        print(f"Copia descomprimida en {args.target}")
+    else:
+        if not args.yes:
+            print("La restauración reemplaza todos los datos actuales: repetir con --yes")
+            sys.exit(1)
+        restore(args.snapshot)
+        print(f"Base restaurada desde {args.snapshot}")
@@ -0,0 +1,261 @@
+# Compresión de respuestas HTTP (gzip / brotli)
+#
+# Las páginas de reportes, el historial de movimientos, las exportaciones CSV y los
+# datos de gráficos (|tojson) son texto muy repetitivo: comprimidos ocupan entre 5 y 10
+# veces menos. En las tablets del almacén con Wi-Fi lento la diferencia se nota.
+#
+# CompressionMiddleware envuelve la aplicación WSGI (app.wsgi_app) y:
+# - Negocia la codificación con la cabecera Accept-Encoding del navegador (br > gzip)
+# - Solo comprime tipos de texto (HTML, CSV, JSON, CSS, JS) y cuerpos de al menos
+#   COMPRESSION_MIN_SIZE bytes: en respuestas chicas la cabecera gzip no compensa
+# - Funciona con respuestas en streaming (generadores, ej: export_csv): comprime cada
+#   parte a medida que se genera, sin esperar el cuerpo completo
+# - Guarda las variantes comprimidas de las respuestas con ETag (archivos estáticos,
+#   respuestas de la API): la siguiente petición del mismo recurso no vuelve a comprimir
+#
+# Brotli comprime más que gzip pero es opcional (pip install brotli): si no está
+# instalado solo se ofrece gzip.
+import os
+import zlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+# Nivel de gzip (1-9) y calidad de brotli (0-11) para respuestas dinámicas
+GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '5'))
+# Tamaño máximo de la caché de variantes comprimidas (bytes, por proceso)
+COMPRESSION_CACHE_BYTES = int(os.environ.get('COMPRESSION_CACHE_BYTES', str(32 * 1024 * 1024)))
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'image/svg+xml')
+
+# En streaming se acumula al menos esto antes de emitir una parte comprimida:
+# comprimir partes muy chicas por separado empeora la compresión
+STREAM_FLUSH_SIZE = 16 * 1024
+
+
+def negotiate(accept_encoding):
+    """
+    Elige la codificación según Accept-Encoding ('br', 'gzip' o None)
+
+    Respeta los valores q (ej: "gzip;q=0" rechaza gzip). Ante empate se prefiere br.
+    """
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    candidates = ['br', 'gzip'] if brotli else ['gzip']
+    best, best_quality = None, 0.0
+    for name in candidates:
+        quality = accepted.get(name, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+class _Compressor:
+    """Interfaz común para gzip y brotli: compress(parte) y finish()"""
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY if level is None else level)
+        else:
+            # wbits=31: formato gzip (cabecera + CRC), no zlib "crudo"
+            self._compressor = zlib.compressobj(GZIP_LEVEL if level is None else level, zlib.DEFLATED, 31)
+
+    def compress(self, data, flush=False):
+        if self.encoding == 'br':
+            output = self._compressor.process(data)
+            return output + self._compressor.flush() if flush else output
+        output = self._compressor.compress(data)
+        # Z_SYNC_FLUSH: lo comprimido hasta aquí se puede descomprimir ya en el navegador
+        return output + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else output
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def compress_bytes(data, encoding, level=None):
+    compressor = _Compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+class CompressedVariantCache:
+    """Variantes comprimidas por (ruta, ETag, codificación), con límite total en bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes // 4:
+            return  # Una sola variante no debe desplazar a toda la caché
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+variants = CompressedVariantCache(COMPRESSION_CACHE_BYTES)
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _should_compress(status, headers):
+    if not status.startswith('200'):
+        return False
+    if _header(headers, 'Content-Encoding'):
+        return False
+    content_type = (_header(headers, 'Content-Type') or '').lower()
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return False
+    if 'no-transform' in (_header(headers, 'Cache-Control') or '').lower():
+        return False
+    length = _header(headers, 'Content-Length')
+    if length is not None and int(length) < COMPRESSION_MIN_SIZE:
+        return False
+    return True
+
+
+def _compressed_headers(headers, encoding, length=None):
+    """Cabeceras de la respuesta comprimida"""
+    result = []
+    vary = None
+    for key, value in headers:
+        lower = key.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'vary':
+            vary = value
+            continue
+        if lower == 'etag' and not value.startswith('W/'):
+            # El cuerpo comprimido no es idéntico byte a byte: ETag débil
+            # (If-None-Match usa comparación débil, así los 304 siguen funcionando)
+            value = 'W/' + value
+        result.append((key, value))
+    result.append(('Content-Encoding', encoding))
+    result.append(('Vary', f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'))
+    if length is not None:
+        result.append(('Content-Length', str(length)))
+    return result
+
+
+class CompressionMiddleware:
+    """Middleware WSGI de compresión (ver explicación al inicio del módulo)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        encoding = None
+        if environ.get('REQUEST_METHOD') != 'HEAD' and not environ.get('HTTP_RANGE'):
+            encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        captured = {}
+
+        def write(data):
+            # Interfaz write() de WSGI (obsoleta): Flask nunca la usa
+            raise RuntimeError("CompressionMiddleware no admite write()")
+
+        def capture_start_response(status, headers, exc_info=None):
+            # Se guarda el estado y las cabeceras para decidir si comprimir antes de enviarlos
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return write
+
+        app_iter = self.app(environ, capture_start_response)
+        status, headers = captured['status'], captured['headers']
+        if not _should_compress(status, headers):
+            start_response(status, headers, captured['exc_info'])
+            return app_iter
+
+        if _header(headers, 'Content-Length') is None:
+            # Respuesta en streaming: se comprime parte por parte
+            start_response(status, _compressed_headers(headers, encoding), captured['exc_info'])
+            return self._stream(app_iter, encoding)
+
+        etag = _header(headers, 'ETag')
+        key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, encoding) if etag else None
+        body = variants.get(key) if key else None
+        if body is None:
+            try:
+                data = b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            if key:
+                # Se comprime una sola vez: vale la pena el nivel máximo
+                body = compress_bytes(data, encoding, level=11 if encoding == 'br' else 9)
+                variants.set(key, body)
+            else:
+                body = compress_bytes(data, encoding)
+        elif hasattr(app_iter, 'close'):
+            app_iter.close()
+        start_response(status, _compressed_headers(headers, encoding, len(body)), captured['exc_info'])
+        return [body]
+
+    @staticmethod
+    def _stream(app_iter, encoding):
+        compressor = _Compressor(encoding)
+        pending = 0
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                pending += len(chunk)
+                flush = pending >= STREAM_FLUSH_SIZE
+                output = compressor.compress(chunk, flush=flush)
+                if flush:
+                    pending = 0
+                if output:
+                    yield output
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def init_app(app):
+    """Envuelve la aplicación WSGI con el middleware de compresión"""
+    if COMPRESSION_ENABLED:
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app)
@@ -34,7 +34,8 @@ try:
             DB_NAME = None  # Se configurará completamente en la conexión
     else:
         # En desarrollo o pruebas, usa la ubicación predeterminada
-        DB_NAME = "data/inventory.db"
+        # (DATABASE_PATH permite apuntar a otra base, ej: la de benchmarks en scripts/)
+        DB_NAME = os.environ.get('DATABASE_PATH', 'data/inventory.db')
 except Exception:
     # Configuración de emergencia si hay algún error
     DB_NAME = "data/inventory.db"
@@ -59,7 +60,7 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 # Función para obtener una conexión a la base de datos
-def get_db_connection():
+def get_db_connection(**sqlite_options):
     """
     Crea una conexión a la base de datos según la configuración del entorno.
     Soporta SQLite (desarrollo/local) y PostgreSQL/MySQL (producción/nube)
@@ -67,6 +68,10 @@ def get_db_connection():
     Esta función incluye manejo de errores para garantizar que siempre
     retorne una conexión funcional, incluso en caso de fallas.
     
+    Args:
+        **sqlite_options: Opciones extra de sqlite3.connect para la base SQLite
+            configurada (ej: factory y cached_statements, ver el pool de db.py)
+    
     Returns:
         connection: Objeto de conexión a la base de datos
         is_sqlite: Boolean indicando si es conexión SQLite
@@ -113,7 +118,9 @@ def get_db_connection():
         # Si llegamos aquí, usamos SQLite (el modo predeterminado y más seguro)
         # Asegurar que el directorio existe
         os.makedirs(os.path.dirname(DB_NAME), exist_ok=True)
-        conn = sqlite3.connect(DB_NAME)
+        # check_same_thread=False: en modo ASGI (asgi.py) las partes de una exportación se
+        # generan en distintos hilos del pool; una conexión nunca se usa en dos hilos a la vez
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False, **sqlite_options)
         return conn, True
         
     except Exception as e:
@@ -126,12 +133,140 @@ def get_db_connection():
             if not os.path.exists('data'):
                 os.makedirs('data')
             
-            conn = sqlite3.connect("data/inventory.db")
+            conn = sqlite3.connect("data/inventory.db", check_same_thread=False)
             return conn, True
         except Exception as final_error:
             # Si incluso esto falla, es un error terminal
             raise RuntimeError(f"Error crítico de base de datos: {str(final_error)}")
 
+# Versión del esquema que deja init_db()
+# Subir este número cada vez que init_db() agregue tablas, columnas, índices o migraciones:
+# así cada proceso detecta con una sola consulta si la base necesita migrarse,
+# sin repetir todos los CREATE TABLE / ALTER TABLE en cada arranque
+SCHEMA_VERSION = 9
+
+def get_schema_version(db):
+    """
+    Versión del esquema registrada en la base (0 si nunca se migró con versión)
+    
+    Args:
+        db: Database abierta (ver db.py)
+    """
+    try:
+        return db.scalar("SELECT version FROM schema_version") or 0
+    except Exception:
+        # La tabla no existe: base nueva o creada antes del control de versiones
+        # (PostgreSQL deja la transacción abortada tras el error: hay que deshacerla)
+        db.rollback()
+        return 0
+
+def ensure_schema():
+    """
+    Migra la base solo si su versión es anterior a SCHEMA_VERSION
+    
+    Con la base al día cuesta una consulta, por eso se puede llamar al atender
+    la primera petición de cada proceso.
+    
+    Returns:
+        bool: True si se ejecutó init_db()
+    """
+    from db import Database
+    conn, _ = get_db_connection()
+    with Database(conn) as db:
+        current = get_schema_version(db)
+    if current >= SCHEMA_VERSION:
+        return False
+    init_db()
+    return True
+
+# Definición de la tabla de movimientos de inventario
+# Se usa tanto para crearla como para reconstruirla en migraciones
+# (SQLite no permite cambiar las restricciones de una columna existente)
+MOVEMENTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,     -- ID único del movimiento
+    product_id INTEGER NOT NULL,              -- ID del producto afectado
+    product_name TEXT,                        -- Nombre histórico (solo en eliminaciones; el resto usa product_dim)
+    movement_type TEXT NOT NULL CHECK(movement_type IN ('entrada', 'salida', 'ajuste', 'creacion', 'eliminacion', 'transferencia')),
+    -- Tipos de movimiento:
+    -- 'entrada': se agregó stock, 'salida': se redujo stock
+    -- 'ajuste': corrección manual, 'creacion': nuevo producto, 'eliminacion': producto eliminado
+    -- 'transferencia': una de las dos partes de un traslado entre ubicaciones (el total no cambia)
+    quantity_before INTEGER NOT NULL,         -- Cantidad total antes del movimiento
+    quantity_after INTEGER NOT NULL,          -- Cantidad total después del movimiento
+    quantity_change INTEGER NOT NULL,         -- Diferencia (quantity_after - quantity_before)
+    location_id INTEGER,                      -- Ubicación afectada (ver locations.py)
+    location_delta INTEGER,                   -- Diferencia en esa ubicación (en una transferencia, ±unidades)
+    reason TEXT,                              -- Razón del movimiento (opcional)
+    user_id INTEGER NOT NULL,                 -- ID del usuario que hizo el cambio
+    username TEXT NOT NULL,                   -- Nombre del usuario (para historiales)
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Momento exacto del movimiento
+    FOREIGN KEY (product_id) REFERENCES products(id),  -- Relación con tabla products
+    FOREIGN KEY (user_id) REFERENCES users(id)         -- Relación con tabla users
+    -- FOREIGN KEY: garantiza que product_id y user_id existan en sus tablas respectivas
+);
+"""
+
+def _migrate_movements_product_name(db):
+    """
+    Migración: product_name deja de repetirse en cada movimiento
+
+    Antes cada movimiento guardaba el nombre del producto como texto, por lo que
+    un producto renombrado quedaba partido en varios grupos en los reportes.
+    Ahora los movimientos se agrupan por product_id y el nombre se toma de
+    product_dim; el texto solo se conserva en los movimientos de eliminación.
+
+    Pasos (solo si la columna todavía es NOT NULL):
+    1. Registrar en deleted_products el último nombre de los productos que ya no existen
+    2. Reconstruir la tabla con product_name opcional (SQLite no tiene ALTER COLUMN)
+    3. Vaciar product_name en los movimientos que no son eliminaciones
+
+    Solo aplica a bases SQLite: en PostgreSQL/MySQL la tabla se crea directamente
+    con el esquema actual.
+    """
+    columns = {row[1]: row for row in db.query("PRAGMA table_info(inventory_movements)")}
+    # row[3] es la bandera notnull de la columna
+    if 'product_name' not in columns or not columns['product_name'][3]:
+        return
+
+    print("Migrando inventory_movements: product_name pasa a ser opcional")
+    db.execute("""
+        INSERT OR IGNORE INTO deleted_products (product_id, name, deleted_at)
+        SELECT im.product_id, im.product_name, im.created_at
+        FROM inventory_movements im
+        WHERE im.product_id NOT IN (SELECT id FROM products)
+          AND im.id = (SELECT MAX(id) FROM inventory_movements last WHERE last.product_id = im.product_id)
+    """)
+
+    column_list = ', '.join(columns)
+    db.execute(MOVEMENTS_TABLE_SQL.format(table='inventory_movements_new'))
+    db.execute(f"INSERT INTO inventory_movements_new ({column_list}) SELECT {column_list} FROM inventory_movements")
+    db.execute("DROP TABLE inventory_movements")
+    db.execute("ALTER TABLE inventory_movements_new RENAME TO inventory_movements")
+    db.execute("UPDATE inventory_movements SET product_name = NULL WHERE movement_type != 'eliminacion'")
+
+def _migrate_movements_locations(db):
+    """
+    Migración: movimientos por ubicación y tipo 'transferencia'
+
+    SQLite no permite cambiar un CHECK ni agregarlo con ALTER TABLE: si la tabla todavía
+    no tiene location_id se reconstruye con el esquema actual (MOVEMENTS_TABLE_SQL). Los
+    índices y triggers de la tabla se vuelven a crear más adelante en init_db().
+
+    Solo aplica a bases SQLite: en PostgreSQL/MySQL la tabla se crea directamente
+    con el esquema actual.
+    """
+    columns = [row[1] for row in db.query("PRAGMA table_info(inventory_movements)")]
+    if 'location_id' in columns:
+        return
+
+    print("Migrando inventory_movements: movimientos por ubicación y transferencias")
+    column_list = ', '.join(columns)
+    db.execute(MOVEMENTS_TABLE_SQL.format(table='inventory_movements_new'))
+    db.execute(f"INSERT INTO inventory_movements_new ({column_list}) SELECT {column_list} FROM inventory_movements")
+    db.execute("DROP TABLE inventory_movements")
+    db.execute("ALTER TABLE inventory_movements_new RENAME TO inventory_movements")
+
 def init_db(): 
     """
     Función principal para inicializar la base de datos
@@ -140,9 +275,11 @@ def init_db():
     - SQLite (desarrollo local): Crea un archivo en disco
     - PostgreSQL/MySQL (entorno de producción): Conecta a servidor de BD existente
     
-    La estructura de tablas es adaptada según el motor de base de datos.
+    La estructura de tablas es adaptada según el motor de base de datos:
+    las sentencias se escriben para SQLite y db.py las traduce (dialect.ddl)
     
-    Esta función se ejecuta al inicio de la aplicación y se encarga de:
+    Se ejecuta con el comando "flask --app wsgi migrate" (o automáticamente en la
+    primera petición si la base no está en SCHEMA_VERSION, ver ensure_schema) y se encarga de:
     1. Crear el directorio 'data' si no existe
     2. Crear las tablas necesarias si no existen
     3. Aplicar migraciones (cambios en la estructura de la BD)
@@ -154,14 +291,20 @@ def init_db():
     # exist_ok=True evita error si el directorio ya existe
     os.makedirs("data", exist_ok=True)
 
-    # Establecer conexión con la base de datos SQLite
+    # Importación local: db.py a su vez importa get_db_connection de este módulo
+    from db import Database
+    import stock_alerts
+    import locations
+
+    # Establecer conexión con la base de datos configurada
     # Si el archivo no existe, SQLite lo crea automáticamente
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()  # Cursor: objeto para ejecutar comandos SQL
+    conn, is_sqlite = get_db_connection()
+    db = Database(conn)
+    ddl = db.dialect.ddl  # Adapta AUTOINCREMENT, REAL, etc. al motor en uso
 
     # Crear tabla 'products' si no existe
     # CREATE TABLE IF NOT EXISTS: solo crea la tabla si no existe previamente
-    cursor.execute("""
+    db.execute(ddl("""
     CREATE TABLE IF NOT EXISTS products (
         id INTEGER PRIMARY KEY AUTOINCREMENT,  -- Clave primaria que se incrementa automáticamente
         name TEXT NOT NULL,                    -- Nombre del producto (obligatorio)
@@ -173,36 +316,24 @@ def init_db():
         stock_min INTEGER DEFAULT 0,          -- Cantidad mínima antes de considerar "stock bajo"
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Fecha de creación automática
     )
-                   """)
+                   """))
     
     # MIGRACIÓN: Agregar columna SKU si no existe
     # Las migraciones permiten actualizar la estructura de BD sin perder datos
-    try:
+    # (solo bases SQLite antiguas: en otros motores la tabla ya se crea con sku)
+    if is_sqlite and 'sku' not in [row[1] for row in db.query("PRAGMA table_info(products)")]:
         # ALTER TABLE: comando SQL para modificar estructura de tabla existente
-        cursor.execute("ALTER TABLE products ADD COLUMN sku TEXT")
+        db.execute("ALTER TABLE products ADD COLUMN sku TEXT")
         print("Columna SKU agregada a la tabla products")
-    except sqlite3.OperationalError as e:
-        # Manejar el caso donde la columna ya existe
-        if "duplicate column name" in str(e).lower():
-            # La columna ya existe, no hacer nada
-            pass
-        else:
-            # Otro tipo de error, mostrar información
-            print(f"Error al agregar columna SKU: {e}")
     
     # Crear índice único para SKU
     # ÍNDICE: estructura que acelera las búsquedas en la base de datos
     # ÚNICO: no permite valores duplicados
     # WHERE sku IS NOT NULL: solo aplica a registros que tienen SKU
-    try:
-        cursor.execute("CREATE UNIQUE INDEX idx_sku_unique ON products(sku) WHERE sku IS NOT NULL")
-        print("Índice único creado para SKU")
-    except sqlite3.OperationalError:
-        # El índice ya existe, ignorar error
-        pass
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sku_unique ON products(sku) WHERE sku IS NOT NULL")
     
     # Crear tabla de usuarios para autenticación y autorización
-    cursor.execute("""
+    db.execute(ddl("""
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,     -- ID único para cada usuario
     username TEXT UNIQUE NOT NULL,            -- Nombre de usuario (único y obligatorio)
@@ -211,36 +342,263 @@ CREATE TABLE IF NOT EXISTS users (
     -- CHECK: constraint que valida que el rol sea uno de los valores permitidos
     -- admin: control total, editor: puede modificar inventario, viewer: solo lectura
 );
-""")
+"""))
 
     # Crear tabla para registrar movimientos de inventario
     # Esta tabla funciona como un "log" o historial de todos los cambios
-    cursor.execute("""
-CREATE TABLE IF NOT EXISTS inventory_movements (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,     -- ID único del movimiento
-    product_id INTEGER NOT NULL,              -- ID del producto afectado
-    product_name TEXT NOT NULL,               -- Nombre del producto (para historiales)
-    movement_type TEXT NOT NULL CHECK(movement_type IN ('entrada', 'salida', 'ajuste', 'creacion', 'eliminacion')),
-    -- Tipos de movimiento:
-    -- 'entrada': se agregó stock, 'salida': se redujo stock
-    -- 'ajuste': corrección manual, 'creacion': nuevo producto, 'eliminacion': producto eliminado
-    quantity_before INTEGER NOT NULL,         -- Cantidad antes del movimiento
-    quantity_after INTEGER NOT NULL,          -- Cantidad después del movimiento
-    quantity_change INTEGER NOT NULL,         -- Diferencia (quantity_after - quantity_before)
-    reason TEXT,                              -- Razón del movimiento (opcional)
-    user_id INTEGER NOT NULL,                 -- ID del usuario que hizo el cambio
-    username TEXT NOT NULL,                   -- Nombre del usuario (para historiales)
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- Momento exacto del movimiento
-    FOREIGN KEY (product_id) REFERENCES products(id),  -- Relación con tabla products
-    FOREIGN KEY (user_id) REFERENCES users(id)         -- Relación con tabla users
-    -- FOREIGN KEY: garantiza que product_id y user_id existan en sus tablas respectivas
+    db.execute(ddl(MOVEMENTS_TABLE_SQL.format(table='inventory_movements')))
+
+    # Productos eliminados: conservan su último nombre para los reportes históricos
+    # Junto con products forma la "dimensión" de nombres (vista product_dim)
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS deleted_products (
+    product_id INTEGER PRIMARY KEY,           -- ID que tenía el producto
+    name TEXT NOT NULL,                       -- Último nombre conocido
+    category TEXT,                            -- Última categoría conocida
+    deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""))
+
+    # MIGRACIÓN: product_name pasó de obligatorio a opcional
+    # (ahora solo se guarda como foto histórica en los movimientos de eliminación)
+    if is_sqlite:
+        _migrate_movements_product_name(db)
+        # MIGRACIÓN: columnas de ubicación y tipo 'transferencia' (ver locations.py)
+        _migrate_movements_locations(db)
+    # Vista con el nombre vigente de cada producto, exista o haya sido eliminado
+    # Los reportes agrupan movimientos por product_id y toman el nombre de aquí,
+    # así un producto renombrado no aparece partido en dos
+    db.execute(db.dialect.create_view('product_dim', """
+    SELECT id AS product_id, name, category FROM products
+    UNION ALL
+    SELECT product_id, name, category FROM deleted_products
+"""))
+
+    # Índice por fecha: el historial, los reportes por período y el archivado
+    # (movement_archive.py) filtran y ordenan por created_at
+    db.execute("CREATE INDEX IF NOT EXISTS idx_movements_created_at ON inventory_movements(created_at)")
+    # Índice por producto que además cubre quantity_change: los totales por producto
+    # (productos más movidos) se calculan leyendo solo el índice
+    db.execute("CREATE INDEX IF NOT EXISTS idx_movements_product ON inventory_movements(product_id, quantity_change)")
+    # Índice por ubicación: el historial filtrado por ubicación se resuelve igual que el general
+    db.execute("CREATE INDEX IF NOT EXISTS idx_movements_location ON inventory_movements(location_id, created_at)")
+
+    # Totales por producto y mes de los movimientos ya archivados en segmentos comprimidos
+    # Permite calcular reportes agregados sin descomprimir los segmentos
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS movement_archive_rollups (
+    month TEXT NOT NULL,                      -- Mes archivado (YYYY-MM)
+    product_id INTEGER NOT NULL,              -- ID del producto (el nombre sale de product_dim)
+    movement_count INTEGER NOT NULL,          -- Número de movimientos del mes
+    total_moved INTEGER NOT NULL,             -- Unidades movidas (valor absoluto)
+    PRIMARY KEY (month, product_id)
+);
+"""))
+    # MIGRACIÓN: los totales archivados se agrupaban también por nombre de producto
+    if is_sqlite and 'product_name' in [row[1] for row in db.query("PRAGMA table_info(movement_archive_rollups)")]:
+        db.execute("ALTER TABLE movement_archive_rollups RENAME TO movement_archive_rollups_old")
+        db.execute("""
+CREATE TABLE movement_archive_rollups (
+    month TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    movement_count INTEGER NOT NULL,
+    total_moved INTEGER NOT NULL,
+    PRIMARY KEY (month, product_id)
 );
 """)
+        db.execute("""
+            INSERT INTO movement_archive_rollups (month, product_id, movement_count, total_moved)
+            SELECT month, product_id, SUM(movement_count), SUM(total_moved)
+            FROM movement_archive_rollups_old
+            GROUP BY month, product_id
+        """)
+        db.execute("DROP TABLE movement_archive_rollups_old")
+
+    # Progreso del volcado de cada archivo del spool de movimientos (ver movement_spool.py)
+    # Se actualiza en la misma transacción que cada lote: al reintentar no se duplican filas
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS movement_spool_checkpoints (
+    segment TEXT PRIMARY KEY,                 -- Nombre del archivo del spool
+    lines_applied INTEGER NOT NULL,           -- Líneas ya insertadas en inventory_movements
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""))
+
+    # Fotos periódicas del stock completo (ver stock_history.py)
+    # Permiten responder "¿cuánto stock había el día X?" sin recorrer todo el historial
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS stock_snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,     -- ID de la foto
+    taken_at TIMESTAMP NOT NULL,              -- Momento en que se tomó
+    last_movement_id INTEGER NOT NULL,        -- Último movimiento ya reflejado en la foto
+    product_count INTEGER NOT NULL            -- Productos incluidos
+);
+"""))
+    db.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_taken_at ON stock_snapshots(taken_at)")
+    # WITHOUT ROWID: la clave primaria es el propio almacenamiento, más compacto para esta tabla
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS stock_snapshot_items (
+    snapshot_id INTEGER NOT NULL,             -- Foto a la que pertenece
+    product_id INTEGER NOT NULL,              -- Producto
+    quantity INTEGER NOT NULL,                -- Cantidad en el momento de la foto
+    PRIMARY KEY (snapshot_id, product_id)
+) WITHOUT ROWID;
+"""))
+
+    # Tokens de la API para integraciones (ver api.py)
+    # Solo se guarda el hash SHA-256 del token: el valor se muestra una vez al crearlo
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS api_tokens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,                       -- Integración que lo usa (ej: "POS tienda 1")
+    token_hash TEXT UNIQUE NOT NULL,          -- SHA-256 del token
+    role TEXT NOT NULL CHECK(role IN ('editor', 'viewer')),  -- viewer: lectura, editor: también escaneos
+    user_id INTEGER,                          -- Usuario a nombre del cual se registran los movimientos
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    revoked_at TIMESTAMP,                     -- NULL mientras el token es válido
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+"""))
+    # Bases creadas con la versión 3 (tokens sin usuario)
+    if is_sqlite and 'user_id' not in [row[1] for row in db.query("PRAGMA table_info(api_tokens)")]:
+        db.execute("ALTER TABLE api_tokens ADD COLUMN user_id INTEGER REFERENCES users(id)")
+
+    # Ubicaciones (almacenes, sucursales) y stock de cada producto en cada una (ver locations.py)
+    # products.quantity es el total; stock_levels, el reparto por ubicación
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,     -- La primera (id 1) es la ubicación principal
+    name TEXT UNIQUE NOT NULL,                -- Nombre de la ubicación
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""))
+    if db.scalar("SELECT COUNT(*) FROM locations") == 0:
+        db.execute("INSERT INTO locations (name) VALUES (?)", (locations.MAIN_LOCATION_NAME,))
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS stock_levels (
+    product_id INTEGER NOT NULL,              -- Producto
+    location_id INTEGER NOT NULL,             -- Ubicación
+    quantity INTEGER NOT NULL DEFAULT 0 CHECK(quantity >= 0),
+    PRIMARY KEY (product_id, location_id)     -- Stock de un producto: búsqueda por clave
+);
+"""))
+    # Productos de una ubicación con su cantidad, leyendo solo el índice
+    db.execute("CREATE INDEX IF NOT EXISTS idx_stock_levels_location ON stock_levels(location_id, product_id, quantity)")
+    for statement in db.dialect.location_triggers(locations.MAIN_LOCATION_ID):
+        db.execute(statement)
+    # Stock inicial en la ubicación principal (y corrección de productos cargados sin los triggers)
+    locations.reconcile_all(db)
+    # Movimientos anteriores a las ubicaciones: ocurrieron en la principal
+    db.execute("""
+        UPDATE inventory_movements SET location_id = ?, location_delta = quantity_change
+        WHERE location_id IS NULL
+    """, (locations.MAIN_LOCATION_ID,))
+
+    # Generación de los datos: un contador que sube con cada cambio en las tablas que se
+    # muestran en pantalla. La caché de fragmentos de plantillas (template_cache.py) lo usa
+    # como parte de la clave: si la generación no cambió, el fragmento guardado sigue vigente.
+    # Lo incrementan triggers de la base, así cuenta cualquier escritura (rutas, spool de
+    # movimientos, archivado, scripts) sin tener que acordarse de hacerlo en el código.
+    # En PostgreSQL el contador es la secuencia data_generation_seq (ver db.py), que crean
+    # los mismos triggers; la tabla queda sin uso.
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS data_generation (
+    generation INTEGER NOT NULL               -- Sube en cada INSERT/UPDATE/DELETE vigilado
+);
+"""))
+    if db.scalar("SELECT COUNT(*) FROM data_generation") == 0:
+        db.execute("INSERT INTO data_generation (generation) VALUES (1)")
+    for table in ('products', 'inventory_movements', 'deleted_products', 'movement_archive_rollups',
+                  'locations', 'stock_levels'):
+        for statement in db.dialect.generation_triggers(table):
+            db.execute(statement)
+
+    # Estado de alerta de stock de cada producto (ver stock_alerts.py)
+    # Lo mantienen triggers sobre products: solo se evalúa la fila que cambió
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS stock_alerts (
+    product_id INTEGER PRIMARY KEY,           -- Producto (una fila por producto)
+    state TEXT NOT NULL CHECK(state IN ('normal', 'warning', 'critical')),
+    previous_state TEXT,                      -- Estado anterior (NULL si nunca cambió)
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Cuándo pasó al estado actual
+);
+"""))
+    # Índice por estado: las páginas solo buscan los productos en alerta
+    db.execute("CREATE INDEX IF NOT EXISTS idx_stock_alerts_state ON stock_alerts(state, changed_at)")
+    # Bandeja de salida de notificaciones (ver notifications.py): los triggers de
+    # stock_alerts agregan una fila por cada cambio de estado, en la misma transacción
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_id INTEGER NOT NULL,              -- Producto que cambió de estado
+    state TEXT NOT NULL,                      -- Estado nuevo (normal/warning/critical)
+    previous_state TEXT,                      -- Estado anterior (NULL en productos nuevos)
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'sent', 'skipped', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,      -- Intentos de envío fallidos
+    last_error TEXT,                          -- Último error de envío
+    delivered_at TIMESTAMP                    -- Cuándo se envió (o se descartó)
+);
+"""))
+    # El despachador busca las pendientes y los últimos avisos enviados de cada producto
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_status ON notification_outbox(status, id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_product ON notification_outbox(product_id, status)")
+    for statement in db.dialect.alert_triggers(stock_alerts.state_sql('NEW.'), stock_alerts.state_sql('OLD.')):
+        db.execute(statement)
+    # Estado inicial (y corrección de productos cargados sin los triggers)
+    stock_alerts.reevaluate_all(db)
+
+    # Punto de reorden sugerido por producto (ver forecasting.py)
+    # Lo reemplaza completo la tarea programada; la página de reportes solo lo lee
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS reorder_suggestions (
+    product_id INTEGER PRIMARY KEY,           -- Producto
+    avg_daily_demand REAL NOT NULL,           -- Promedio móvil de salidas por día
+    forecast_daily_demand REAL NOT NULL,      -- Suavizado exponencial de salidas por día
+    demand_std REAL NOT NULL,                 -- Desviación de la demanda diaria
+    safety_stock INTEGER NOT NULL,            -- Stock de seguridad
+    reorder_point INTEGER NOT NULL,           -- Stock mínimo sugerido
+    lead_time_days REAL NOT NULL,             -- Días de reposición usados en el cálculo
+    service_level REAL NOT NULL,              -- Nivel de servicio usado en el cálculo
+    computed_at TIMESTAMP NOT NULL            -- Cuándo se calculó (UTC)
+);
+"""))
+
+    # Clasificación ABC por valor y por velocidad de cada producto (ver abc_analysis.py)
+    # La actualiza la tarea programada, reescribiendo solo las filas que cambiaron
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS abc_classification (
+    product_id INTEGER PRIMARY KEY,           -- Producto
+    stock_value REAL NOT NULL,                -- quantity * price
+    value_share REAL NOT NULL,                -- Parte acumulada del valor total (0-1)
+    value_class TEXT NOT NULL CHECK(value_class IN ('A', 'B', 'C')),
+    units_moved REAL NOT NULL,                -- Salidas en la ventana de velocidad
+    velocity_share REAL NOT NULL,             -- Parte acumulada de las salidas (0-1)
+    velocity_class TEXT NOT NULL CHECK(velocity_class IN ('A', 'B', 'C')),
+    computed_at TIMESTAMP NOT NULL            -- Cuándo cambió la fila por última vez (UTC)
+);
+"""))
+    db.execute("CREATE INDEX IF NOT EXISTS idx_abc_value_class ON abc_classification(value_class)")
+    # Último cálculo ABC: una sola fila con la generación de los datos que se usaron
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS abc_runs (
+    generation INTEGER NOT NULL,              -- Generación de data_generation al calcular
+    computed_at TIMESTAMP NOT NULL            -- Cuándo se calculó (UTC)
+);
+"""))
+
+    # Versión del esquema: una sola fila, reemplazada en cada migración (ver SCHEMA_VERSION)
+    db.execute(ddl("""
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER NOT NULL                  -- Última versión aplicada por init_db()
+);
+"""))
+    db.execute("DELETE FROM schema_version")
+    db.execute("INSERT INTO schema_version (version) VALUES (?)", (SCHEMA_VERSION,))
 
     # Insertar usuarios de prueba solo si la tabla está vacía
     # Esto permite tener usuarios predeterminados para probar la aplicación
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]  # fetchone() devuelve tupla, [0] toma el primer valor
+    user_count = db.scalar("SELECT COUNT(*) FROM users")  # Primer valor de la primera fila
     
     if user_count == 0:
         # Solo crear usuarios si no existen (primera vez que se ejecuta)
@@ -256,7 +614,7 @@ CREATE TABLE IF NOT EXISTS inventory_movements (
         
         # executemany: ejecuta la misma consulta con múltiples conjuntos de datos
         # Más eficiente que hacer múltiples execute() individuales
-        cursor.executemany(
+        db.executemany(
             "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
             test_users
         )
@@ -268,8 +626,8 @@ CREATE TABLE IF NOT EXISTS inventory_movements (
 
     # Confirmar todos los cambios en la base de datos
     # commit(): hace permanentes todas las operaciones pendientes
-    conn.commit()
+    db.commit()
     
     # Cerrar la conexión para liberar recursos
     # Importante: siempre cerrar conexiones cuando termines
-    conn.close()
\ No newline at end of file
+    db.close()
\ No newline at end of file
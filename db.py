@@ -0,0 +1,783 @@
+# Capa de consultas independiente del motor de base de datos
+#
+# get_db_connection() (database.py) puede devolver una conexión SQLite, PostgreSQL
+# (psycopg2) o MySQL (pymysql), pero cada motor habla un "dialecto" distinto de SQL:
+# - Marcadores de parámetros: SQLite usa ?, psycopg2/pymysql usan %s
+# - Fechas: date('now', '-30 days') solo existe en SQLite
+# - Filas: sqlite3.Row permite row['columna']; los otros drivers devuelven tuplas
+# - IDs generados: SQLite/MySQL usan lastrowid, PostgreSQL necesita RETURNING
+#
+# Esta capa es deliberadamente delgada: las consultas se siguen escribiendo en SQL
+# (con ? como marcador), y la clase Database se encarga de traducir lo necesario.
+# Las expresiones que cambian según el motor se piden al dialecto:
+#
+#     db = get_db()
+#     rows = db.query(f"SELECT * FROM products WHERE {db.dialect.to_date('created_at')} >= "
+#                     f"{db.dialect.days_ago(30)} AND category = ?", (category,))
+#     db.close()
+#
+# Conexiones SQLite reutilizables: abrir la base en cada petición cuesta más que la
+# consulta típica y deja vacía la caché de sentencias compiladas de la conexión (sqlite3
+# guarda hasta cached_statements sentencias por conexión, buscadas por su texto exacto).
+# Database.close() devuelve la conexión a un pool de DB_POOL_SIZE conexiones por proceso
+# y la siguiente petición la reutiliza con sus sentencias ya compiladas. Solo se reutilizan
+# conexiones a la base SQLite principal (no la réplica, que se reemplaza por archivo,
+# ni PostgreSQL/MySQL, que tienen sus propios poolers).
+import os
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask import g, has_request_context
+
+from database import get_db_connection
+from instrumentation import record_query
+import metrics
+import replica
+
+# Conexiones SQLite que se conservan abiertas para reutilizar (0 = una nueva por petición)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+# Sentencias compiladas que SQLite guarda por conexión (por defecto sqlite3 guarda 128;
+# los textos canónicos de query_builder.py más las consultas fijas de la aplicación
+# superan esa cifra)
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', '256'))
+
+
+@lru_cache(maxsize=1024)
+def _to_format_paramstyle(sql):
+    """
+    Traduce marcadores ? a %s (estilo de psycopg2 y pymysql)
+
+    - Los ? dentro de literales de texto ('...') no se tocan
+    - Los % existentes se duplican (%%): estos drivers usan % para formatear
+      la consulta y un % suelto (ej: en DATE_FORMAT) rompería la ejecución
+
+    El resultado se cachea: las consultas de la aplicación son textos fijos.
+    """
+    output = []
+    in_string = False
+    for char in sql:
+        if char == "'":
+            in_string = not in_string
+            output.append(char)
+        elif char == '%':
+            output.append('%%')
+        elif char == '?' and not in_string:
+            output.append('%s')
+        else:
+            output.append(char)
+    return ''.join(output)
+
+
+class SQLiteDialect:
+    """Dialecto de SQLite (el motor por defecto, y el "idioma" en que se escriben las consultas)"""
+    name = 'sqlite'
+
+    # Sentencia para empezar una transacción de escritura que ve datos consistentes
+    # BEGIN IMMEDIATE toma el bloqueo de escritura desde el principio
+    begin_write = "BEGIN IMMEDIATE"
+
+    # Operador de búsqueda de texto sin distinguir mayúsculas (LIKE ya lo hace en SQLite)
+    like = "LIKE"
+
+    # Lectura de la generación de los datos (ver current_generation) y, si hace falta,
+    # sentencia que la incrementa después de cada commit con escrituras (ver Database.commit)
+    generation_query = "SELECT generation FROM data_generation"
+    bump_generation = None
+
+    def translate(self, sql):
+        return sql
+
+    def days_ago(self, days):
+        """Expresión SQL para la fecha de hace N días"""
+        return f"date('now', '-{int(days)} days')"
+
+    def to_date(self, expr):
+        """Expresión SQL que extrae la fecha (sin hora) de un timestamp"""
+        return f"date({expr})"
+
+    def month_key(self, expr):
+        """Expresión SQL con el mes 'YYYY-MM' de un timestamp"""
+        return f"substr({expr}, 1, 7)"
+
+    def ddl(self, sql):
+        """Adapta un CREATE TABLE escrito para SQLite a este motor"""
+        return sql
+
+    def create_view(self, name, select):
+        return f"CREATE VIEW IF NOT EXISTS {name} AS {select}"
+
+    def generation_triggers(self, table):
+        """
+        Sentencias que crean los triggers que incrementan data_generation
+        cuando cambian las filas de la tabla (ver template_cache.py)
+        """
+        return [
+            f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{operation.lower()}_generation
+                AFTER {operation} ON {table}
+                BEGIN UPDATE data_generation SET generation = generation + 1; END"""
+            for operation in ('INSERT', 'UPDATE', 'DELETE')
+        ]
+
+    def alert_triggers(self, new_state, old_state):
+        """
+        Sentencias que crean los triggers que mantienen stock_alerts (ver stock_alerts.py)
+        y que dejan cada cambio de estado en notification_outbox (ver notifications.py)
+
+        Se borran y se vuelven a crear en cada migración: así una versión nueva del
+        esquema reemplaza los triggers de la anterior.
+
+        Args:
+            new_state, old_state: Expresión SQL del estado con las columnas NEW. y OLD.
+        """
+        upsert = f"""INSERT INTO stock_alerts (product_id, state, previous_state, changed_at)
+                     VALUES (NEW.id, {new_state}, {{previous}}, CURRENT_TIMESTAMP)
+                     ON CONFLICT(product_id) DO UPDATE SET previous_state = excluded.previous_state,
+                         state = excluded.state, changed_at = excluded.changed_at"""
+        return [
+            "DROP TRIGGER IF EXISTS trg_products_insert_alert",
+            f"""CREATE TRIGGER trg_products_insert_alert AFTER INSERT ON products
+                BEGIN
+                    {upsert.format(previous='NULL')};
+                    -- Un producto nuevo solo se notifica si ya nace en alerta
+                    INSERT INTO notification_outbox (product_id, state, previous_state)
+                    SELECT NEW.id, {new_state}, NULL WHERE {new_state} <> 'normal';
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_update_alert",
+            # Solo cuando cambian las columnas del umbral y el estado resultante es otro
+            f"""CREATE TRIGGER trg_products_update_alert
+                AFTER UPDATE OF quantity, stock_min ON products
+                WHEN {new_state} <> {old_state}
+                BEGIN
+                    {upsert.format(previous=old_state)};
+                    INSERT INTO notification_outbox (product_id, state, previous_state)
+                    VALUES (NEW.id, {new_state}, {old_state});
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_delete_alert",
+            """CREATE TRIGGER trg_products_delete_alert AFTER DELETE ON products
+               BEGIN DELETE FROM stock_alerts WHERE product_id = OLD.id; END""",
+        ]
+
+    def location_triggers(self, main_location):
+        """
+        Sentencias que crean los triggers que mantienen stock_levels (ver locations.py)
+
+        products.quantity es el total del producto y stock_levels el reparto por ubicación.
+        Un producto nuevo nace con todo su stock en la ubicación principal, y cuando un
+        UPDATE cambia el total sin pasar por stock_levels (edición, scripts) la diferencia
+        va a la ubicación principal. Si el total ya coincide con la suma de las ubicaciones
+        (locations.adjust las actualiza a las dos) el trigger no hace nada.
+
+        Args:
+            main_location (int): id de la ubicación principal
+        """
+        total = "(SELECT COALESCE(SUM(quantity), 0) FROM stock_levels WHERE product_id = NEW.id)"
+        return [
+            "DROP TRIGGER IF EXISTS trg_products_insert_location",
+            f"""CREATE TRIGGER trg_products_insert_location AFTER INSERT ON products
+                BEGIN
+                    INSERT INTO stock_levels (product_id, location_id, quantity)
+                    VALUES (NEW.id, {int(main_location)}, NEW.quantity);
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_update_location",
+            f"""CREATE TRIGGER trg_products_update_location
+                AFTER UPDATE OF quantity ON products
+                WHEN NEW.quantity <> {total}
+                BEGIN
+                    INSERT INTO stock_levels (product_id, location_id, quantity)
+                    VALUES (NEW.id, {int(main_location)}, 0)
+                    ON CONFLICT(product_id, location_id) DO NOTHING;
+                    UPDATE stock_levels SET quantity = quantity + NEW.quantity - {total}
+                    WHERE product_id = NEW.id AND location_id = {int(main_location)};
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_delete_location",
+            """CREATE TRIGGER trg_products_delete_location AFTER DELETE ON products
+               BEGIN DELETE FROM stock_levels WHERE product_id = OLD.id; END""",
+        ]
+
+
+class PostgreSQLDialect(SQLiteDialect):
+    """Dialecto de PostgreSQL"""
+    name = 'postgresql'
+    # Debe ser la primera sentencia de la transacción (psycopg2 la abre automáticamente)
+    begin_write = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+    like = "ILIKE"  # En PostgreSQL, LIKE distingue mayúsculas
+
+    # La generación es una secuencia: nextval no toma bloqueos ni forma parte de la
+    # transacción, así dos escrituras concurrentes no chocan (con una fila data_generation,
+    # en REPEATABLE READ la segunda fallaría con serialization_failure, 40001).
+    # Como nextval es visible antes del commit, Database.commit vuelve a incrementarla al
+    # terminar: una lectura que vio el número nuevo con los datos viejos queda con una
+    # generación vencida y no deja ese fragmento en caché como vigente.
+    generation_query = "SELECT last_value FROM data_generation_seq"
+    bump_generation = "SELECT nextval('data_generation_seq')"
+
+    def translate(self, sql):
+        return _to_format_paramstyle(sql)
+
+    def days_ago(self, days):
+        return f"(CURRENT_DATE - INTERVAL '{int(days)} days')"
+
+    def to_date(self, expr):
+        return f"CAST({expr} AS DATE)"
+
+    def month_key(self, expr):
+        return f"to_char({expr}, 'YYYY-MM')"
+
+    def ddl(self, sql):
+        """
+        Adapta un CREATE TABLE escrito para SQLite a PostgreSQL
+
+        - INTEGER PRIMARY KEY AUTOINCREMENT -> SERIAL PRIMARY KEY
+        - REAL (4 bytes en PostgreSQL) -> DOUBLE PRECISION, como el REAL de SQLite
+        - Sin WITHOUT ROWID (concepto propio de SQLite)
+        - Sin FOREIGN KEY: SQLite nunca las aplicó (PRAGMA foreign_keys desactivado)
+          y el historial conserva movimientos de productos y usuarios eliminados
+        """
+        sql = re.sub(r'INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY', sql, flags=re.I)
+        sql = re.sub(r'\bREAL\b', 'DOUBLE PRECISION', sql)
+        sql = re.sub(r',(\s*--[^\n]*)?\s*FOREIGN KEY \(\w+\) REFERENCES \w+\(\w+\)',
+                     lambda match: match.group(1) or '', sql)
+        return re.sub(r'\)\s*WITHOUT ROWID', ')', sql, flags=re.I)
+
+    def create_view(self, name, select):
+        return f"CREATE OR REPLACE VIEW {name} AS {select}"
+
+    def generation_triggers(self, table):
+        # Un trigger por sentencia (no por fila): una carga masiva incrementa una sola vez
+        return [
+            "CREATE SEQUENCE IF NOT EXISTS data_generation_seq",
+            """CREATE OR REPLACE FUNCTION bump_data_generation() RETURNS trigger AS $$
+               BEGIN PERFORM nextval('data_generation_seq'); RETURN NULL; END;
+               $$ LANGUAGE plpgsql""",
+            f"DROP TRIGGER IF EXISTS trg_{table}_generation ON {table}",
+            f"""CREATE TRIGGER trg_{table}_generation AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_data_generation()""",
+        ]
+
+    def alert_triggers(self, new_state, old_state):
+        return [
+            f"""CREATE OR REPLACE FUNCTION refresh_stock_alert() RETURNS trigger AS $$
+               DECLARE new_state TEXT; old_state TEXT;
+               BEGIN
+                   IF TG_OP = 'DELETE' THEN
+                       DELETE FROM stock_alerts WHERE product_id = OLD.id;
+                       RETURN NULL;
+                   END IF;
+                   new_state := {new_state};
+                   IF TG_OP = 'UPDATE' THEN
+                       old_state := {old_state};
+                       IF new_state = old_state THEN RETURN NULL; END IF;
+                   END IF;
+                   INSERT INTO stock_alerts (product_id, state, previous_state, changed_at)
+                   VALUES (NEW.id, new_state, old_state, CURRENT_TIMESTAMP)
+                   ON CONFLICT (product_id) DO UPDATE SET previous_state = EXCLUDED.previous_state,
+                       state = EXCLUDED.state, changed_at = EXCLUDED.changed_at;
+                   IF TG_OP = 'UPDATE' OR new_state <> 'normal' THEN
+                       INSERT INTO notification_outbox (product_id, state, previous_state)
+                       VALUES (NEW.id, new_state, old_state);
+                   END IF;
+                   RETURN NULL;
+               END;
+               $$ LANGUAGE plpgsql""",
+            "DROP TRIGGER IF EXISTS trg_products_alert ON products",
+            """CREATE TRIGGER trg_products_alert
+               AFTER INSERT OR DELETE OR UPDATE OF quantity, stock_min ON products
+               FOR EACH ROW EXECUTE FUNCTION refresh_stock_alert()""",
+        ]
+
+    def location_triggers(self, main_location):
+        return [
+            f"""CREATE OR REPLACE FUNCTION sync_stock_levels() RETURNS trigger AS $$
+               DECLARE levels_total INTEGER;
+               BEGIN
+                   IF TG_OP = 'DELETE' THEN
+                       DELETE FROM stock_levels WHERE product_id = OLD.id;
+                   ELSIF TG_OP = 'INSERT' THEN
+                       INSERT INTO stock_levels (product_id, location_id, quantity)
+                       VALUES (NEW.id, {int(main_location)}, NEW.quantity);
+                   ELSE
+                       SELECT COALESCE(SUM(quantity), 0) INTO levels_total
+                       FROM stock_levels WHERE product_id = NEW.id;
+                       IF NEW.quantity <> levels_total THEN
+                           INSERT INTO stock_levels (product_id, location_id, quantity)
+                           VALUES (NEW.id, {int(main_location)}, NEW.quantity - levels_total)
+                           ON CONFLICT (product_id, location_id)
+                           DO UPDATE SET quantity = stock_levels.quantity + EXCLUDED.quantity;
+                       END IF;
+                   END IF;
+                   RETURN NULL;
+               END;
+               $$ LANGUAGE plpgsql""",
+            "DROP TRIGGER IF EXISTS trg_products_location ON products",
+            """CREATE TRIGGER trg_products_location
+               AFTER INSERT OR DELETE OR UPDATE OF quantity ON products
+               FOR EACH ROW EXECUTE FUNCTION sync_stock_levels()""",
+        ]
+
+
+class MySQLDialect(PostgreSQLDialect):
+    """Dialecto de MySQL"""
+    name = 'mysql'
+    begin_write = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+    like = "LIKE"  # Con la collation por defecto no distingue mayúsculas
+    # Sin secuencias: la generación es la fila de data_generation, como en SQLite
+    generation_query = SQLiteDialect.generation_query
+    bump_generation = None
+
+    def days_ago(self, days):
+        return f"(CURDATE() - INTERVAL {int(days)} DAY)"
+
+    def to_date(self, expr):
+        return f"DATE({expr})"
+
+    def month_key(self, expr):
+        return f"DATE_FORMAT({expr}, '%Y-%m')"
+
+    def generation_triggers(self, table):
+        return [
+            f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_{operation.lower()}_generation
+                AFTER {operation} ON {table}
+                FOR EACH ROW UPDATE data_generation SET generation = generation + 1"""
+            for operation in ('INSERT', 'UPDATE', 'DELETE')
+        ]
+
+    def alert_triggers(self, new_state, old_state):
+        upsert = f"""INSERT INTO stock_alerts (product_id, state, previous_state, changed_at)
+                     VALUES (NEW.id, {new_state}, {{previous}}, CURRENT_TIMESTAMP)
+                     ON DUPLICATE KEY UPDATE previous_state = VALUES(previous_state),
+                         state = VALUES(state), changed_at = VALUES(changed_at)"""
+        outbox = f"""INSERT INTO notification_outbox (product_id, state, previous_state)
+                     VALUES (NEW.id, {new_state}, {{previous}})"""
+        return [
+            "DROP TRIGGER IF EXISTS trg_products_insert_alert",
+            f"""CREATE TRIGGER trg_products_insert_alert AFTER INSERT ON products
+                FOR EACH ROW BEGIN
+                    {upsert.format(previous='NULL')};
+                    IF {new_state} <> 'normal' THEN {outbox.format(previous='NULL')}; END IF;
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_update_alert",
+            # MySQL no tiene UPDATE OF ni WHEN: la condición va dentro del cuerpo
+            f"""CREATE TRIGGER trg_products_update_alert AFTER UPDATE ON products
+                FOR EACH ROW BEGIN
+                    IF {new_state} <> {old_state} THEN
+                        {upsert.format(previous=old_state)};
+                        {outbox.format(previous=old_state)};
+                    END IF;
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_delete_alert",
+            """CREATE TRIGGER trg_products_delete_alert AFTER DELETE ON products
+               FOR EACH ROW DELETE FROM stock_alerts WHERE product_id = OLD.id""",
+        ]
+
+    def location_triggers(self, main_location):
+        # Sin UPDATE OF ni WHEN: la comparación con la suma va dentro del cuerpo
+        return [
+            "DROP TRIGGER IF EXISTS trg_products_insert_location",
+            f"""CREATE TRIGGER trg_products_insert_location AFTER INSERT ON products
+                FOR EACH ROW INSERT INTO stock_levels (product_id, location_id, quantity)
+                VALUES (NEW.id, {int(main_location)}, NEW.quantity)""",
+            "DROP TRIGGER IF EXISTS trg_products_update_location",
+            f"""CREATE TRIGGER trg_products_update_location AFTER UPDATE ON products
+                FOR EACH ROW BEGIN
+                    DECLARE levels_total INTEGER;
+                    SELECT COALESCE(SUM(quantity), 0) INTO levels_total
+                    FROM stock_levels WHERE product_id = NEW.id;
+                    IF NEW.quantity <> levels_total THEN
+                        INSERT INTO stock_levels (product_id, location_id, quantity)
+                        VALUES (NEW.id, {int(main_location)}, NEW.quantity - levels_total)
+                        ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity);
+                    END IF;
+                END""",
+            "DROP TRIGGER IF EXISTS trg_products_delete_location",
+            """CREATE TRIGGER trg_products_delete_location AFTER DELETE ON products
+               FOR EACH ROW DELETE FROM stock_levels WHERE product_id = OLD.id""",
+        ]
+
+    def ddl(self, sql):
+        sql = re.sub(r'AUTOINCREMENT', 'AUTO_INCREMENT', sql, flags=re.I)
+        sql = re.sub(r',(\s*--[^\n]*)?\s*FOREIGN KEY \(\w+\) REFERENCES \w+\(\w+\)',
+                     lambda match: match.group(1) or '', sql)
+        return re.sub(r'\)\s*WITHOUT ROWID', ')', sql, flags=re.I)
+
+
+DIALECTS = {
+    'sqlite': SQLiteDialect(),
+    'postgresql': PostgreSQLDialect(),
+    'mysql': MySQLDialect(),
+}
+
+
+def dialect_for(conn):
+    """Detecta el dialecto según el módulo del driver que creó la conexión"""
+    module = type(conn).__module__
+    if module.startswith('psycopg2'):
+        return DIALECTS['postgresql']
+    if module.startswith('pymysql'):
+        return DIALECTS['mysql']
+    return DIALECTS['sqlite']
+
+
+@lru_cache(maxsize=256)
+def _row_class(columns):
+    """
+    Crea (una sola vez por combinación de columnas) una clase de fila
+    que se comporta como sqlite3.Row: row[0], row['columna'], dict(row)
+    """
+    index = {name: position for position, name in enumerate(columns)}
+
+    class DictRow(tuple):
+        __slots__ = ()
+        _index = index
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                key = self._index[key]
+            return tuple.__getitem__(self, key)
+
+        def keys(self):
+            return list(self._index)
+
+    return DictRow
+
+
+# Aciertos de las cachés de traducción y de clases de fila (ver /metrics)
+metrics.register_lru_cache('sql_translate', _to_format_paramstyle)
+metrics.register_lru_cache('row_class', _row_class)
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Conexión SQLite que puede volver al pool al cerrarse (ver Database.close)
+
+    sqlite3 no publica los aciertos de su caché de sentencias: se lleva la cuenta de los
+    textos recientes con la misma política (LRU de SQLITE_CACHED_STATEMENTS textos) y
+    se publican como cache="sqlite_statements" en /metrics.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = OrderedDict()
+
+    def note_statement(self, sql):
+        if sql in self.statements:
+            self.statements.move_to_end(sql)
+            metrics.CACHE_HITS.inc(cache='sqlite_statements')
+        else:
+            self.statements[sql] = True
+            if len(self.statements) > SQLITE_CACHED_STATEMENTS:
+                self.statements.popitem(last=False)
+            metrics.CACHE_MISSES.inc(cache='sqlite_statements')
+
+
+_pool = []
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+
+
+def _pooled_connection():
+    """Conexión del pool (la usada más recientemente) o una nueva si está vacío"""
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # Proceso hijo (workers de gunicorn): las conexiones del padre no se comparten
+            _pool.clear()
+            _pool_pid = os.getpid()
+        conn = _pool.pop() if _pool else None
+    if conn is not None:
+        metrics.CACHE_HITS.inc(cache='db_pool')
+        return conn
+    metrics.CACHE_MISSES.inc(cache='db_pool')
+    conn, _ = get_db_connection(factory=PooledConnection, cached_statements=SQLITE_CACHED_STATEMENTS)
+    return conn
+
+
+def _release(conn):
+    """Devuelve la conexión al pool si es reutilizable y hay lugar (True si se guardó)"""
+    if not isinstance(conn, PooledConnection) or DB_POOL_SIZE <= 0:
+        return False
+    if conn.in_transaction:
+        # Lo que no se confirmó se descarta, igual que al cerrar la conexión
+        conn.rollback()
+    with _pool_lock:
+        if _pool_pid == os.getpid() and len(_pool) < DB_POOL_SIZE:
+            _pool.append(conn)
+            return True
+    return False
+
+
+# Conexión ya cerrada que reemplaza a la devuelta al pool: usar un Database cerrado
+# falla como antes ("Cannot operate on a closed database") en lugar de usar una
+# conexión que ya tiene otra petición
+_CLOSED = sqlite3.connect(':memory:')
+_CLOSED.close()
+
+
+def _integrity_error(dialect_name):
+    """Clase de excepción de violación de restricciones (UNIQUE, CHECK...) del driver"""
+    if dialect_name == 'postgresql':
+        import psycopg2
+        return psycopg2.IntegrityError
+    if dialect_name == 'mysql':
+        import pymysql
+        return pymysql.err.IntegrityError
+    return sqlite3.IntegrityError
+
+
+def is_lock_error(exc):
+    """
+    Indica si una excepción se debe a un bloqueo de la base (escrituras concurrentes)
+
+    - SQLite: OperationalError "database is locked" / "database table is locked"
+    - PostgreSQL: lock_not_available (55P03), deadlock_detected (40P01)
+      y serialization_failure (40001)
+    """
+    if isinstance(exc, sqlite3.OperationalError):
+        return 'locked' in str(exc).lower()
+    return getattr(exc, 'pgcode', None) in ('55P03', '40P01', '40001')
+
+
+class Database:
+    """
+    Envoltorio de una conexión con traducción de dialecto
+
+    Métodos principales:
+    - query(sql, params): lista de filas (acceso por nombre o posición)
+    - query_one(sql, params): primera fila o None
+    - iterate(sql, params): generador de filas leídas por lotes (exportaciones grandes)
+    - scalar(sql, params): primer valor de la primera fila
+    - execute(sql, params): ejecuta y devuelve el cursor (para INSERT/UPDATE/DELETE)
+    - insert(sql, params): ejecuta un INSERT y devuelve el id generado
+
+    Se puede usar con "with": la conexión se cierra al salir del bloque.
+    """
+
+    def __init__(self, conn, dialect=None):
+        self.conn = conn
+        self.dialect = dialect or dialect_for(conn)
+        self.closed = False
+        # True si la transacción en curso ejecutó escrituras (ver commit)
+        self.wrote = False
+        # False si la conexión tiene objetos temporales (ej: movement_source): al
+        # cerrarla no vuelve al pool
+        self.reusable = True
+        # True si la conexión es de un standby de PostgreSQL (ver get_db y use_primary)
+        self.standby = False
+        metrics.DB_CONNECTIONS_OPENED.inc()
+        metrics.DB_CONNECTIONS_OPEN.inc()
+        self.IntegrityError = _integrity_error(self.dialect.name)
+        if self.dialect.name == 'sqlite':
+            # sqlite3.Row ya ofrece acceso por nombre y posición (implementado en C)
+            conn.row_factory = sqlite3.Row
+
+    def _rows(self, cursor, rows):
+        if self.dialect.name == 'sqlite' or not rows:
+            return rows
+        row_class = _row_class(tuple(d[0] for d in cursor.description))
+        return [row_class(row) for row in rows]
+
+    def _execute(self, sql, params=()):
+        if isinstance(self.conn, PooledConnection):
+            self.conn.note_statement(sql)
+        cursor = self.conn.cursor()
+        if params:
+            cursor.execute(self.dialect.translate(sql), tuple(params))
+        else:
+            # Sin parámetros los drivers no formatean la consulta: se envía tal cual
+            # (así un ? o un % dentro de un comentario del DDL no se interpreta)
+            cursor.execute(sql)
+        return cursor
+
+    # Cada método público mide su consulta (incluida la lectura de resultados)
+    # y la registra en instrumentation.py: Server-Timing y log de consultas lentas
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        self.wrote = True
+        cursor = self._execute(sql, params)
+        record_query(self, sql, params, time.perf_counter() - started)
+        return cursor
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        self.wrote = True
+        cursor = self.conn.cursor()
+        cursor.executemany(self.dialect.translate(sql), seq_of_params)
+        record_query(self, sql, None, time.perf_counter() - started)
+        return cursor
+
+    def query(self, sql, params=()):
+        started = time.perf_counter()
+        cursor = self._execute(sql, params)
+        rows = self._rows(cursor, cursor.fetchall())
+        record_query(self, sql, params, time.perf_counter() - started)
+        return rows
+
+    def iterate(self, sql, params=(), size=1000, plain=False):
+        """
+        Recorre las filas de una consulta por lotes de `size`, sin cargarlas todas en memoria
+
+        Pensado para exportaciones en streaming: cada lote se envía antes de leer el siguiente.
+        El tiempo registrado es solo el de la base (no el de quien procesa las filas).
+
+        Con plain=True las filas son tuplas simples, en el orden del SELECT: es lo que
+        necesita un csv.writer, y se evita crear un objeto de fila con nombres por cada
+        fila leída (en una exportación del historial completo, cientos de miles).
+        """
+        started = time.perf_counter()
+        cursor = self._execute(sql, params)
+        if plain and self.dialect.name == 'sqlite':
+            cursor.row_factory = None
+        elapsed = time.perf_counter() - started
+        try:
+            while True:
+                started = time.perf_counter()
+                rows = cursor.fetchmany(size)
+                elapsed += time.perf_counter() - started
+                if not rows:
+                    break
+                yield from (rows if plain else self._rows(cursor, rows))
+        finally:
+            record_query(self, sql, params, elapsed)
+
+    def query_one(self, sql, params=()):
+        started = time.perf_counter()
+        cursor = self._execute(sql, params)
+        row = cursor.fetchone()
+        record_query(self, sql, params, time.perf_counter() - started)
+        if row is None:
+            return None
+        return self._rows(cursor, [row])[0]
+
+    def scalar(self, sql, params=()):
+        row = self.query_one(sql, params)
+        return row[0] if row else None
+
+    def insert(self, sql, params=(), returning='id'):
+        """
+        Ejecuta un INSERT y devuelve el valor generado de la columna indicada
+
+        PostgreSQL no tiene lastrowid: se agrega RETURNING a la sentencia.
+        """
+        if self.dialect.name == 'postgresql':
+            return self.execute(f"{sql} RETURNING {returning}", params).fetchone()[0]
+        return self.execute(sql, params).lastrowid
+
+    def begin_write(self):
+        """Inicia una transacción de escritura con lectura consistente"""
+        self.conn.cursor().execute(self.dialect.begin_write)
+
+    def commit(self):
+        self.conn.commit()
+        if self.wrote and self.dialect.bump_generation:
+            # Incremento posterior al commit (ver PostgreSQLDialect.generation_query)
+            self.conn.cursor().execute(self.dialect.bump_generation)
+            self.conn.commit()
+        self.wrote = False
+        # Lectura de lo propio: el usuario lee del primario hasta que la réplica lo incluya
+        replica.note_commit()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.wrote = False
+
+    def use_primary(self):
+        """
+        Pasa a leer del primario una conexión abierta en un standby de PostgreSQL
+
+        El standby es de solo lectura: rechaza CREATE TEMP TABLE/VIEW, que movement_source
+        necesita para leer meses archivados. El resto de la petición lee del primario, que
+        está al menos tan al día como el standby.
+        """
+        if not self.standby:
+            return
+        self.conn.close()
+        self.conn = _pooled_connection()
+        self.standby = False
+        metrics.DB_READS.inc(target='primary', reason='temp_tables')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        metrics.DB_CONNECTIONS_OPEN.dec()
+        conn, self.conn = self.conn, _CLOSED
+        if not (self.reusable and _release(conn)):
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def records(rows):
+    """
+    Filas como diccionarios, para |tojson en plantillas y respuestas JSON
+
+    Las plantillas y los CSV usan las filas tal cual (row['columna'] funciona con
+    sqlite3.Row y con las filas de db.py); solo la serialización a JSON necesita dicts.
+    Los nombres de columna se toman una vez y se comparten: dict(zip(...)) evita buscar
+    cada columna por nombre como hace dict(row).
+    """
+    if not rows:
+        return []
+    keys = rows[0].keys()
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def get_db(readonly=False):
+    """
+    Abre una conexión con la base de datos configurada y la envuelve en Database
+
+    Args:
+        readonly (bool): La conexión solo se usará para leer (reportes, exportaciones):
+            puede ir a la réplica de lectura si está configurada y al día (ver replica.py)
+
+    Returns:
+        Database: Conexión lista para usar (cerrar con db.close() o usar "with")
+    """
+    if readonly:
+        conn = replica.connect()
+        if conn is not None:
+            db = Database(conn)
+            db.standby = db.dialect.name == 'postgresql'
+            # La secuencia de un standby de PostgreSQL avanza a saltos (se registra de a
+            # varios valores): no identifica sus datos y la vista no guarda fragmentos
+            _note_generation(db, usable=db.dialect.name == 'sqlite')
+            return db
+        db = Database(_pooled_connection())
+        _note_generation(db)
+        return db
+    return Database(_pooled_connection())
+
+
+def _note_generation(db, usable=True):
+    """
+    Generación de los datos para la caché de fragmentos (ver template_cache.py)
+
+    Se lee en la conexión de la que la vista lee los datos: una copia de la réplica
+    tiene su propia data_generation, la del momento en que se copió.
+    """
+    if has_request_context() and g.get('fragment_cache') and 'data_generation' not in g:
+        g.data_generation = current_generation(db) if usable else None
+
+
+def current_generation(db=None):
+    """
+    Generación actual de los datos (tabla data_generation, ver database.py; en
+    PostgreSQL, la secuencia data_generation_seq)
+
+    Sube con cada cambio de productos o movimientos: dos lecturas con la misma
+    generación ven los mismos datos. La usan la caché de fragmentos de plantillas
+    y los ETag de la API.
+    """
+    if db is not None:
+        return db.scalar(db.dialect.generation_query)
+    with get_db() as db:
+        return db.scalar(db.dialect.generation_query)
@@ -0,0 +1,218 @@
+# Pronóstico de demanda y punto de reorden sugerido para todo el catálogo
+#
+# stock_min es un número que alguien escribe a mano y casi nunca se revisa. Este módulo
+# lo calcula a partir de lo que realmente sale del almacén:
+#
+# 1. DEMANDA DIARIA: se suman los movimientos de 'salida' de cada producto por día
+#    (últimos FORECAST_HISTORY_DAYS días, incluidos los meses archivados) y se arma
+#    una matriz productos x días con NumPy (los días sin salidas valen 0)
+# 2. PRONÓSTICO de la demanda diaria, de dos formas:
+#    - Promedio móvil de los últimos FORECAST_WINDOW_DAYS días
+#    - Suavizado exponencial simple (alpha = FORECAST_ALPHA): cada día pesa
+#      alpha * (1 - alpha)^antigüedad, así lo reciente pesa más que lo viejo
+# 3. STOCK DE SEGURIDAD = z * desviación de la demanda diaria * raíz(días de reposición)
+#    (z sale del nivel de servicio: 95% -> 1.645, "solo 1 de cada 20 reposiciones
+#    llega tarde")
+# 4. PUNTO DE REORDEN = demanda pronosticada * días de reposición + stock de seguridad
+#
+# Todo se calcula con operaciones sobre matrices (sin bucles por producto): el
+# suavizado exponencial es un producto matriz-vector con los pesos de cada día. Los
+# productos se procesan en bloques de FORECAST_CHUNK para acotar la memoria (100.000
+# productos x 730 días serían ~300 MB de una sola vez).
+#
+# Es una tarea programada (cron, una vez al día) que guarda el resultado en la tabla
+# reorder_suggestions; la página de reportes solo la lee:
+#     python forecasting.py
+#     python forecasting.py --lead-time 10 --service-level 0.98
+#
+# Requiere NumPy (pip install numpy). La aplicación web no lo necesita: solo lee la tabla.
+import os
+import time
+import math
+from datetime import date, datetime, timedelta
+from statistics import NormalDist
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from movement_archive import movement_source
+
+FORECAST_HISTORY_DAYS = int(os.environ.get('FORECAST_HISTORY_DAYS', '730'))
+FORECAST_WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS', '28'))
+FORECAST_ALPHA = float(os.environ.get('FORECAST_ALPHA', '0.1'))
+# Días que tarda un pedido al proveedor en llegar
+FORECAST_LEAD_TIME_DAYS = float(os.environ.get('FORECAST_LEAD_TIME_DAYS', '7'))
+# Probabilidad de no quedarse sin stock mientras llega la reposición
+FORECAST_SERVICE_LEVEL = float(os.environ.get('FORECAST_SERVICE_LEVEL', '0.95'))
+# Días recientes con los que se mide la variabilidad de la demanda
+FORECAST_STD_DAYS = int(os.environ.get('FORECAST_STD_DAYS', '90'))
+# Productos por bloque de cálculo
+FORECAST_CHUNK = int(os.environ.get('FORECAST_CHUNK', '8192'))
+
+
+def exponential_weights(days, alpha):
+    """
+    Pesos del suavizado exponencial simple para una serie de `days` valores
+
+    Con nivel inicial = primer valor, el nivel final es sum(pesos * serie):
+    peso[t] = alpha * (1 - alpha)^(days - 1 - t) y el primer día se queda con el resto,
+    así los pesos suman 1.
+    """
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=np.float64)
+    weights[0] = (1 - alpha) ** (days - 1)
+    return weights
+
+
+def forecast(demand, lead_time=FORECAST_LEAD_TIME_DAYS, service_level=FORECAST_SERVICE_LEVEL,
+             window=FORECAST_WINDOW_DAYS, alpha=FORECAST_ALPHA, std_days=FORECAST_STD_DAYS):
+    """
+    Pronóstico y punto de reorden de un bloque de productos
+
+    Args:
+        demand (numpy.ndarray): Matriz productos x días (el último día es ayer)
+
+    Returns:
+        dict: Arrays (uno por producto) average, forecast, std, safety_stock, reorder_point
+    """
+    days = demand.shape[1]
+    window = min(window, days)
+    std_days = min(std_days, days)
+    average = demand[:, -window:].mean(axis=1)
+    smoothed = demand @ exponential_weights(days, alpha)
+    deviation = demand[:, -std_days:].std(axis=1)
+    z = NormalDist().inv_cdf(service_level)
+    safety_stock = np.ceil(z * deviation * math.sqrt(lead_time))
+    reorder_point = np.ceil(smoothed * lead_time + safety_stock)
+    return {
+        'average': average,
+        'forecast': smoothed,
+        'std': deviation,
+        'safety_stock': safety_stock,
+        'reorder_point': reorder_point,
+    }
+
+
+def load_daily_demand(db, start, days):
+    """
+    Salidas por producto y día desde `start` (inclusive), sin incluir hoy
+
+    Returns:
+        tuple: arrays (product_id, índice del día, unidades) de las celdas con salidas
+    """
+    end = start + timedelta(days=days - 1)
+    source = movement_source(db, start.isoformat(), end.isoformat())
+    day_expr = db.dialect.to_date('created_at')
+    rows = db.iterate(f"""
+        SELECT product_id, {day_expr} AS day, SUM(-quantity_change) AS units
+        FROM {source}
+        WHERE movement_type = 'salida' AND {day_expr} >= ? AND {day_expr} <= ?
+        GROUP BY product_id, {day_expr}
+    """, (start.isoformat(), end.isoformat()), size=10000)
+    day_index = {}  # Fecha (texto u objeto date según el motor) -> índice del día
+    product_ids, day_numbers, units = [], [], []
+    for product_id, day, quantity in rows:
+        index = day_index.get(day)
+        if index is None:
+            parsed = day if isinstance(day, date) else date.fromisoformat(str(day)[:10])
+            index = day_index[day] = (parsed - start).days
+        product_ids.append(product_id)
+        day_numbers.append(index)
+        units.append(quantity)
+    return (np.array(product_ids, dtype=np.int64), np.array(day_numbers, dtype=np.int64),
+            np.array(units, dtype=np.float64))
+
+
+def compute_suggestions(db, history_days=FORECAST_HISTORY_DAYS, lead_time=FORECAST_LEAD_TIME_DAYS,
+                        service_level=FORECAST_SERVICE_LEVEL):
+    """
+    Recalcula reorder_suggestions para todos los productos (en una transacción)
+
+    Returns:
+        dict: Productos procesados, con demanda y tiempos de lectura/cálculo
+    """
+    if np is None:
+        raise RuntimeError("El pronóstico de demanda requiere NumPy: pip install numpy")
+
+    started = time.perf_counter()
+    start = date.today() - timedelta(days=history_days)
+    catalogue = np.array([row[0] for row in db.query("SELECT id FROM products ORDER BY id")], dtype=np.int64)
+    cell_products, cell_days, cell_units = load_daily_demand(db, start, history_days)
+    # Fin de la lectura: si la ventana toca meses archivados, movement_source llenó una tabla
+    # temporal y el INSERT dejó abierta una transacción implícita que impediría begin_write()
+    db.rollback()
+    loaded = time.perf_counter()
+
+    # Posición de cada celda en el catálogo (los productos eliminados se descartan)
+    positions = np.searchsorted(catalogue, cell_products)
+    valid = positions < len(catalogue)
+    valid[valid] = catalogue[positions[valid]] == cell_products[valid]
+    positions, cell_days, cell_units = positions[valid], cell_days[valid], cell_units[valid]
+    order = np.argsort(positions, kind='stable')
+    positions, cell_days, cell_units = positions[order], cell_days[order], cell_units[order]
+
+    computed_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    suggestions = []
+    for first in range(0, len(catalogue), FORECAST_CHUNK):
+        last = min(first + FORECAST_CHUNK, len(catalogue))
+        low, high = np.searchsorted(positions, [first, last])
+        # Matriz densa del bloque: bincount suma las unidades de cada (producto, día)
+        flat = (positions[low:high] - first) * history_days + cell_days[low:high]
+        demand = np.bincount(flat, weights=cell_units[low:high],
+                             minlength=(last - first) * history_days).reshape(last - first, history_days)
+        result = forecast(demand, lead_time=lead_time, service_level=service_level)
+        suggestions.extend(zip(
+            catalogue[first:last].tolist(),
+            np.round(result['average'], 4).tolist(),
+            np.round(result['forecast'], 4).tolist(),
+            np.round(result['std'], 4).tolist(),
+            result['safety_stock'].astype(np.int64).tolist(),
+            result['reorder_point'].astype(np.int64).tolist(),
+        ))
+    calculated = time.perf_counter()
+
+    db.begin_write()
+    try:
+        db.execute("DELETE FROM reorder_suggestions")
+        db.executemany("""
+            INSERT INTO reorder_suggestions
+            (product_id, avg_daily_demand, forecast_daily_demand, demand_std, safety_stock, reorder_point,
+             lead_time_days, service_level, computed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [row + (lead_time, service_level, computed_at) for row in suggestions])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {
+        'products': len(catalogue),
+        'with_demand': int(len(np.unique(positions))),
+        'cells': int(len(cell_units)),
+        'load_seconds': round(loaded - started, 3),
+        'compute_seconds': round(calculated - loaded, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from db import get_db
+
+    parser = argparse.ArgumentParser(description="Pronóstico de demanda y punto de reorden sugerido")
+    parser.add_argument('--history-days', type=int, default=FORECAST_HISTORY_DAYS,
+                        help="Días de historial de salidas (por defecto %(default)s)")
+    parser.add_argument('--lead-time', type=float, default=FORECAST_LEAD_TIME_DAYS,
+                        help="Días de reposición del proveedor (por defecto %(default)s)")
+    parser.add_argument('--service-level', type=float, default=FORECAST_SERVICE_LEVEL,
+                        help="Nivel de servicio entre 0 y 1 (por defecto %(default)s)")
+    args = parser.parse_args()
+
+    with get_db() as database:
+        summary = compute_suggestions(database, history_days=args.history_days, lead_time=args.lead_time,
+                                      service_level=args.service_level)
+    print(f"Sugerencias calculadas para {summary['products']} productos "
+          f"({summary['with_demand']} con salidas, {summary['cells']} días-producto)")
+    print(f"Lectura: {summary['load_seconds']}s, cálculo: {summary['compute_seconds']}s, "
+          f"total: {summary['total_seconds']}s")
@@ -0,0 +1,211 @@
+# Instrumentación de peticiones y consultas SQL
+#
+# Para cada petición HTTP se mide:
+# - Tiempo total (desde before_request hasta after_request)
+# - Tiempo en la base de datos y número de consultas (medido en db.Database)
+# - Tiempo de renderizado de plantillas (clase de plantilla Jinja2 cronometrada)
+#
+# Los tiempos se envían al navegador en la cabecera Server-Timing (visible en la
+# pestaña "Timing" de las herramientas de desarrollo) y se acumulan por ruta y por
+# "huella" de consulta (el SQL normalizado, sin valores concretos), para saber qué
+# consultas de reports() o generate_custom_report pesan más.
+#
+# Las consultas que superan SLOW_QUERY_MS se escriben en el log de consultas lentas
+# (una línea JSON por consulta) junto con su plan de ejecución (EXPLAIN QUERY PLAN
+# en SQLite, EXPLAIN en PostgreSQL/MySQL).
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+
+# Activar/desactivar toda la instrumentación (1/0)
+ENABLED = os.environ.get('INSTRUMENTATION_ENABLED', '1') == '1'
+# Umbral de consulta lenta en milisegundos
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+# Archivo del log de consultas lentas
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'data/logs/slow_queries.log')
+
+slow_query_logger = logging.getLogger('inventario.slow_queries')
+slow_query_logger.propagate = False
+
+# Estadísticas acumuladas del proceso (las lee metrics.py)
+_lock = threading.Lock()
+query_stats = {}     # huella -> {'sql', 'count', 'total_ms', 'max_ms'}
+request_stats = {}   # endpoint -> {'count', 'total_ms', 'db_ms', 'template_ms', 'queries'}
+
+_COMMENT_RE = re.compile(r'--[^\n]*')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_sql(sql):
+    """
+    Normaliza una consulta para agrupar ejecuciones equivalentes
+
+    Quita comentarios y espacios repetidos y reemplaza literales de texto y números
+    por ?, y las listas (?, ?, ?) por (...). Dos consultas que solo difieren en los
+    valores tienen el mismo texto normalizado.
+    """
+    sql = _COMMENT_RE.sub(' ', sql)
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """
+    Huella corta (12 caracteres) de la consulta normalizada
+
+    Returns:
+        tuple: (huella, consulta normalizada)
+    """
+    cached = _fingerprints.get(sql)
+    if cached is None:
+        normalized = normalize_sql(sql)
+        cached = (hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12], normalized)
+        if len(_fingerprints) < 5000:  # Las consultas de la app son textos fijos; límite por seguridad
+            _fingerprints[sql] = cached
+    return cached
+
+
+def _setup_slow_log():
+    if slow_query_logger.handlers:
+        return
+    os.makedirs(os.path.dirname(SLOW_QUERY_LOG) or '.', exist_ok=True)
+    handler = logging.FileHandler(SLOW_QUERY_LOG, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    slow_query_logger.addHandler(handler)
+    slow_query_logger.setLevel(logging.INFO)
+
+
+def _explain(db, sql, params):
+    """Plan de ejecución de una consulta SELECT (lista de líneas de texto)"""
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if db.dialect.name == 'sqlite' else 'EXPLAIN '
+    try:
+        # Cursor directo (sin pasar por Database): el EXPLAIN no se vuelve a medir
+        cursor = db.conn.cursor()
+        if params:
+            cursor.execute(prefix + db.dialect.translate(sql), tuple(params))
+        else:
+            cursor.execute(prefix + sql)
+        rows = cursor.fetchall()
+    except Exception as e:
+        return [f'(EXPLAIN falló: {e})']
+    if db.dialect.name == 'sqlite':
+        # Columnas: id, parent, notused, detail
+        return [row[3] for row in rows]
+    return [' | '.join(str(value) for value in row) for row in rows]
+
+
+def record_query(db, sql, params, elapsed):
+    """
+    Registra una consulta ejecutada (llamado por db.Database)
+
+    Args:
+        db: Database que ejecutó la consulta (para el EXPLAIN de las lentas)
+        sql (str): Consulta tal como la escribió la aplicación
+        params: Parámetros usados
+        elapsed (float): Duración en segundos (incluye leer los resultados)
+    """
+    if not ENABLED:
+        return
+    elapsed_ms = elapsed * 1000
+    key, normalized = fingerprint(sql)
+    with _lock:
+        stats = query_stats.get(key)
+        if stats is None:
+            stats = query_stats[key] = {'sql': normalized, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+    in_request = has_request_context()
+    if in_request and 'request_timing' in g:
+        timing = g.request_timing
+        timing['db'] += elapsed
+        timing['queries'] += 1
+
+    if elapsed_ms >= SLOW_QUERY_MS:
+        _setup_slow_log()
+        entry = {
+            'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+            'duration_ms': round(elapsed_ms, 2),
+            'fingerprint': key,
+            'sql': normalized,
+            'params': [repr(p)[:100] for p in (params or ())][:20],
+            'path': request.full_path.rstrip('?') if in_request else None,
+            'endpoint': request.endpoint if in_request else None,
+            'plan': _explain(db, sql, params),
+        }
+        slow_query_logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+class TimedTemplate(Template):
+    """Plantilla Jinja2 que suma su tiempo de renderizado al de la petición actual"""
+
+    def render(self, *args, **kwargs):
+        if not (ENABLED and has_request_context() and 'request_timing' in g):
+            return super().render(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            g.request_timing['template'] += time.perf_counter() - started
+
+
+def _before_request():
+    g.request_timing = {'started': time.perf_counter(), 'db': 0.0, 'template': 0.0, 'queries': 0}
+
+
+def _after_request(response):
+    timing = g.pop('request_timing', None)
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['started']
+    # Server-Timing: duraciones en milisegundos; el navegador las muestra por petición
+    response.headers['Server-Timing'] = (
+        f"db;dur={timing['db'] * 1000:.2f};desc=\"{timing['queries']} consultas\", "
+        f"tpl;dur={timing['template'] * 1000:.2f};desc=\"plantillas\", "
+        f"app;dur={total * 1000:.2f};desc=\"total\""
+    )
+    endpoint = request.endpoint or 'other'
+    with _lock:
+        stats = request_stats.get(endpoint)
+        if stats is None:
+            stats = request_stats[endpoint] = {'count': 0, 'total_ms': 0.0, 'db_ms': 0.0,
+                                               'template_ms': 0.0, 'queries': 0}
+        stats['count'] += 1
+        stats['total_ms'] += total * 1000
+        stats['db_ms'] += timing['db'] * 1000
+        stats['template_ms'] += timing['template'] * 1000
+        stats['queries'] += timing['queries']
+    return response
+
+
+def init_app(app):
+    """
+    Activa la instrumentación en la aplicación Flask
+
+    - before_request/after_request miden cada petición y agregan Server-Timing
+    - Las plantillas se cargan con TimedTemplate para medir el renderizado
+    """
+    if not ENABLED:
+        return
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_before_request)
+    app.after_request(_after_request)
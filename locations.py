@@ -0,0 +1,177 @@
+# Stock por ubicación (almacenes, sucursales)
+#
+# products.quantity sigue siendo el stock TOTAL de cada producto: la lista de productos,
+# el dashboard, las alertas y la API lo leen tal cual (una columna, sin sumar nada).
+# El reparto entre ubicaciones vive en la tabla stock_levels, una fila por
+# (producto, ubicación), y se mantiene así:
+#
+# - adjust(): entrada o salida en una ubicación. Actualiza la fila de stock_levels y
+#   suma la misma diferencia a products.quantity (incremental, sin recalcular el total)
+# - transfer(): mueve unidades entre dos ubicaciones en UNA transacción: las dos filas
+#   de stock_levels y los dos movimientos 'transferencia' (salida del origen y entrada
+#   en el destino) se confirman juntos o no se confirma nada. El total no cambia.
+# - Triggers de la base (ver location_triggers en db.py): un producto nuevo nace con su
+#   stock en la ubicación principal, y un cambio de products.quantity que no pasó por
+#   adjust() (edición del producto, scripts) se aplica a la ubicación principal.
+#
+# Índices: la clave primaria (product_id, location_id) resuelve "stock de un producto" y
+# idx_stock_levels_location (location_id, product_id, quantity) "productos de una
+# ubicación" leyendo solo el índice. Los movimientos tienen location_id con su índice
+# (location_id, created_at) para el historial por ubicación.
+#
+# Ubicaciones:
+#     flask --app wsgi create-location "Sucursal Norte"
+#     flask --app wsgi list-locations
+import click
+
+from db import get_db
+
+# La ubicación principal es la primera que se crea (init_db la crea con la tabla)
+MAIN_LOCATION_ID = 1
+MAIN_LOCATION_NAME = 'Principal'
+
+
+def list_locations(db):
+    """Ubicaciones ordenadas (la principal primero)"""
+    return db.query("SELECT id, name FROM locations ORDER BY id")
+
+
+def get_location(db, location_id):
+    """Ubicación por id (None si no existe)"""
+    return db.query_one("SELECT id, name FROM locations WHERE id = ?", (location_id,))
+
+
+def levels(db, product_id):
+    """Stock de un producto en cada ubicación (incluidas las que no tienen fila: 0)"""
+    return db.query("""
+        SELECT l.id AS location_id, l.name, COALESCE(s.quantity, 0) AS quantity
+        FROM locations l
+        LEFT JOIN stock_levels s ON s.location_id = l.id AND s.product_id = ?
+        ORDER BY l.id
+    """, (product_id,))
+
+
+def level(db, product_id, location_id):
+    """Cantidad de un producto en una ubicación (None si todavía no tiene fila)"""
+    return db.scalar("SELECT quantity FROM stock_levels WHERE product_id = ? AND location_id = ?",
+                     (product_id, location_id))
+
+
+def _set_level(db, product_id, location_id, current, quantity):
+    """Guarda la cantidad de una ubicación (current=None si la fila todavía no existe)"""
+    if current is None:
+        db.execute("INSERT INTO stock_levels (product_id, location_id, quantity) VALUES (?, ?, ?)",
+                   (product_id, location_id, quantity))
+    else:
+        db.execute("UPDATE stock_levels SET quantity = ? WHERE product_id = ? AND location_id = ?",
+                   (quantity, product_id, location_id))
+
+
+def adjust(db, product_id, location_id, delta):
+    """
+    Suma `delta` unidades (negativo para una salida) a un producto en una ubicación (sin commit)
+
+    Como en el ajuste rápido, la cantidad de la ubicación nunca queda negativa: una salida
+    mayor que lo disponible deja la ubicación en 0.
+
+    Returns:
+        tuple: (cantidad en la ubicación antes, después) o None si el producto no existe
+    """
+    total = db.scalar("SELECT quantity FROM products WHERE id = ?", (product_id,))
+    if total is None:
+        return None
+    current = level(db, product_id, location_id)
+    before = current or 0
+    after = max(0, before + delta)
+    if after != before:
+        # Primero la ubicación y después el total: cuando el trigger de products compara
+        # el total con la suma de stock_levels ya coinciden y no toca la ubicación principal
+        _set_level(db, product_id, location_id, current, after)
+        db.execute("UPDATE products SET quantity = quantity + ? WHERE id = ?", (after - before, product_id))
+    return before, after
+
+
+def transfer(db, product_id, source_id, target_id, quantity):
+    """
+    Mueve unidades de un producto entre dos ubicaciones (sin commit)
+
+    Raises:
+        ValueError: Ubicaciones iguales o inexistentes, cantidad no positiva o mayor que el
+            stock del origen (el mensaje se puede mostrar al usuario)
+
+    Returns:
+        tuple: ((origen antes, origen después), (destino antes, destino después))
+    """
+    if quantity <= 0:
+        raise ValueError('La cantidad a transferir debe ser mayor que cero')
+    if source_id == target_id:
+        raise ValueError('El origen y el destino deben ser ubicaciones distintas')
+    if get_location(db, source_id) is None or get_location(db, target_id) is None:
+        raise ValueError('Ubicación no encontrada')
+    source_current = level(db, product_id, source_id)
+    if (source_current or 0) < quantity:
+        raise ValueError(f'Stock insuficiente en el origen (disponible: {source_current or 0})')
+    target_current = level(db, product_id, target_id)
+    _set_level(db, product_id, source_id, source_current, source_current - quantity)
+    _set_level(db, product_id, target_id, target_current, (target_current or 0) + quantity)
+    return (source_current, source_current - quantity), (target_current or 0, (target_current or 0) + quantity)
+
+
+def reconcile_all(db):
+    """
+    Hace coincidir stock_levels con products.quantity en todos los productos (sin commit)
+
+    Los productos sin filas (ej: existentes antes de las ubicaciones) reciben todo su stock
+    en la ubicación principal; en los demás, la diferencia con el total va a la principal.
+
+    Returns:
+        dict: Productos agregados y corregidos
+    """
+    added = db.execute("""
+        INSERT INTO stock_levels (product_id, location_id, quantity)
+        SELECT p.id, ?, p.quantity
+        FROM products p
+        WHERE NOT EXISTS (SELECT 1 FROM stock_levels s WHERE s.product_id = p.id)
+    """, (MAIN_LOCATION_ID,)).rowcount
+    drift = db.query("""
+        SELECT p.id, p.quantity - totals.quantity AS difference
+        FROM products p
+        JOIN (SELECT product_id, SUM(quantity) AS quantity FROM stock_levels GROUP BY product_id) totals
+          ON totals.product_id = p.id
+        WHERE p.quantity <> totals.quantity
+    """)
+    for product_id, difference in drift:
+        current = level(db, product_id, MAIN_LOCATION_ID)
+        _set_level(db, product_id, MAIN_LOCATION_ID, current, max(0, (current or 0) + difference))
+    removed = db.execute("""
+        DELETE FROM stock_levels
+        WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.id = stock_levels.product_id)
+    """).rowcount
+    return {'added': added, 'corrected': len(drift), 'removed': removed}
+
+
+@click.argument('name')
+def create_location_command(name):
+    """Crea una ubicación (almacén, sucursal)"""
+    with get_db() as db:
+        try:
+            location_id = db.insert("INSERT INTO locations (name) VALUES (?)", (name.strip(),))
+            db.commit()
+        except db.IntegrityError:
+            db.rollback()
+            print(f"Ya existe una ubicación llamada '{name}'")
+            return
+    print(f"Ubicación '{name}' creada (id {location_id})")
+
+
+def list_locations_command():
+    """Muestra las ubicaciones con sus productos y unidades"""
+    with get_db() as db:
+        for row in db.query("""
+            SELECT l.id, l.name, COUNT(s.product_id) AS products, COALESCE(SUM(s.quantity), 0) AS units
+            FROM locations l
+            LEFT JOIN stock_levels s ON s.location_id = l.id AND s.quantity > 0
+            GROUP BY l.id, l.name
+            ORDER BY l.id
+        """):
+            print(f"{row['id']:>4}  {row['name']:<30} {row['products']:>6} productos  {row['units']:>10} unidades")
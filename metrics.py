@@ -0,0 +1,407 @@
+# Métricas de la aplicación en formato de texto de Prometheus
+#
+# Con gunicorn hay varios procesos (workers) y cada uno atiende parte de las peticiones:
+# los contadores en memoria de un solo proceso no sirven para ver el total.
+# Por eso cada worker guarda periódicamente una "foto" de sus métricas en un archivo
+# JSON propio (data/metrics/<pid>-<inicio>.json) y la ruta /metrics suma los archivos de todos:
+# - Contadores e histogramas: se suman todos los archivos (también los de workers ya
+#   terminados, así los totales no retroceden cuando gunicorn recicla un worker)
+# - Gauges (valores actuales, ej: conexiones abiertas): solo se suman los procesos vivos
+#
+# El nombre lleva el inicio del proceso además del pid: tras reiniciar un contenedor los
+# workers vuelven a tener los mismos pids y un worker nuevo sobrescribiría los contadores
+# del anterior. Por lo mismo, un proceso vivo no se reconoce por su pid sino por el
+# bloqueo de fcntl que mantiene sobre su archivo <pid>-<inicio>.lock (como en
+# movement_spool.py): al morir, el sistema libera el bloqueo.
+#
+# No requiere ningún servicio externo: cualquier herramienta que lea el formato de texto
+# de Prometheus (o un simple curl) puede consultar /metrics.
+#
+# Uso desde el código:
+#     metrics.LOGIN_ATTEMPTS.inc(result='success')
+#     metrics.EXPORT_BYTES.observe(12345, export='export_csv')
+import os
+import json
+import time
+import atexit
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: solo hay un proceso en desarrollo (se usa el pid del archivo)
+
+from flask import g, request, session
+
+# Directorio compartido por los workers
+METRICS_DIR = os.environ.get('METRICS_DIR', 'data/metrics')
+# Segundos entre escrituras del archivo de cada worker
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+# Los archivos de workers terminados se borran después de este tiempo (segundos)
+METRICS_RETENTION = float(os.environ.get('METRICS_RETENTION', '86400'))
+
+# Límites de los histogramas
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+_lock = threading.Lock()
+_registry = {}      # nombre -> métrica
+_collectors = []    # funciones que actualizan métricas justo antes de guardarlas
+_flusher_pid = None  # Proceso en el que corre el hilo de escritura
+_process_file = None  # (pid, nombre de los archivos, manejador con el bloqueo) de este proceso
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # tupla de valores de etiquetas -> valor
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+
+class Counter(_Metric):
+    """Valor que solo crece (peticiones, intentos de login, ajustes)"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Fija el total acumulado (para contadores que ya lleva otro objeto, ej: lru_cache)"""
+        with _lock:
+            self.values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    """Valor que sube y baja (conexiones abiertas)"""
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Distribución de valores en rangos (latencias, tamaños)"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            data = self.values.get(key)
+            if data is None:
+                # Conteo por rango (no acumulado), suma y cantidad de observaciones
+                data = self.values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            position = len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    position = index
+                    break
+            data['buckets'][position] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+
+# Métricas de la aplicación
+REQUESTS = Counter('inventario_http_requests_total', 'Peticiones HTTP atendidas',
+                   ['endpoint', 'method', 'status', 'role'])
+REQUEST_LATENCY = Histogram('inventario_http_request_duration_seconds', 'Duración de las peticiones HTTP',
+                            ['endpoint', 'role'])
+DB_CONNECTIONS_OPENED = Counter('inventario_db_connections_opened_total', 'Conexiones a la base de datos abiertas')
+DB_CONNECTIONS_OPEN = Gauge('inventario_db_connections_open', 'Conexiones a la base de datos abiertas ahora')
+CACHE_HITS = Counter('inventario_cache_hits_total', 'Aciertos de cachés internas', ['cache'])
+CACHE_MISSES = Counter('inventario_cache_misses_total', 'Fallos de cachés internas', ['cache'])
+STOCK_ADJUSTMENTS = Counter('inventario_stock_adjustments_total', 'Ajustes rápidos de stock', ['movement_type'])
+LOGIN_ATTEMPTS = Counter('inventario_login_attempts_total', 'Intentos de inicio de sesión', ['result'])
+EXPORT_BYTES = Histogram('inventario_export_bytes', 'Tamaño de las exportaciones CSV', ['export'],
+                         buckets=SIZE_BUCKETS)
+NOTIFICATIONS = Counter('inventario_notifications_total', 'Notificaciones de alertas de stock procesadas',
+                        ['sink', 'result'])
+DB_READS = Counter('inventario_db_readonly_connections_total', 'Conexiones de solo lectura por destino',
+                   ['target', 'reason'])
+
+# Rutas cuyo tamaño de respuesta se registra en EXPORT_BYTES
+EXPORT_ENDPOINTS = {'export_csv', 'export_custom_report'}
+
+
+def register_collector(function):
+    """Registra una función que actualiza métricas antes de cada escritura (ej: estadísticas de cachés)"""
+    _collectors.append(function)
+    return function
+
+
+def register_lru_cache(name, cached_function):
+    """Publica los aciertos/fallos de una función con @lru_cache como métricas de caché"""
+    def collect():
+        info = cached_function.cache_info()
+        CACHE_HITS.set_total(info.hits, cache=name)
+        CACHE_MISSES.set_total(info.misses, cache=name)
+    register_collector(collect)
+
+
+def _snapshot():
+    for collector in _collectors:
+        collector()
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'metrics': {name: metric.snapshot() for name, metric in _registry.items() if metric.values},
+        }
+
+
+def _own_name():
+    """
+    Nombre de los archivos de este proceso (<pid>-<inicio en ns>)
+
+    La primera vez (en cada proceso: los workers se crean con fork) abre <nombre>.lock y
+    toma su bloqueo, que se mantiene mientras el proceso viva.
+    """
+    global _process_file
+    with _lock:
+        if _process_file is None or _process_file[0] != os.getpid():
+            if _process_file is not None and _process_file[2] is not None:
+                # Copia heredada del proceso padre: el bloqueo es suyo
+                _process_file[2].close()
+            name = f'{os.getpid()}-{time.time_ns()}'
+            handle = None
+            if fcntl is not None:
+                handle = open(os.path.join(METRICS_DIR, f'{name}.lock'), 'w')
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            _process_file = (os.getpid(), name, handle)
+        return _process_file[1]
+
+
+def flush():
+    """
+    Guarda las métricas de este proceso en METRICS_DIR/<pid>-<inicio>.json
+
+    Se escribe en un archivo temporal y se renombra: quien lea nunca ve un archivo a medias.
+    """
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'{_own_name()}.json')
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(_snapshot(), f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"AVISO: No se pudieron guardar las métricas: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+
+def _start_flusher():
+    """
+    Inicia (una vez por proceso) el hilo que guarda las métricas cada METRICS_FLUSH_INTERVAL
+
+    Se llama en la primera petición y no al importar: con gunicorn --preload el módulo
+    se importa en el proceso maestro, y los hilos no sobreviven al fork de los workers.
+    """
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+    atexit.register(flush)  # Última escritura al terminar el worker
+
+
+
+def _alive(name, data):
+    """
+    Indica si sigue vivo el proceso que escribió METRICS_DIR/<name>.json
+
+    Vivo = alguien tiene el bloqueo de <name>.lock (también este proceso, sobre otro
+    manejador). Sin archivo de bloqueo (ej: los <pid>.json de versiones anteriores) se
+    considera terminado.
+    """
+    if fcntl is None:
+        return _pid_alive(data.get('pid', 0))
+    try:
+        with open(os.path.join(METRICS_DIR, f'{name}.lock'), 'r') as f:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True
+    return False
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_snapshots():
+    """Lee los archivos de todos los workers (y borra los de workers terminados hace tiempo)"""
+    snapshots = []
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return snapshots
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        alive = _alive(name[:-len('.json')], data)
+        if not alive and time.time() - data.get('time', 0) > METRICS_RETENTION:
+            for old in (path, f'{path[:-len(".json")]}.lock'):
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+            continue
+        snapshots.append((alive, data['metrics']))
+    return snapshots
+
+
+def _merge(snapshots):
+    merged = {}  # nombre -> {etiquetas: valor}
+    for alive, data in snapshots:
+        for name, samples in data.items():
+            metric = _registry.get(name)
+            if metric is None or (metric.type == 'gauge' and not alive):
+                continue
+            target = merged.setdefault(name, {})
+            for labels, value in samples:
+                key = tuple(labels)
+                if metric.type == 'histogram':
+                    current = target.get(key)
+                    if current is None:
+                        target[key] = {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+                    else:
+                        current['buckets'] = [a + b for a, b in zip(current['buckets'], value['buckets'])]
+                        current['sum'] += value['sum']
+                        current['count'] += value['count']
+                else:
+                    target[key] = target.get(key, 0) + value
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Métricas de todos los workers en formato de texto de Prometheus
+
+    Returns:
+        str: Texto listo para devolver con Content-Type text/plain; version=0.0.4
+    """
+    flush()
+    merged = _merge(_load_snapshots())
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        for key, value in sorted(merged.get(name, {}).items()):
+            if metric.type != 'histogram':
+                lines.append(f'{name}{_labels(metric.labelnames, key)} {_format_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), value['buckets']):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{name}_bucket{_labels(metric.labelnames, key, le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(metric.labelnames, key)} {_format_number(value["sum"])}')
+            lines.append(f'{name}_count{_labels(metric.labelnames, key)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _count_streamed(iterable, endpoint):
+    """Cuenta los bytes de una respuesta en streaming a medida que se envían"""
+    size = 0
+    try:
+        for chunk in iterable:
+            size += len(chunk)
+            yield chunk
+    finally:
+        EXPORT_BYTES.observe(size, export=endpoint)
+        close = getattr(iterable, 'close', None)
+        if close:
+            close()
+
+
+def _before_request():
+    _start_flusher()
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'other'
+    # Los archivos estáticos no leen la sesión: leerla agrega "Vary: Cookie" a la respuesta
+    # y los navegadores/proxies dejarían de compartir su caché
+    role = 'anonymous' if endpoint == 'static' else session.get('role', 'anonymous')
+    REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, role=role)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code, role=role)
+    if endpoint in EXPORT_ENDPOINTS and response.status_code == 200:
+        if response.is_streamed:
+            response.response = _count_streamed(response.response, endpoint)
+        else:
+            EXPORT_BYTES.observe(response.calculate_content_length() or 0, export=endpoint)
+    return response
+
+
+def init_app(app):
+    """Mide cada petición (cantidad y latencia por ruta y rol)"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,339 @@
+# Archivado por particiones del historial de movimientos de inventario
+#
+# La tabla inventory_movements es un log que solo crece: cada ajuste, edición,
+# alta o baja de producto agrega una fila y nunca se borra nada. Con el tiempo
+# todas las consultas de historial, reportes y dashboard terminan recorriendo
+# años de registros aunque solo les interesen unos días.
+#
+# Este módulo implementa un particionado por tiempo (un "segmento" por mes):
+# - Los meses recientes ("calientes") se quedan en la tabla viva inventory_movements
+# - Los meses antiguos se mueven a archivos comprimidos de solo lectura
+#   (formato columnar: una lista de valores por columna, comprimido con gzip o zstd)
+# - Un manifiesto (manifest.json) describe qué mes contiene cada segmento
+#   y su rango de fechas, para no abrir archivos que no hacen falta
+# - Al archivar también se guardan totales por producto y mes en la tabla
+#   movement_archive_rollups, así los reportes agregados no necesitan leer segmentos
+#
+# Las consultas que filtran por fecha usan movement_source(), que devuelve el nombre
+# de la "tabla" a consultar: la tabla viva si ningún segmento se solapa con el rango,
+# o una vista temporal que une la tabla viva con los segmentos que sí se solapan.
+import os
+import json
+import gzip
+from datetime import date
+
+try:
+    import zstandard  # Compresión zstd (opcional, más rápida y compacta que gzip)
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+# Directorio donde viven los segmentos archivados y su manifiesto
+ARCHIVE_DIR = os.environ.get('MOVEMENT_ARCHIVE_DIR', 'data/archive')
+MANIFEST_FILE = 'manifest.json'
+
+# Meses que se mantienen en la tabla viva (incluyendo el mes actual)
+HOT_MONTHS = int(os.environ.get('MOVEMENT_HOT_MONTHS', '6'))
+
+# Códec de compresión para segmentos nuevos: 'gzip' (siempre disponible) o 'zstd'
+SEGMENT_CODEC = os.environ.get('MOVEMENT_ARCHIVE_CODEC', 'gzip').lower()
+
+# Nombres de los objetos temporales que se crean en la conexión al consultar segmentos
+ARCHIVE_TEMP_TABLE = 'archived_movements'
+ARCHIVE_TEMP_VIEW = 'movements_all'
+
+
+def _manifest_path():
+    return os.path.join(ARCHIVE_DIR, MANIFEST_FILE)
+
+
+def load_manifest():
+    """
+    Lee el manifiesto de segmentos archivados
+
+    Returns:
+        dict: {'segments': [...]} donde cada segmento tiene month, file, codec,
+              rows, min_created_at y max_created_at
+    """
+    try:
+        with open(_manifest_path(), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'segments': []}
+
+
+def _write_atomic(path, data):
+    """
+    Escribe un archivo de forma atómica (archivo temporal + os.replace)
+
+    Así un lector nunca ve un segmento o manifiesto a medio escribir,
+    aunque el proceso se interrumpa durante la escritura.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _save_manifest(manifest):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    manifest['segments'].sort(key=lambda s: s['month'])
+    _write_atomic(_manifest_path(), json.dumps(manifest, indent=2).encode('utf-8'))
+
+
+def _compress(raw, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(raw)
+    return gzip.compress(raw, compresslevel=9)
+
+
+def _decompress(data, codec):
+    if codec == 'zstd':
+        if not has_zstd:
+            raise RuntimeError("El segmento usa zstd pero el paquete 'zstandard' no está instalado")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def read_segment(segment):
+    """
+    Lee un segmento archivado y lo convierte de formato columnar a filas
+
+    Args:
+        segment (dict): Entrada del manifiesto
+
+    Returns:
+        tuple: (lista de columnas, lista de tuplas con las filas)
+    """
+    with open(os.path.join(ARCHIVE_DIR, segment['file']), 'rb') as f:
+        payload = json.loads(_decompress(f.read(), segment.get('codec', 'gzip')))
+    columns = payload['columns']
+    # zip(*columnas) reconstruye las filas a partir de las listas por columna
+    rows = list(zip(*(payload['data'][col] for col in columns)))
+    return columns, rows
+
+
+def _write_segment(month, columns, rows, manifest):
+    """
+    Escribe (o amplía) el segmento de un mes y actualiza el manifiesto en memoria
+
+    Si el segmento del mes ya existe, las filas se fusionan eliminando duplicados
+    por id. Esto hace que archivar sea idempotente: si el proceso se interrumpió
+    después de escribir el segmento pero antes de borrar las filas de la tabla viva,
+    la siguiente ejecución no duplica movimientos.
+    """
+    existing = next((s for s in manifest['segments'] if s['month'] == month), None)
+    id_index = columns.index('id')
+    merged = {row[id_index]: row for row in rows}
+
+    if existing:
+        old_columns, old_rows = read_segment(existing)
+        for old_row in old_rows:
+            values = dict(zip(old_columns, old_row))
+            # Columnas que no existían cuando se archivó el segmento quedan en NULL
+            merged.setdefault(values['id'], tuple(values.get(col) for col in columns))
+
+    ordered = sorted(merged.values(), key=lambda row: row[id_index])
+    created_index = columns.index('created_at')
+    codec = 'zstd' if SEGMENT_CODEC == 'zstd' and has_zstd else 'gzip'
+    filename = f"movements_{month}.json.{'zst' if codec == 'zstd' else 'gz'}"
+
+    # Formato columnar: una lista por columna comprime mucho mejor que fila por fila
+    payload = {
+        'month': month,
+        'columns': columns,
+        'data': {col: [row[i] for row in ordered] for i, col in enumerate(columns)},
+    }
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # default=str: PostgreSQL/MySQL devuelven created_at como datetime, SQLite como texto
+    _write_atomic(os.path.join(ARCHIVE_DIR, filename),
+                  _compress(json.dumps(payload, separators=(',', ':'), default=str).encode('utf-8'), codec))
+
+    if existing and existing['file'] != filename:
+        # Cambió el códec: eliminar el archivo anterior del mismo mes
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, existing['file']))
+        except FileNotFoundError:
+            pass
+
+    entry = {
+        'month': month,
+        'file': filename,
+        'codec': codec,
+        'rows': len(ordered),
+        'min_created_at': min(str(row[created_index]) for row in ordered),
+        'max_created_at': max(str(row[created_index]) for row in ordered),
+    }
+    manifest['segments'] = [s for s in manifest['segments'] if s['month'] != month] + [entry]
+    return entry
+
+
+def _cutoff_month(today, hot_months):
+    """Primer mes (YYYY-MM) que se mantiene en la tabla viva"""
+    month_index = today.year * 12 + (today.month - 1) - (hot_months - 1)
+    return f"{month_index // 12:04d}-{month_index % 12 + 1:02d}"
+
+
+def archive_movements(db, hot_months=HOT_MONTHS, today=None):
+    """
+    Mueve los meses antiguos de inventory_movements a segmentos comprimidos
+
+    Para cada mes anterior al corte:
+    1. Escribe el segmento comprimido y actualiza el manifiesto
+    2. Guarda los totales por producto en movement_archive_rollups
+    3. Borra las filas del mes de la tabla viva (en la misma transacción que el paso 2)
+
+    Args:
+        db: Conexión a la base de datos principal (db.Database)
+        hot_months (int): Meses que se conservan en la tabla viva
+        today (date, optional): Fecha de referencia (por defecto, hoy)
+
+    Returns:
+        list: Entradas del manifiesto de los segmentos escritos
+    """
+    cutoff = _cutoff_month(today or date.today(), max(1, hot_months))
+    months = [row[0] for row in db.query(f"""
+        SELECT DISTINCT {db.dialect.month_key('created_at')} FROM inventory_movements
+        WHERE created_at < ?
+        ORDER BY 1
+    """, (cutoff + '-01',))]
+
+    manifest = load_manifest()
+    written = []
+    for month in months:
+        month_start, month_end = _month_bounds(month)
+        rows = db.query("""
+            SELECT * FROM inventory_movements
+            WHERE created_at >= ? AND created_at < ?
+            ORDER BY id
+        """, (month_start, month_end))
+        if not rows:
+            continue
+        columns = list(rows[0].keys())
+
+        written.append(_write_segment(month, columns, rows, manifest))
+        _save_manifest(manifest)
+
+        # Totales por producto del mes: los reportes agregados leen esta tabla
+        # en lugar de descomprimir segmentos
+        db.execute("""
+            INSERT INTO movement_archive_rollups (month, product_id, movement_count, total_moved)
+            SELECT ?, product_id, COUNT(*), SUM(ABS(quantity_change))
+            FROM inventory_movements
+            WHERE created_at >= ? AND created_at < ?
+            GROUP BY product_id
+            ON CONFLICT(month, product_id) DO UPDATE SET
+                movement_count = movement_archive_rollups.movement_count + excluded.movement_count,
+                total_moved = movement_archive_rollups.total_moved + excluded.total_moved
+        """, (month, month_start, month_end))
+        db.execute("DELETE FROM inventory_movements WHERE created_at >= ? AND created_at < ?",
+                   (month_start, month_end))
+        db.commit()
+
+    return written
+
+
+def _month_bounds(month):
+    """Devuelve ('YYYY-MM-01', primer día del mes siguiente) para comparar created_at"""
+    year, mon = int(month[:4]), int(month[5:7])
+    next_year, next_mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{month}-01", f"{next_year:04d}-{next_mon:02d}-01"
+
+
+def segments_for_range(date_from=None, date_to=None):
+    """
+    Segmentos del manifiesto cuyo rango de fechas se solapa con [date_from, date_to]
+
+    Args:
+        date_from (str, optional): Fecha inicial YYYY-MM-DD (vacía = sin límite)
+        date_to (str, optional): Fecha final YYYY-MM-DD (vacía = sin límite)
+    """
+    segments = []
+    for segment in load_manifest()['segments']:
+        if date_to and segment['min_created_at'][:10] > date_to:
+            continue
+        if date_from and segment['max_created_at'][:10] < date_from:
+            continue
+        segments.append(segment)
+    return segments
+
+
+def movement_source(db, date_from=None, date_to=None):
+    """
+    Devuelve la tabla o vista a usar en FROM para consultar movimientos en un rango
+
+    - Si ningún segmento archivado se solapa con el rango: 'inventory_movements'
+      (la consulta no paga ningún costo extra)
+    - Si hay segmentos solapados: carga solo esos segmentos (y solo las filas del rango)
+      en una tabla temporal de la conexión y devuelve una vista temporal que une
+      la tabla viva con la archivada
+
+    Los objetos temporales viven solo en esta conexión y desaparecen al cerrarla. Si la
+    conexión es de un standby de PostgreSQL (de solo lectura), se pasa antes al primario.
+    Los nombres temporales ocultan a los permanentes tanto en SQLite como en
+    PostgreSQL, por eso no llevan prefijo de esquema.
+
+    Args:
+        db: Conexión donde se ejecutará la consulta (db.Database)
+        date_from (str, optional): Fecha inicial YYYY-MM-DD
+        date_to (str, optional): Fecha final YYYY-MM-DD
+
+    Returns:
+        str: Nombre de la tabla/vista para usar en la cláusula FROM
+    """
+    segments = segments_for_range(date_from, date_to)
+    if not segments:
+        return 'inventory_movements'
+
+    # Un standby de PostgreSQL no admite objetos temporales: la lectura sigue en el primario
+    db.use_primary()
+    # Los objetos temporales (y las filas cargadas) son de esta conexión: al cerrarla no
+    # vuelve al pool de db.py, se cierra y desaparecen
+    db.reusable = False
+    db.execute(f"DROP VIEW IF EXISTS {ARCHIVE_TEMP_VIEW}")
+    db.execute(f"DROP TABLE IF EXISTS {ARCHIVE_TEMP_TABLE}")
+    # Copia la estructura actual de la tabla viva (sin filas)
+    db.execute(f"CREATE TEMP TABLE {ARCHIVE_TEMP_TABLE} AS SELECT * FROM inventory_movements WHERE 1=0")
+    live_columns = [d[0] for d in db.execute(f"SELECT * FROM {ARCHIVE_TEMP_TABLE} WHERE 1=0").description]
+
+    for segment in segments:
+        columns, rows = read_segment(segment)
+        created_index = columns.index('created_at')
+        shared = [col for col in live_columns if col in columns]
+        indexes = [columns.index(col) for col in shared]
+        selected = (
+            tuple(row[i] for i in indexes) for row in rows
+            if (not date_from or str(row[created_index])[:10] >= date_from)
+            and (not date_to or str(row[created_index])[:10] <= date_to)
+        )
+        db.executemany(
+            f"INSERT INTO {ARCHIVE_TEMP_TABLE} ({', '.join(shared)}) VALUES ({', '.join('?' * len(shared))})",
+            selected
+        )
+
+    column_list = ', '.join(live_columns)
+    db.execute(f"""
+        CREATE TEMP VIEW {ARCHIVE_TEMP_VIEW} AS
+        SELECT {column_list} FROM inventory_movements
+        UNION ALL
+        SELECT {column_list} FROM {ARCHIVE_TEMP_TABLE}
+    """)
+    return ARCHIVE_TEMP_VIEW
+
+
+# Ejecución como script: python movement_archive.py [--hot-months N]
+# Pensado para programarse (cron, tarea programada) una vez al día o al mes
+if __name__ == "__main__":
+    import argparse
+    from db import get_db
+
+    parser = argparse.ArgumentParser(description="Archiva meses antiguos del historial de movimientos")
+    parser.add_argument('--hot-months', type=int, default=HOT_MONTHS,
+                        help="Meses que se conservan en la tabla viva (por defecto %(default)s)")
+    args = parser.parse_args()
+
+    with get_db() as database:
+        for entry in archive_movements(database, hot_months=args.hot_months):
+            print(f"Segmento {entry['month']}: {entry['rows']} movimientos -> {entry['file']}")
@@ -0,0 +1,428 @@
+# Escritura diferida (write-behind) del historial de movimientos
+#
+# En modo directo, cada cambio de stock abre una conexión, inserta un movimiento y
+# hace commit: un fsync de la base de datos por cada ajuste. En días de conteo físico,
+# con cientos de ajustes por minuto, esos commits individuales se vuelven el cuello
+# de botella.
+#
+# En modo "spool" (MOVEMENT_WRITE_MODE=spool) los movimientos se escriben primero en
+# un archivo local tipo WAL (una línea JSON por movimiento, con fsync antes de
+# responder), y un hilo en segundo plano los vuelca a la base de datos en lotes,
+# dentro de una sola transacción por lote. Los movimientos que se registran dentro de
+# la transacción de un cambio de stock (ajuste rápido, transferencia, escaneos) no pasan
+# por el spool: se insertan en esa transacción y se confirman o revierten con ella.
+#
+# Garantías:
+# - DURABILIDAD: un movimiento aceptado ya está en disco (fsync) aunque el proceso muera
+# - SIN DUPLICADOS: cada lote actualiza en la misma transacción un checkpoint
+#   (movement_spool_checkpoints) con las líneas ya aplicadas de cada archivo
+# - RETRASO ACOTADO: se vuelca cada MOVEMENT_SPOOL_FLUSH_INTERVAL segundos; si el
+#   movimiento pendiente más antiguo supera MOVEMENT_SPOOL_MAX_LAG, el propio
+#   request que escribe fuerza el volcado
+# - VOLCADO AL APAGAR: atexit vacía el spool antes de que el proceso termine
+# - RECUPERACIÓN: los archivos que dejó un proceso muerto los aplica el siguiente
+#   proceso que arranque el spool
+#
+# Cada proceso (worker de gunicorn) escribe en sus propios archivos, así que no hay
+# bloqueos entre procesos al escribir. Mientras un archivo no se aplicó, el proceso que
+# lo escribió (o que lo está recuperando) lo mantiene abierto con un bloqueo de fcntl:
+# un archivo sin bloqueo es de un proceso que murió. No alcanza con mirar si el pid del
+# nombre sigue vivo: tras reiniciar un contenedor los workers vuelven a tener los
+# mismos pids y los archivos del worker caído parecerían de un proceso vivo.
+import os
+import json
+import time
+import glob
+import atexit
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: solo hay un proceso en desarrollo (se usa el pid del nombre)
+
+from db import get_db
+from locations import MAIN_LOCATION_ID
+
+# Configuración por variables de entorno
+WRITE_MODE = os.environ.get('MOVEMENT_WRITE_MODE', 'direct').lower()   # 'direct' o 'spool'
+SPOOL_DIR = os.environ.get('MOVEMENT_SPOOL_DIR', 'data/spool')
+FLUSH_INTERVAL = float(os.environ.get('MOVEMENT_SPOOL_FLUSH_INTERVAL', '1.0'))  # segundos
+MAX_BATCH = int(os.environ.get('MOVEMENT_SPOOL_MAX_BATCH', '500'))     # movimientos por transacción
+MAX_LAG = float(os.environ.get('MOVEMENT_SPOOL_MAX_LAG', '5.0'))       # segundos de retraso máximo
+
+# Columnas que se guardan en cada línea del spool (mismo orden que el INSERT)
+MOVEMENT_FIELDS = (
+    'product_id', 'product_name', 'movement_type', 'quantity_before', 'quantity_after',
+    'quantity_change', 'reason', 'user_id', 'username', 'created_at',
+    'location_id', 'location_delta',
+)
+
+
+def _spooled_row(values):
+    """
+    Fila lista para insertar a partir de una línea del spool
+
+    Las líneas escritas antes de existir las ubicaciones no traen location_id ni
+    location_delta: esos movimientos ocurrieron en la ubicación principal.
+    """
+    if len(values) < len(MOVEMENT_FIELDS):
+        values = values + [MAIN_LOCATION_ID, values[MOVEMENT_FIELDS.index('quantity_change')]]
+    return tuple(values)
+
+
+def enabled():
+    """Indica si los movimientos deben pasar por el spool en lugar de insertarse directamente"""
+    return WRITE_MODE == 'spool'
+
+
+def utc_timestamp():
+    """
+    Timestamp actual en el mismo formato que CURRENT_TIMESTAMP de SQLite (UTC)
+
+    En modo spool el movimiento se inserta más tarde, así que la fecha se fija
+    en el momento en que ocurrió el cambio y no en el momento del volcado.
+    """
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _try_lock(f):
+    """Bloqueo exclusivo sin esperar sobre un archivo abierto (True si se obtuvo)"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def _segment_name(path):
+    """Nombre del archivo original (movements-...log), aunque se haya renombrado al recuperarlo"""
+    name = os.path.basename(path)
+    return name[:name.index('.log') + len('.log')]
+
+
+def _pid_alive(pid):
+    """Comprueba si un proceso sigue vivo (señal 0 no envía nada, solo verifica)"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MovementSpool:
+    """
+    Spool de movimientos de un proceso: archivo de escritura + hilo de volcado
+
+    Los archivos se nombran movements-<pid>-<inicio>-<secuencia>.log; al volcar,
+    se empieza un archivo nuevo, así las escrituras nunca esperan a que termine una
+    transacción. Cada archivo sigue abierto y bloqueado (self._held) hasta que se
+    aplica y se borra.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR, flush_interval=FLUSH_INTERVAL,
+                 max_batch=MAX_BATCH, max_lag=MAX_LAG):
+        self.spool_dir = spool_dir
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_lag = max_lag
+        self._pid = None
+        self._write_lock = threading.Lock()   # Protege el archivo actual
+        self._flush_lock = threading.Lock()   # Un solo volcado a la vez por proceso
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._atexit_registered = False
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self._file = None
+        self._path = None
+        self._held = {}               # Archivo -> manejador abierto con el bloqueo de fcntl
+        self._sequence = 0
+        self._ready = []              # Archivos cerrados pendientes de volcar
+        self._pending = 0
+        self._oldest_pending = None
+        self.flushed_records = 0
+        self.flushed_batches = 0
+        self.flush_errors = 0
+        self.recovered_segments = 0
+        self.last_flush_duration = 0.0
+        self.last_flush_at = None
+
+    # --- Ciclo de vida ---------------------------------------------------
+
+    def _ensure_started(self):
+        """
+        Arranca el spool en este proceso la primera vez que se usa
+
+        Se comprueba el pid porque gunicorn crea los workers con fork(): un hilo
+        arrancado en el proceso padre no existe en los hijos.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._write_lock:
+            if self._pid == os.getpid():
+                return
+            # Proceso hijo: los archivos heredados del padre son suyos; cerrar las copias
+            # evita que sus bloqueos sigan tomados si el padre muere
+            for handle in self._held.values():
+                handle.close()
+            self._pid = os.getpid()
+            self._started_at = time.time_ns()
+            self._reset_counters()
+            self._stopping.clear()
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._open_next_file()
+            self._thread = threading.Thread(target=self._run, name='movement-spool', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+        self._recover_orphans()
+
+    def _own_prefix(self):
+        # pid e inicio: un proceso nuevo con el mismo pid no toma los archivos del anterior
+        return f"movements-{self._pid}-{self._started_at}-"
+
+    def _open_next_file(self):
+        while True:
+            self._sequence += 1
+            self._path = os.path.join(self.spool_dir, f"{self._own_prefix()}{self._sequence:06d}.log")
+            self._file = open(self._path, 'ab')
+            # Otro proceso que arrancaba pudo tomar el archivo recién creado (todavía sin
+            # bloqueo) como huérfano: en ese caso se sigue con el siguiente
+            if _try_lock(self._file):
+                self._held[self._path] = self._file
+                return
+            self._file.close()
+
+    def close(self):
+        """Detiene el hilo y vuelca todo lo pendiente (se llama automáticamente al salir)"""
+        if self._pid != os.getpid() or self._file is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout=self.flush_interval * 2 + 5)
+        self.flush()
+        with self._write_lock:
+            # El archivo actual quedó vacío tras el último volcado
+            if os.path.getsize(self._path) == 0:
+                os.remove(self._path)
+            # Cerrar los archivos libera sus bloqueos: lo que no se pudo aplicar lo
+            # recupera el siguiente proceso
+            for handle in self._held.values():
+                handle.close()
+            self._held = {}
+            self._file = None
+            self._pid = None   # Un append posterior volvería a arrancar el spool
+
+    def _run(self):
+        """Hilo de volcado: espera el intervalo (o un aviso) y vuelca"""
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Los archivos siguen en disco: se reintentará en la siguiente vuelta
+                self.flush_errors += 1
+                print(f"Error al volcar el spool de movimientos: {e}")
+
+    # --- Escritura -------------------------------------------------------
+
+    def append(self, record):
+        """
+        Agrega un movimiento al spool de forma durable
+
+        Args:
+            record (dict): Movimiento con las claves de MOVEMENT_FIELDS
+        """
+        self._ensure_started()
+        line = json.dumps([record.get(field) for field in MOVEMENT_FIELDS], ensure_ascii=False)
+        with self._write_lock:
+            self._file.write(line.encode('utf-8') + b'\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())   # El movimiento queda en disco antes de responder
+            self._pending += 1
+            if self._oldest_pending is None:
+                self._oldest_pending = time.time()
+            pending = self._pending
+            lag = time.time() - self._oldest_pending
+
+        if lag > self.max_lag:
+            # El hilo no está dando abasto (o está bloqueado): volcar aquí mismo
+            self.flush()
+        elif pending >= self.max_batch:
+            self._wakeup.set()
+
+    # --- Volcado ---------------------------------------------------------
+
+    def flush(self):
+        """
+        Vuelca a la base de datos todos los movimientos escritos hasta ahora
+
+        Returns:
+            int: Movimientos insertados
+        """
+        if self._pid != os.getpid():
+            return 0
+        with self._flush_lock:
+            with self._write_lock:
+                if self._pending:
+                    # Rotar: el archivo actual pasa a la cola (abierto y bloqueado) y se abre uno nuevo
+                    self._ready.append(self._path)
+                    self._open_next_file()
+                    self._pending = 0
+                    self._oldest_pending = None
+                ready, self._ready = self._ready, []
+
+            started = time.perf_counter()
+            inserted = 0
+            try:
+                while ready:
+                    inserted += self._apply_segment(ready[0])
+                    with self._write_lock:
+                        handle = self._held.pop(ready[0], None)
+                    if handle is not None:
+                        handle.close()
+                    ready.pop(0)
+            finally:
+                if ready:
+                    # Error a mitad de camino: los archivos restantes vuelven a la cola
+                    with self._write_lock:
+                        self._ready = ready + self._ready
+            if inserted:
+                self.flushed_records += inserted
+                self.last_flush_duration = time.perf_counter() - started
+                self.last_flush_at = time.time()
+            return inserted
+
+    def _apply_segment(self, path):
+        """
+        Inserta en lotes los movimientos de un archivo del spool y luego lo elimina
+
+        Cada lote es una transacción que incluye la actualización del checkpoint,
+        así que si el proceso muere a mitad de camino, al reintentar se continúa
+        desde la última línea confirmada sin duplicar movimientos.
+        """
+        segment = _segment_name(path)
+        with open(path, 'rb') as f:
+            raw_lines = f.read().split(b'\n')
+        # La última línea sin '\n' es una escritura interrumpida: nunca se confirmó al cliente
+        rows = [_spooled_row(json.loads(line)) for line in raw_lines[:-1] if line.strip()]
+
+        db = get_db()
+        inserted = 0
+        try:
+            applied = db.scalar("SELECT lines_applied FROM movement_spool_checkpoints WHERE segment = ?",
+                                (segment,)) or 0
+
+            while applied < len(rows):
+                batch = rows[applied:applied + self.max_batch]
+                db.executemany(f"""
+                    INSERT INTO inventory_movements ({', '.join(MOVEMENT_FIELDS)})
+                    VALUES ({', '.join('?' * len(MOVEMENT_FIELDS))})
+                """, batch)
+                applied += len(batch)
+                updated = db.execute("UPDATE movement_spool_checkpoints SET lines_applied = ? WHERE segment = ?",
+                                     (applied, segment))
+                if updated.rowcount == 0:
+                    db.execute("INSERT INTO movement_spool_checkpoints (segment, lines_applied) VALUES (?, ?)",
+                               (segment, applied))
+                db.commit()   # Lote + checkpoint en una sola transacción
+                inserted += len(batch)
+                self.flushed_batches += 1
+
+            os.remove(path)
+            db.execute("DELETE FROM movement_spool_checkpoints WHERE segment = ?", (segment,))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        return inserted
+
+    def _recover_orphans(self):
+        """
+        Aplica los archivos que dejaron procesos que ya no existen
+
+        Un archivo es huérfano si nadie tiene su bloqueo de fcntl (el proceso que lo
+        escribía o lo recuperaba murió y el sistema liberó el bloqueo). Se toma el bloqueo
+        y, con él, se renombra con os.replace (operación atómica) a un nombre propio de
+        este proceso: si dos procesos intentan recuperar el mismo archivo, solo uno lo
+        consigue. Lo mismo vale para un .recovering de un proceso que murió recuperando.
+        """
+        pattern = os.path.join(self.spool_dir, 'movements-*.log*')
+        for path in sorted(glob.glob(pattern)):
+            name = os.path.basename(path)
+            if name.startswith(self._own_prefix()) or path in self._held:
+                continue
+            if fcntl is None:
+                # Sin fcntl (Windows, un solo proceso): el pid del nombre decide
+                try:
+                    owner = int(name.split('-')[1])
+                except (IndexError, ValueError):
+                    continue
+                if owner == self._pid or _pid_alive(owner):
+                    continue
+            try:
+                handle = open(path, 'rb')
+            except FileNotFoundError:
+                continue   # Otro proceso lo reclamó primero
+            if not _try_lock(handle):
+                handle.close()   # Lo está escribiendo o recuperando un proceso vivo
+                continue
+            claimed = os.path.join(self.spool_dir, f"{_segment_name(path)}.recovering-{self._pid}-{self._started_at}")
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                # Otro proceso lo recuperó (y borró) entre el glob y el bloqueo
+                handle.close()
+                continue
+            with self._write_lock:
+                self._held[claimed] = handle
+                self._ready.append(claimed)
+            self.recovered_segments += 1
+        if self._ready:
+            self._wakeup.set()
+
+    # --- Métricas --------------------------------------------------------
+
+    def stats(self):
+        """
+        Métricas del spool de este proceso
+
+        Returns:
+            dict: Pendientes, retraso del más antiguo, totales volcados y errores
+        """
+        with self._write_lock:
+            pending = self._pending
+            oldest = self._oldest_pending
+            queued_segments = len(self._ready)
+        return {
+            'mode': WRITE_MODE,
+            'pid': os.getpid(),
+            'pending_records': pending,
+            'queued_segments': queued_segments,
+            'oldest_pending_age_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+            'flushed_records_total': self.flushed_records,
+            'flushed_batches_total': self.flushed_batches,
+            'flush_errors_total': self.flush_errors,
+            'recovered_segments_total': self.recovered_segments,
+            'last_flush_duration_seconds': round(self.last_flush_duration, 6),
+            'last_flush_at': self.last_flush_at,
+            'flush_interval_seconds': self.flush_interval,
+            'max_lag_seconds': self.max_lag,
+        }
+
+
+# Instancia única por proceso (se arranca en el primer append)
+spool = MovementSpool()
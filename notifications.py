@@ -0,0 +1,374 @@
+# Notificaciones de alertas de stock (bandeja de salida + envío por lotes)
+#
+# Cuando un producto se queda sin stock, hasta ahora alguien tenía que verlo en el
+# dashboard. Ahora cada cambio de estado de alerta (ver stock_alerts.py) deja una fila
+# en la tabla notification_outbox. La escriben los mismos triggers que actualizan
+# stock_alerts, así que queda en la MISMA transacción que el cambio de stock: si el
+# cambio se confirma, la notificación existe; si se deshace, tampoco queda.
+#
+# Enviar correos o llamar a un webhook desde la petición haría esperar al usuario (y
+# fallaría la petición si el servidor de correo no responde). Por eso el envío lo hace
+# un hilo en segundo plano cada NOTIFY_INTERVAL segundos:
+#
+# 1. Lee las filas pendientes de la bandeja
+# 2. Agrupa por producto: varios cambios en la misma ventana son UNA notificación con
+#    el estado final (normal -> warning -> critical = "critical"); si el producto
+#    volvió al estado de partida (normal -> critical -> normal) no se avisa
+# 3. Descarta los avisos repetidos: si el último aviso enviado del producto en las
+#    últimas NOTIFY_DEDUP_WINDOW horas ya era ese mismo estado
+# 4. Envía el lote a cada destino (sink) configurado en NOTIFY_SINKS:
+#       file     una línea JSON por notificación en NOTIFY_FILE
+#       webhook  POST JSON a NOTIFY_WEBHOOK_URL (ej: un servidor de prueba local)
+#       smtp     un correo por lote (NOTIFY_SMTP_HOST, por defecto localhost:1025, un
+#                servidor de prueba como "python -m aiosmtpd -n" o MailHog)
+# 5. Marca las filas como enviadas; si un destino falla quedan pendientes y se
+#    reintentan (hasta NOTIFY_MAX_ATTEMPTS veces)
+#
+# Con varios workers de gunicorn, cada uno tiene su hilo, pero un bloqueo de archivo
+# (fcntl) garantiza que solo uno envía a la vez. La entrega es "al menos una vez": si un
+# destino falla después de que otro ya recibió el lote, el reintento repite el envío.
+#
+# Para enviar en el momento (ej: desde cron, o con NOTIFY_INTERVAL=0 para no usar hilo):
+#     flask --app wsgi dispatch-notifications
+import os
+import json
+import time
+import atexit
+import smtplib
+import threading
+import urllib.request
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: solo hay un proceso en desarrollo, basta el bloqueo entre hilos
+
+from db import get_db
+import metrics
+
+# Destinos separados por comas (vacío desactiva el envío; las filas quedan en la bandeja)
+NOTIFY_SINKS = [name.strip() for name in os.environ.get('NOTIFY_SINKS', 'file').split(',') if name.strip()]
+NOTIFY_INTERVAL = float(os.environ.get('NOTIFY_INTERVAL', '30'))            # segundos entre envíos
+NOTIFY_DEDUP_WINDOW = float(os.environ.get('NOTIFY_DEDUP_WINDOW', '1'))     # horas
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', '500'))         # filas por vuelta
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', '10'))
+NOTIFY_LOCK_FILE = os.environ.get('NOTIFY_LOCK_FILE', 'data/notifications.lock')
+
+NOTIFY_FILE = os.environ.get('NOTIFY_FILE', 'data/logs/notifications.log')
+NOTIFY_WEBHOOK_URL = os.environ.get('NOTIFY_WEBHOOK_URL', 'http://127.0.0.1:8025/notifications')
+NOTIFY_SMTP_HOST = os.environ.get('NOTIFY_SMTP_HOST', 'localhost')
+NOTIFY_SMTP_PORT = int(os.environ.get('NOTIFY_SMTP_PORT', '1025'))
+NOTIFY_EMAIL_FROM = os.environ.get('NOTIFY_EMAIL_FROM', 'inventario@localhost')
+NOTIFY_EMAIL_TO = os.environ.get('NOTIFY_EMAIL_TO', 'almacen@localhost')
+# Tiempo máximo de espera de un destino remoto (webhook, SMTP), en segundos
+NOTIFY_TIMEOUT = float(os.environ.get('NOTIFY_TIMEOUT', '10'))
+
+STATE_LABELS = {'critical': 'SIN STOCK', 'warning': 'Stock bajo', 'normal': 'Stock normal'}
+
+
+# --- Destinos -----------------------------------------------------------------
+# Cada destino recibe la lista completa del lote: send(notifications)
+# Cada notificación es un dict con product_id, name, sku, state, previous_state,
+# quantity, stock_min, changed_at y events (cambios agrupados)
+
+class FileSink:
+    """Agrega una línea JSON por notificación a un archivo"""
+
+    def __init__(self, path=NOTIFY_FILE):
+        self.path = path
+
+    def send(self, notifications):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for notification in notifications:
+                f.write(json.dumps(notification, ensure_ascii=False, default=str) + '\n')
+
+
+class WebhookSink:
+    """Envía el lote como JSON en un POST: {"notifications": [...]}"""
+
+    def __init__(self, url=NOTIFY_WEBHOOK_URL, timeout=NOTIFY_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, notifications):
+        body = json.dumps({'notifications': notifications}, ensure_ascii=False, default=str).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        # urlopen lanza HTTPError con respuestas 4xx/5xx: el lote queda pendiente
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class SmtpSink:
+    """Envía un correo de texto con todas las notificaciones del lote"""
+
+    def __init__(self, host=NOTIFY_SMTP_HOST, port=NOTIFY_SMTP_PORT, sender=NOTIFY_EMAIL_FROM,
+                 recipients=NOTIFY_EMAIL_TO, timeout=NOTIFY_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = [address.strip() for address in recipients.split(',') if address.strip()]
+        self.timeout = timeout
+
+    def send(self, notifications):
+        critical = sum(1 for notification in notifications if notification['state'] == 'critical')
+        message = EmailMessage()
+        message['Subject'] = (f"Inventario: {len(notifications)} alertas de stock"
+                              + (f" ({critical} sin stock)" if critical else ''))
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message.set_content('\n'.join(format_notification(notification) for notification in notifications))
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+
+# Destinos disponibles por nombre (NOTIFY_SINKS); se pueden agregar otros con register_sink
+SINKS = {
+    'file': FileSink,
+    'webhook': WebhookSink,
+    'smtp': SmtpSink,
+}
+
+
+def register_sink(name, sink_class):
+    """Registra un destino nuevo (clase con método send(notifications))"""
+    SINKS[name] = sink_class
+
+
+def format_notification(notification):
+    """Línea de texto legible de una notificación"""
+    label = STATE_LABELS.get(notification['state'], notification['state'])
+    previous = STATE_LABELS.get(notification['previous_state'] or 'normal', notification['previous_state'])
+    sku = f" [{notification['sku']}]" if notification['sku'] else ''
+    return (f"{label}: {notification['name']}{sku} - cantidad {notification['quantity']}, "
+            f"mínimo {notification['stock_min']} (antes: {previous}, {notification['changed_at']})")
+
+
+# --- Envío ----------------------------------------------------------------------
+
+class _DispatchLock:
+    """Bloqueo entre hilos y, con fcntl, entre procesos (workers de gunicorn)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        """Intenta tomar el bloqueo sin esperar; False si otro hilo/proceso está enviando"""
+        if not self._thread_lock.acquire(blocking=False):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            return False
+
+    def release(self):
+        if self._file is not None:
+            # Cerrar el archivo libera el bloqueo de fcntl
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+_dispatch_lock = _DispatchLock(NOTIFY_LOCK_FILE)
+
+
+def _utc(hours_ago):
+    """Timestamp UTC de hace N horas, en el formato de CURRENT_TIMESTAMP"""
+    return (datetime.utcnow() - timedelta(hours=hours_ago)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _in_clause(values):
+    return ', '.join('?' for _ in values)
+
+
+def _collect(db):
+    """
+    Lee las filas pendientes y las agrupa por producto
+
+    Returns:
+        tuple: (notificaciones a enviar, ids de sus filas, ids de filas que no hace falta enviar)
+    """
+    rows = db.query("""
+        SELECT id, product_id, state, previous_state, created_at
+        FROM notification_outbox
+        WHERE status = 'pending'
+        ORDER BY id
+        LIMIT ?
+    """, (NOTIFY_BATCH_SIZE,))
+    if not rows:
+        return [], [], []
+
+    groups = {}
+    for row in rows:
+        group = groups.get(row['product_id'])
+        if group is None:
+            # El estado de partida es el anterior al primer cambio pendiente
+            groups[row['product_id']] = {'previous_state': row['previous_state'] or 'normal',
+                                         'state': row['state'], 'changed_at': row['created_at'],
+                                         'ids': [row['id']]}
+        else:
+            group['state'] = row['state']
+            group['changed_at'] = row['created_at']
+            group['ids'].append(row['id'])
+
+    product_ids = list(groups)
+    # Último aviso enviado de cada producto dentro de la ventana de repetición
+    last_sent = {}
+    for row in db.query(f"""
+        SELECT product_id, state FROM notification_outbox
+        WHERE status = 'sent' AND delivered_at >= ? AND product_id IN ({_in_clause(product_ids)})
+        ORDER BY id
+    """, [_utc(NOTIFY_DEDUP_WINDOW)] + product_ids):
+        last_sent[row['product_id']] = row['state']
+    products = {row['id']: row for row in db.query(f"""
+        SELECT id, name, sku, quantity, stock_min FROM products WHERE id IN ({_in_clause(product_ids)})
+    """, product_ids)}
+
+    notifications, delivered_ids, skipped_ids = [], [], []
+    for product_id, group in groups.items():
+        product = products.get(product_id)
+        if (product is None                                              # Producto eliminado
+                or group['state'] == group['previous_state']             # Volvió al estado de partida
+                or last_sent.get(product_id) == group['state']):         # Ya se avisó hace poco
+            skipped_ids.extend(group['ids'])
+            continue
+        notifications.append({
+            'product_id': product_id,
+            'name': product['name'],
+            'sku': product['sku'],
+            'state': group['state'],
+            'previous_state': group['previous_state'],
+            'quantity': product['quantity'],
+            'stock_min': product['stock_min'],
+            'changed_at': str(group['changed_at']),
+            'events': len(group['ids']),
+        })
+        delivered_ids.extend(group['ids'])
+    return notifications, delivered_ids, skipped_ids
+
+
+def _mark(db, ids, sql, params=()):
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        db.execute(f"{sql} WHERE id IN ({_in_clause(chunk)})", list(params) + chunk)
+
+
+def dispatch(sinks=None):
+    """
+    Envía una vuelta de notificaciones pendientes
+
+    Las consultas van en transacciones cortas: la base no queda bloqueada mientras se
+    espera a un servidor de correo o webhook.
+
+    Returns:
+        int: Notificaciones enviadas (None si otro proceso estaba enviando)
+    """
+    if sinks is None:
+        sinks = [(name, SINKS[name]()) for name in NOTIFY_SINKS]
+    if not sinks or not _dispatch_lock.acquire():
+        return None
+    try:
+        with get_db() as db:
+            notifications, delivered_ids, skipped_ids = _collect(db)
+            db.rollback()  # Fin de la lectura (PostgreSQL deja abierta la transacción)
+            if skipped_ids:
+                _mark(db, skipped_ids, "UPDATE notification_outbox SET status = 'skipped', delivered_at = CURRENT_TIMESTAMP")
+                db.commit()
+            if not notifications:
+                return 0
+
+            errors = []
+            for name, sink in sinks:
+                try:
+                    sink.send(notifications)
+                    metrics.NOTIFICATIONS.inc(len(notifications), sink=name, result='sent')
+                except Exception as e:
+                    metrics.NOTIFICATIONS.inc(len(notifications), sink=name, result='error')
+                    errors.append(f"{name}: {e}")
+
+            if errors:
+                error = '; '.join(errors)[:500]
+                print(f"AVISO: No se pudieron enviar {len(notifications)} notificaciones: {error}")
+                _mark(db, delivered_ids, f"""
+                    UPDATE notification_outbox
+                    SET attempts = attempts + 1, last_error = ?,
+                        status = CASE WHEN attempts + 1 >= {NOTIFY_MAX_ATTEMPTS} THEN 'failed' ELSE 'pending' END
+                """, (error,))
+                db.commit()
+                return 0
+            _mark(db, delivered_ids, "UPDATE notification_outbox SET status = 'sent', delivered_at = CURRENT_TIMESTAMP")
+            db.commit()
+            return len(notifications)
+    finally:
+        _dispatch_lock.release()
+
+
+def _dispatch_loop():
+    while True:
+        time.sleep(NOTIFY_INTERVAL)
+        try:
+            dispatch()
+        except Exception as e:
+            # Las filas siguen pendientes: se reintentará en la siguiente vuelta
+            print(f"Error al enviar notificaciones: {e}")
+
+
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def _start_dispatcher():
+    """
+    Inicia (una vez por proceso) el hilo de envío
+
+    Igual que en metrics.py, se llama en la primera petición y no al importar
+    (con gunicorn --preload los hilos del proceso maestro no pasan a los workers).
+    """
+    global _dispatcher_pid
+    if _dispatcher_pid == os.getpid():
+        return
+    with _dispatcher_lock:
+        if _dispatcher_pid == os.getpid():
+            return
+        _dispatcher_pid = os.getpid()
+    threading.Thread(target=_dispatch_loop, name='notifications', daemon=True).start()
+    atexit.register(_dispatch_at_exit)
+
+
+def _dispatch_at_exit():
+    try:
+        dispatch()
+    except Exception as e:
+        print(f"Error al enviar notificaciones: {e}")
+
+
+def dispatch_command():
+    """Envía ahora las notificaciones de stock pendientes"""
+    sent = dispatch()
+    if sent is None:
+        print("Otro proceso está enviando notificaciones (o NOTIFY_SINKS está vacío)")
+    else:
+        print(f"Notificaciones enviadas: {sent}")
+    with get_db() as db:
+        for row in db.query("SELECT status, COUNT(*) AS total FROM notification_outbox GROUP BY status ORDER BY status"):
+            print(f"  {row['status']}: {row['total']}")
+
+
+def init_app(app):
+    """Arranca el hilo de envío en la primera petición de cada proceso"""
+    if NOTIFY_SINKS and NOTIFY_INTERVAL > 0:
+        app.before_request(_start_dispatcher)
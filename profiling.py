@@ -0,0 +1,189 @@
+# Perfilado bajo demanda de peticiones reales (solo administradores)
+#
+# Cuando un reporte es lento en producción, no siempre se puede reproducir en local
+# sin los datos de producción. Un administrador puede perfilar una petición concreta
+# agregando ?_profile=1 a la URL (o la cabecera X-Profile: 1):
+#
+# - _profile=1 (o cprofile): cProfile mide todas las llamadas a funciones (.pstats) y,
+#   en paralelo, un muestreador guarda las pilas de llamadas (.collapsed)
+# - _profile=sample: solo el muestreador, con mucho menos sobrecosto
+#
+# El muestreador mira cada PROFILE_SAMPLE_INTERVAL segundos en qué función está el
+# hilo de la petición (sys._current_frames) y cuenta cada pila completa. El archivo
+# .collapsed ("pila;de;funciones cantidad" por línea) se puede abrir con speedscope.app
+# o flamegraph.pl para ver el gráfico de llama. El .pstats se analiza con:
+#     python -m pstats data/profiles/<perfil>.pstats
+#
+# Los perfiles se guardan en data/profiles y se listan en /profiles.
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import g, request, session
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'data/profiles')
+# Segundos entre muestras del muestreador
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+# Retención: cantidad máxima de perfiles y antigüedad máxima en días
+PROFILE_MAX_COUNT = int(os.environ.get('PROFILE_MAX_COUNT', '50'))
+PROFILE_MAX_AGE_DAYS = int(os.environ.get('PROFILE_MAX_AGE_DAYS', '7'))
+
+# Extensiones de los archivos de un perfil (el .json tiene los metadatos)
+PROFILE_EXTENSIONS = ('.json', '.pstats', '.collapsed')
+
+
+class StackSampler:
+    """Muestreador de pilas de llamadas de un hilo (perfilador estadístico)"""
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            # Formato "collapsed": de la raíz a la hoja separado por ;
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def _requested_mode():
+    """Modo de perfilado pedido en la petición ('cprofile', 'sample' o None)"""
+    flag = request.args.get('_profile') or request.headers.get('X-Profile')
+    if not flag or flag == '0' or session.get('role') != 'admin':
+        return None
+    return 'sample' if flag == 'sample' else 'cprofile'
+
+
+def _before_request():
+    mode = _requested_mode()
+    if mode is None:
+        return
+    sampler = StackSampler(threading.get_ident())
+    profiler = cProfile.Profile() if mode == 'cprofile' else None
+    g.profile = {'mode': mode, 'sampler': sampler, 'profiler': profiler, 'started': time.perf_counter()}
+    sampler.start()
+    if profiler:
+        profiler.enable()
+
+
+def _after_request(response):
+    # La respuesta lleva el id del perfil; se guarda en teardown (también si hubo error)
+    if 'profile' in g:
+        g.profile['id'] = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint or 'other'}"
+        g.profile['status'] = response.status_code
+        response.headers['X-Profile-Id'] = g.profile['id']
+    return response
+
+
+def _teardown_request(exc):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    if profile['profiler']:
+        profile['profiler'].disable()
+    profile['sampler'].stop()
+    duration = time.perf_counter() - profile['started']
+    profile_id = profile.get('id') or f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint or 'other'}"
+    try:
+        save_profile(profile_id, profile, duration, status=profile.get('status', 500))
+        prune_profiles()
+    except OSError as e:
+        print(f"AVISO: No se pudo guardar el perfil {profile_id}: {e}")
+
+
+def save_profile(profile_id, profile, duration, status):
+    """Guarda los archivos del perfil (.pstats, .collapsed y metadatos .json)"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, profile_id)
+    summary = ''
+    if profile['profiler']:
+        profile['profiler'].dump_stats(base + '.pstats')
+        # Resumen: las 25 funciones con más tiempo acumulado
+        output = io.StringIO()
+        pstats.Stats(profile['profiler'], stream=output).sort_stats('cumulative').print_stats(25)
+        summary = output.getvalue()
+    with open(base + '.collapsed', 'w', encoding='utf-8') as f:
+        f.write(profile['sampler'].collapsed())
+    metadata = {
+        'id': profile_id,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': status,
+        'username': session.get('username'),
+        'mode': profile['mode'],
+        'duration_ms': round(duration * 1000, 2),
+        'samples': profile['sampler'].samples,
+        'files': [ext for ext in ('.pstats', '.collapsed') if os.path.exists(base + ext)],
+        'summary': summary,
+    }
+    with open(base + '.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+
+def list_profiles():
+    """Metadatos de los perfiles guardados, del más reciente al más antiguo"""
+    profiles = []
+    try:
+        names = sorted(os.listdir(PROFILE_DIR), reverse=True)
+    except FileNotFoundError:
+        return profiles
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def prune_profiles(max_count=PROFILE_MAX_COUNT, max_age_days=PROFILE_MAX_AGE_DAYS):
+    """Borra los perfiles que superan la cantidad máxima o la antigüedad máxima"""
+    oldest = (datetime.now() - timedelta(days=max_age_days)).strftime('%Y%m%d_%H%M%S')
+    for position, profile in enumerate(list_profiles()):
+        # El id empieza con la fecha: comparar el texto equivale a comparar fechas
+        if position >= max_count or profile['id'] < oldest:
+            for ext in PROFILE_EXTENSIONS:
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, profile['id'] + ext))
+                except FileNotFoundError:
+                    pass
+
+
+def init_app(app):
+    """Activa el perfilado bajo demanda (?_profile=1 o cabecera X-Profile, solo admin)"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
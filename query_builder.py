@@ -0,0 +1,235 @@
+# Consultas canónicas de los reportes y del historial de movimientos
+#
+# Los reportes personalizados y el historial se filtran con una combinación de campos
+# opcionales (categoría, proveedor, fechas, ubicación...). Antes cada vista armaba el SQL
+# concatenando trozos ("WHERE 1=1" + " AND ...") con espacios y saltos de línea distintos
+# en cada copia (generate_custom_report y export_custom_report repetían la misma lógica).
+#
+# Aquí cada reporte se describe una sola vez y el texto SQL se arma siempre igual:
+# - Un texto fijo por combinación de filtros presentes: los VALORES van siempre como
+#   parámetros (?), nunca dentro del texto. Dos peticiones con los mismos filtros
+#   (aunque con otros valores) producen exactamente la misma cadena
+# - Orden fijo de cláusulas y sin "WHERE 1=1" ni espacios sobrantes
+# - El texto de cada combinación se arma una vez y se guarda en una lru_cache
+#
+# Que el texto sea idéntico es lo que permite reutilizar el trabajo de la base: SQLite
+# guarda en cada conexión las sentencias ya compiladas (cached_statements, ver db.py)
+# y las busca por el texto exacto; las traducciones de ? a %s (db.py) también se cachean
+# por texto. Aciertos de cada caché en /metrics (cache="report_sql", "sqlite_statements").
+#
+#     sql, params = build('low_stock', db.dialect, {'category': 'Bebidas'})
+#     rows = db.query(sql, params)
+from functools import lru_cache
+
+import metrics
+from stock_alerts import ALERTED_PRODUCT_IDS
+
+# Columnas de un movimiento para mostrar en pantalla
+# im = tabla/vista de movimientos, d = product_dim (nombre vigente del producto)
+# product_name solo se guarda en las eliminaciones; el resto toma el nombre actual
+MOVEMENT_COLUMNS = (
+    "im.id, im.product_id, COALESCE(d.name, im.product_name) as product_name, "
+    "im.movement_type, im.quantity_before, im.quantity_after, im.quantity_change, "
+    "im.reason, im.user_id, im.username, im.created_at, im.location_id, im.location_delta"
+)
+
+# El nombre y la categoría se toman de product_dim (incluye productos eliminados)
+PRODUCT_DIM_JOIN = "LEFT JOIN product_dim d ON d.product_id = im.product_id"
+
+# Filtros de fecha sobre los movimientos ({date} = fecha sin hora según el dialecto)
+DATE_FILTERS = [
+    ('date_from', "{date} >= ?"),
+    ('date_to', "{date} <= ?"),
+]
+
+# Descripción de cada consulta:
+# - columns / export_columns: lista del SELECT (la exportación CSV puede pedir otras)
+# - source: FROM ({source} = tabla o vista de movimientos, ver movement_archive.py)
+# - joins: JOINs (en el COUNT del historial solo se incluyen si un filtro los usa)
+# - where: condiciones fijas; filters: (campo, condición) que se agregan si el campo
+#   tiene valor. La condición lleva ? si el valor es un parámetro; sin ? (ej: stock_low)
+#   el campo solo activa la condición
+# - group_by, order_by, paginate (LIMIT ? OFFSET ?)
+# - headers: encabezados del CSV exportado
+REPORTS = {
+    'inventory_by_category': {
+        'columns': "category, COUNT(*) as total_products, SUM(quantity) as total_quantity, "
+                   "SUM(quantity * price) as total_value",
+        'source': "products",
+        'filters': [('category', "category = ?")],
+        'group_by': "category",
+        'order_by': "total_value DESC",
+        'headers': ['Categoría', 'Total Productos', 'Total Cantidad', 'Valor Total'],
+    },
+    'low_stock': {
+        'columns': "name, category, quantity, stock_min, provider, (stock_min - quantity) as deficit",
+        'source': "products",
+        'where': [f"id IN ({ALERTED_PRODUCT_IDS})"],
+        'filters': [('category', "category = ?")],
+        'order_by': "deficit DESC",
+        'headers': ['Producto', 'Categoría', 'Cantidad', 'Stock Mínimo', 'Proveedor', 'Déficit'],
+    },
+    'movements_by_period': {
+        'columns': f"{MOVEMENT_COLUMNS}, d.category, im.quantity_change as quantity",
+        'export_columns': "im.created_at, COALESCE(d.name, im.product_name) as product_name, d.category, "
+                          "im.movement_type, im.quantity_change as quantity, im.reason, im.username",
+        'source': "{source} im",
+        'joins': [PRODUCT_DIM_JOIN],
+        'filters': DATE_FILTERS + [
+            ('category', "d.category = ?"),
+            ('location_id', "im.location_id = ?"),
+        ],
+        'order_by': "im.created_at DESC",
+        'headers': ['Fecha', 'Producto', 'Categoría', 'Tipo', 'Cantidad', 'Motivo', 'Usuario'],
+    },
+    'value_by_provider': {
+        'columns': "provider, COUNT(*) as total_products, SUM(quantity) as total_quantity, "
+                   "SUM(quantity * price) as total_value",
+        'source': "products",
+        'filters': [('provider', "provider = ?")],
+        'group_by': "provider",
+        'order_by': "total_value DESC",
+        'headers': ['Proveedor', 'Total Productos', 'Total Cantidad', 'Valor Total'],
+    },
+    'abc_classification': {
+        # La calcula la tarea programada abc_analysis.py; aquí solo se lee y filtra
+        'columns': "p.id, p.name, p.sku, p.category, a.stock_value, a.value_share, a.value_class, "
+                   "a.units_moved, a.velocity_share, a.velocity_class",
+        'source': "abc_classification a",
+        'joins': ["JOIN products p ON p.id = a.product_id"],
+        'filters': [
+            ('value_class', "a.value_class = ?"),
+            ('velocity_class', "a.velocity_class = ?"),
+            ('category', "p.category = ?"),
+        ],
+        'order_by': "a.stock_value DESC, p.id",
+        'headers': ['ID', 'Producto', 'SKU', 'Categoría', 'Valor en Stock', '% Acumulado Valor', 'Clase Valor',
+                    'Unidades Salidas', '% Acumulado Salidas', 'Clase Velocidad'],
+    },
+    'general': {
+        'columns': "*",
+        'export_columns': "name, category, quantity, price, provider, stock_min, created_at",
+        'source': "products p",
+        'filters': [
+            ('category', "p.category = ?"),
+            ('provider', "p.provider = ?"),
+            ('stock_low', f"p.id IN ({ALERTED_PRODUCT_IDS})"),
+            ('stock_high', "p.quantity > p.stock_min * 2"),
+        ],
+        'order_by': "p.name",
+        'headers': ['Producto', 'Categoría', 'Cantidad', 'Precio', 'Proveedor', 'Stock Mínimo', 'Fecha Creación'],
+    },
+    # Reporte general de una ubicación: la cantidad es la de esa ubicación
+    # (índice idx_stock_levels_location)
+    'general_location': {
+        'columns': "p.id, p.name, p.sku, p.category, s.quantity, p.price, p.provider, p.stock_min, p.created_at",
+        'export_columns': "p.name, p.category, s.quantity, p.price, p.provider, p.stock_min, p.created_at",
+        'source': "stock_levels s",
+        'joins': ["JOIN products p ON p.id = s.product_id"],
+        'where': ["s.quantity > 0"],
+        'filters': [
+            ('location_id', "s.location_id = ?"),
+            ('category', "p.category = ?"),
+            ('provider', "p.provider = ?"),
+            ('stock_low', f"p.id IN ({ALERTED_PRODUCT_IDS})"),
+            ('stock_high', "p.quantity > p.stock_min * 2"),
+        ],
+        'order_by': "p.name",
+        'headers': ['Producto', 'Categoría', 'Cantidad', 'Precio', 'Proveedor', 'Stock Mínimo', 'Fecha Creación'],
+    },
+    # Historial paginado de /inventory_movements
+    'movement_history': {
+        'columns': MOVEMENT_COLUMNS,
+        'source': "{source} im",
+        'joins': [PRODUCT_DIM_JOIN],
+        'filters': [
+            ('product', "d.name {like} ?"),
+            ('movement_type', "im.movement_type = ?"),
+            # Resuelto con el índice idx_movements_location (location_id, created_at)
+            ('location_id', "im.location_id = ?"),
+        ] + DATE_FILTERS,
+        'order_by': "im.created_at DESC",
+        'paginate': True,
+    },
+}
+
+
+def report_name(report_type, location_id=None):
+    """Consulta de REPORTS para un tipo de reporte del formulario (None si no tiene consulta SQL)"""
+    if report_type == 'stock_as_of':
+        # No es una consulta SQL directa: foto de stock + movimientos (ver stock_history.py)
+        return None
+    if report_type in ('inventory_by_category', 'low_stock', 'movements_by_period',
+                       'value_by_provider', 'abc_classification'):
+        return report_type
+    # Cualquier otro valor es el reporte general
+    return 'general_location' if location_id else 'general'
+
+
+def _uses(clause, conditions):
+    """Indica si alguna condición usa el alias que introduce el JOIN (ej: 'd.')"""
+    alias = clause.split(' ON ')[0].split()[-1]
+    return any(f"{alias}." in condition for condition in conditions)
+
+
+@lru_cache(maxsize=512)
+def statement(name, dialect, source, present, count=False, export=False):
+    """
+    Texto SQL canónico de una consulta con los filtros presentes
+
+    Args:
+        name (str): Clave de REPORTS
+        dialect: Dialecto de la conexión (db.py)
+        source (str): Tabla o vista de movimientos (solo consultas con {source})
+        present (tuple): Campos de filtro con valor, en el orden de REPORTS[name]['filters']
+        count (bool): SELECT COUNT(*) sin orden ni paginación (total del historial)
+        export (bool): Columnas de la exportación CSV
+
+    Returns:
+        str: Consulta en una sola línea, con ? en el orden de los campos presentes
+    """
+    spec = REPORTS[name]
+    filters = dict(spec['filters'])
+    conditions = list(spec.get('where', [])) + [
+        filters[field].format(date=dialect.to_date('im.created_at'), like=dialect.like)
+        for field in present
+    ]
+    joins = spec.get('joins', [])
+    if count:
+        columns = "COUNT(*)"
+        joins = [join for join in joins if _uses(join, conditions)]
+    elif export:
+        columns = spec.get('export_columns', spec['columns'])
+    else:
+        columns = spec['columns']
+    parts = [f"SELECT {columns} FROM {spec['source'].format(source=source)}"]
+    parts.extend(joins)
+    if conditions:
+        parts.append("WHERE " + " AND ".join(conditions))
+    if not count:
+        if 'group_by' in spec:
+            parts.append(f"GROUP BY {spec['group_by']}")
+        parts.append(f"ORDER BY {spec['order_by']}")
+        if spec.get('paginate'):
+            parts.append("LIMIT ? OFFSET ?")
+    return " ".join(parts)
+
+
+# Aciertos de la caché de textos SQL (ver /metrics)
+metrics.register_lru_cache('report_sql', statement)
+
+
+def build(name, dialect, values, source='inventory_movements', count=False, export=False):
+    """
+    Consulta y parámetros de REPORTS[name] para los valores de filtro recibidos
+
+    Los campos vacíos ('', None, False) no filtran. Con paginate hay que agregar
+    a los parámetros el límite y el desplazamiento.
+
+    Returns:
+        tuple: (consulta SQL, lista de parámetros)
+    """
+    filters = REPORTS[name]['filters']
+    present = tuple(field for field, _ in filters if values.get(field))
+    params = [values[field] for field, condition in filters if field in present and '?' in condition]
+    return statement(name, dialect, source, present, count, export), params
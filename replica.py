@@ -0,0 +1,224 @@
+# Réplica de lectura para reportes, dashboard, historial y exportaciones
+#
+# Esas vistas son casi toda la carga de lectura y compiten con las escrituras de stock en
+# la misma base. get_db(readonly=True) (db.py) las envía a una réplica cuando hay una
+# configurada y está dentro de las cotas de atraso; las escrituras siempre van al primario.
+#
+# - SQLite: REPLICA_PATH es una copia de la base hecha con la API de backup de SQLite
+#   (consistente aunque haya escrituras en curso, ver backup.py). Un hilo la renueva cada
+#   REPLICA_REFRESH_INTERVAL segundos: copia a un archivo temporal y lo reemplaza con
+#   os.replace, así las lecturas en curso terminan con la copia anterior. La fecha de
+#   modificación del archivo es la hora en que EMPEZÓ la copia (los datos que contiene).
+#   "python backup.py create" también deja su copia como réplica: con las copias de
+#   seguridad programadas se puede usar REPLICA_REFRESH_INTERVAL=0.
+# - PostgreSQL: DB_REPLICA_HOST es un standby (replicación en streaming) con las mismas
+#   credenciales que el primario. Su hora es la de la última transacción aplicada (o
+#   "ahora" si ya aplicó todo lo recibido).
+#
+# Cotas:
+# - REPLICA_MAX_LAG: una réplica con más segundos de atraso no se usa (se lee del primario)
+# - Leer lo propio (read-your-writes): cada petición que confirma una escritura guarda la
+#   hora en la sesión; mientras la réplica sea anterior a esa hora, ese usuario lee del
+#   primario. Así, tras un ajuste de stock el historial ya muestra el movimiento.
+#
+# Sin réplica configurada (o con MySQL) todo se lee del primario, como antes.
+#     flask --app wsgi refresh-replica     # renovar la copia ahora (ej: desde cron)
+import os
+import time
+import atexit
+import sqlite3
+import threading
+
+from flask import g, session, has_request_context
+
+import backup
+import metrics
+
+# SQLite: archivo de la copia (vacío = sin réplica)
+REPLICA_PATH = os.environ.get('REPLICA_PATH', '')
+# PostgreSQL: host del standby (vacío = sin réplica)
+REPLICA_HOST = os.environ.get('DB_REPLICA_HOST', '')
+REPLICA_PORT = os.environ.get('DB_REPLICA_PORT', os.environ.get('DB_PORT', '5432'))
+# Segundos de atraso tolerados para una lectura de reportes
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', '300'))
+# Segundos entre copias de la réplica SQLite (0 = sin hilo, solo el comando)
+REPLICA_REFRESH_INTERVAL = float(os.environ.get('REPLICA_REFRESH_INTERVAL', '60'))
+
+# Clave de la sesión con la hora (time.time()) de la última escritura del usuario
+LAST_WRITE_KEY = 'last_write_at'
+
+
+def enabled():
+    """True si hay una réplica configurada"""
+    return bool(REPLICA_PATH or REPLICA_HOST)
+
+
+def snapshot_time(path=None):
+    """Hora de los datos de la copia SQLite (None si todavía no existe)"""
+    try:
+        return os.path.getmtime(path or REPLICA_PATH)
+    except OSError:
+        return None
+
+
+def refresh(path=None):
+    """
+    Copia la base SQLite primaria a la réplica
+
+    Returns:
+        float: Segundos que tardó la copia
+    """
+    path = path or REPLICA_PATH
+    started = time.time()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    # Copia por pasos con pausas (ver backup.py): no frena las escrituras de stock
+    backup.online_backup(temporary)
+    # La copia contiene los datos del momento en que empezó
+    os.utime(temporary, (started, started))
+    os.replace(temporary, path)
+    return time.time() - started
+
+
+def _connect_standby():
+    """Conexión al standby de PostgreSQL y hora hasta la que tiene los datos"""
+    import psycopg2
+    conn = psycopg2.connect(
+        host=REPLICA_HOST,
+        port=REPLICA_PORT,
+        user=os.environ.get('DB_USER', 'postgres'),
+        password=os.environ.get('DB_PASSWORD', ''),
+        dbname=os.environ.get('DB_NAME', 'inventory'),
+    )
+    conn.set_session(readonly=True)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT EXTRACT(EPOCH FROM CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN now()
+            ELSE pg_last_xact_replay_timestamp()
+        END)
+    """)
+    position = cursor.fetchone()[0]
+    # Fuera de una transacción explícita la consulta dejó una abierta: se cierra
+    conn.rollback()
+    return conn, (float(position) if position is not None else None)
+
+
+def last_write():
+    """Hora de la última escritura del usuario de la petición actual (o None)"""
+    if has_request_context():
+        return session.get(LAST_WRITE_KEY)
+    return None
+
+
+def connect():
+    """
+    Conexión a la réplica si está dentro de las cotas, o None para leer del primario
+
+    Cuenta cada decisión en la métrica de lecturas (destino y motivo).
+    """
+    if not enabled():
+        return None
+    conn = None
+    try:
+        if REPLICA_HOST:
+            conn, position = _connect_standby()
+        else:
+            position = snapshot_time()
+    except Exception as e:
+        print(f"Réplica no disponible, se lee del primario: {e}")
+        position = None
+    if position is None:
+        reason = 'unavailable'
+    else:
+        written = last_write()
+        if time.time() - position > REPLICA_MAX_LAG:
+            reason = 'lag'
+        elif written is not None and position < written:
+            reason = 'own_write'
+        else:
+            metrics.DB_READS.inc(target='replica', reason='fresh')
+            if conn is None:
+                # Igual que en database.py: la conexión puede pasar entre hilos en modo ASGI
+                conn = sqlite3.connect(f"file:{REPLICA_PATH}?mode=ro", uri=True, check_same_thread=False)
+            return conn
+    if conn is not None:
+        conn.close()
+    metrics.DB_READS.inc(target='primary', reason=reason)
+    return None
+
+
+def note_commit():
+    """Marca la petición actual como escritura (la llama Database.commit)"""
+    if has_request_context():
+        g.replica_wrote = True
+
+
+def _remember_write(response):
+    # Solo en sesiones de usuario: la API (tokens) no usa la cookie de sesión
+    if g.pop('replica_wrote', False) and 'user_id' in session:
+        session[LAST_WRITE_KEY] = time.time()
+    return response
+
+
+# --- Renovación de la copia SQLite ----------------------------------------------
+
+def refresh_if_due():
+    """Renueva la copia si tiene más de REPLICA_REFRESH_INTERVAL segundos"""
+    position = snapshot_time()
+    if position is not None and time.time() - position < REPLICA_REFRESH_INTERVAL:
+        return None
+    return refresh()
+
+
+def _refresh_loop():
+    while True:
+        # Con varios workers cada uno tiene su hilo: el que llega con la copia ya
+        # renovada por otro no hace nada (y dos copias simultáneas no se pisan)
+        try:
+            refresh_if_due()
+        except Exception as e:
+            print(f"Error al renovar la réplica: {e}")
+        time.sleep(REPLICA_REFRESH_INTERVAL)
+
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def _start_refresher():
+    """Inicia (una vez por proceso) el hilo que renueva la copia, en la primera petición"""
+    global _refresher_pid
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name='replica', daemon=True).start()
+    atexit.register(_remove_temporary)
+
+
+def _remove_temporary():
+    try:
+        os.remove(f"{REPLICA_PATH}.{os.getpid()}.tmp")
+    except OSError:
+        pass
+
+
+def refresh_command():
+    """Renueva ahora la réplica SQLite de lectura"""
+    if not REPLICA_PATH:
+        print("No hay réplica SQLite configurada (REPLICA_PATH)")
+        return
+    seconds = refresh()
+    print(f"Réplica renovada en {seconds:.2f}s: {REPLICA_PATH}")
+
+
+def init_app(app):
+    """Recuerda las escrituras de cada usuario y arranca el hilo de la copia SQLite"""
+    if not enabled():
+        return
+    app.after_request(_remember_write)
+    if REPLICA_PATH and REPLICA_REFRESH_INTERVAL > 0:
+        app.before_request(_start_refresher)
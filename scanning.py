@@ -0,0 +1,173 @@
+# Escaneo de códigos (SKU) con lectores de mano en la recepción de mercancía
+#
+# Cada lectura de un lector es un "+1" (o "-1") de un SKU. Con quick_stock_adjustment
+# cada lectura sería una petición con su consulta por SKU, su UPDATE, su movimiento y
+# el render de una página. Aquí:
+#
+# 1. ÍNDICE DE SKU EN MEMORIA (SkuIndex): diccionario SKU -> id de producto por proceso.
+#    Resolver un SKU es una búsqueda en un dict (microsegundos, sin ir a la base).
+#    Se reconstruye cuando cambia la generación de los datos (tabla data_generation),
+#    que se consulta como mucho cada SCAN_INDEX_MAX_AGE segundos (o de inmediato si
+#    llega un SKU desconocido, por si es un producto recién creado en otro worker).
+#
+# 2. AGRUPACIÓN DE LECTURAS (ScanCoalescer): las lecturas que llegan dentro de una
+#    ventana de SCAN_COALESCE_MS milisegundos se agrupan por producto y usuario, y se
+#    aplican en UNA transacción: un UPDATE y UN movimiento por producto con el total
+#    (ej: 24 lecturas de la misma caja = un movimiento "+24"), en lugar de 24.
+#    Cada lectura recibe su propia confirmación con la cantidad resultante.
+#
+# Un lector puede enviar varias lecturas por petición sin esperar la respuesta de las
+# anteriores (ver POST /api/v1/scan en api.py).
+import os
+import time
+import threading
+
+from db import get_db, current_generation
+
+# Ventana de agrupación de lecturas (milisegundos)
+SCAN_COALESCE_MS = float(os.environ.get('SCAN_COALESCE_MS', '50'))
+# Antigüedad máxima del índice de SKU antes de comprobar la generación (segundos)
+SCAN_INDEX_MAX_AGE = float(os.environ.get('SCAN_INDEX_MAX_AGE', '1.0'))
+# Tiempo máximo que una petición espera la confirmación de sus lecturas (segundos)
+SCAN_ACK_TIMEOUT = float(os.environ.get('SCAN_ACK_TIMEOUT', '10'))
+
+
+def normalize_sku(sku):
+    """Mismo formato con el que se guardan los SKU al crear productos (mayúsculas, sin espacios)"""
+    return str(sku).upper().strip()
+
+
+class SkuIndex:
+    """Índice SKU -> id de producto en memoria, vigente mientras no cambie la generación"""
+
+    def __init__(self, max_age=SCAN_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self.generation = None
+        self.rebuilds = 0
+        self._skus = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Comprueba la generación (si el índice es viejo o force=True) y reconstruye si cambió"""
+        if not force and time.monotonic() - self._checked < self.max_age:
+            return
+        with self._lock:
+            with get_db() as db:
+                generation = current_generation(db)
+                if generation != self.generation:
+                    # Se arma un dict nuevo y se reemplaza de una vez: las búsquedas
+                    # concurrentes ven el índice anterior o el nuevo, nunca uno a medias
+                    self._skus = {row[0]: row[1] for row in
+                                  db.query("SELECT sku, id FROM products WHERE sku IS NOT NULL")}
+                    self.generation = generation
+                    self.rebuilds += 1
+            self._checked = time.monotonic()
+
+    def advance(self, before, after):
+        """
+        Registra una escritura propia que no cambia SKUs (solo cantidades)
+
+        Si el índice estaba en la generación `before`, pasa a `after` sin reconstruirse.
+        Debe llamarse con las generaciones leídas dentro de la misma transacción de escritura.
+        """
+        with self._lock:
+            if self.generation == before:
+                self.generation = after
+
+    def lookup(self, skus):
+        """
+        Resuelve varios SKU de una vez
+
+        Returns:
+            dict: SKU normalizado -> id de producto (solo los encontrados)
+        """
+        self.refresh()
+        skus = [normalize_sku(sku) for sku in skus]
+        index = self._skus
+        found = {sku: index[sku] for sku in skus if sku in index}
+        if len(found) < len(set(skus)):
+            # SKU desconocido: puede ser un producto recién creado en otro proceso
+            self.refresh(force=True)
+            index = self._skus
+            found = {sku: index[sku] for sku in skus if sku in index}
+        return found
+
+
+class ScanTicket:
+    """Una lectura pendiente: se completa cuando su grupo se aplica en la base"""
+    __slots__ = ('product_id', 'delta', 'actor', 'result', '_done')
+
+    def __init__(self, product_id, delta, actor):
+        self.product_id = product_id
+        self.delta = delta
+        self.actor = actor
+        self.result = None
+        self._done = threading.Event()
+
+    def complete(self, result):
+        self.result = result
+        self._done.set()
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+
+class ScanCoalescer:
+    """
+    Agrupa lecturas por (producto, usuario) durante una ventana y las aplica juntas
+
+    `apply_batch(groups)` recibe {(product_id, actor): [tickets]} y devuelve
+    {(product_id, actor): resultado}; el resultado se entrega a cada ticket del grupo.
+    Un hilo por proceso (se crea al llegar la primera lectura, también después de un fork).
+    """
+
+    def __init__(self, apply_batch, window_ms=SCAN_COALESCE_MS):
+        self.apply_batch = apply_batch
+        self.window = window_ms / 1000.0
+        self.batches = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pending = []
+                threading.Thread(target=self._run, name='scan-coalescer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, product_id, delta, actor):
+        self._ensure_started()
+        ticket = ScanTicket(product_id, delta, actor)
+        with self._cond:
+            self._pending.append(ticket)
+            self._cond.notify()
+        return ticket
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # La primera lectura abre la ventana; las que lleguen mientras tanto se suman
+            time.sleep(self.window)
+            with self._cond:
+                tickets, self._pending = self._pending, []
+            groups = {}
+            for ticket in tickets:
+                groups.setdefault((ticket.product_id, ticket.actor), []).append(ticket)
+            try:
+                results = self.apply_batch(groups)
+            except Exception as e:
+                print(f"ERROR aplicando {len(tickets)} lecturas: {e}")
+                results = {}
+                error = {'status': 'error', 'error': str(e)}
+            else:
+                error = {'status': 'error', 'error': 'Sin resultado'}
+            self.batches += 1
+            for key, group in groups.items():
+                for ticket in group:
+                    ticket.complete(results.get(key, error))
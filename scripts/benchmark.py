@@ -0,0 +1,258 @@
+# Benchmark reproducible de todas las rutas de la aplicación
+#
+# Ejecuta cada escenario (página, reporte, exportación, ajuste de stock) a través del
+# cliente de pruebas de Flask, sin servidor ni red: se mide el costo de la aplicación
+# (consultas + plantillas), no el del servidor web.
+#
+# Los resultados se guardan en JSON junto con el commit y el tamaño de la base,
+# y se pueden comparar con una ejecución anterior para detectar regresiones:
+#
+#   python scripts/generate_data.py --db data/benchmark.db --products 10000 --movements 1000000
+#   python scripts/benchmark.py --db data/benchmark.db --output data/benchmarks/base.json
+#   ... cambios ...
+#   python scripts/benchmark.py --db data/benchmark.db --compare data/benchmarks/base.json
+#
+# Además del tiempo de reloj se guarda el tiempo de CPU del proceso (cpu_ms) y, con
+# --memory, el pico de memoria reservada por Python en una ejecución más de cada escenario
+# (peak_kb, medido con tracemalloc): cuánto cuesta en objetos cada fila que se lee,
+# se pasa a la plantilla o se escribe en un CSV.
+#
+# Los escenarios de escritura (ajustes de stock) modifican la base: alternan entradas
+# y salidas para que las cantidades no deriven, pero agregan movimientos al historial.
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# Tipos de reporte personalizado (ver generate_custom_report en app.py)
+CUSTOM_REPORT_TYPES = ['inventory_by_category', 'low_stock', 'movements_by_period',
+                       'value_by_provider', 'stock_as_of', 'general']
+
+
+def build_scenarios(db):
+    """
+    Lista de escenarios: (nombre, método, ruta, datos del formulario)
+
+    Los parámetros (productos, fechas, páginas) se eligen a partir de los datos
+    de la base para que los filtros devuelvan resultados.
+    """
+    product_id = db.scalar("SELECT MIN(id) FROM products") or 1
+    total_movements = db.scalar("SELECT COUNT(*) FROM inventory_movements") or 0
+    last_movement = str(db.scalar("SELECT MAX(created_at) FROM inventory_movements") or datetime.now())[:10]
+    period_to = datetime.strptime(last_movement, '%Y-%m-%d')
+    period_from = (period_to - timedelta(days=30)).strftime('%Y-%m-%d')
+    middle_page = max(1, (total_movements // 50) // 2)
+
+    scenarios = [
+        ('home', 'GET', '/', None),
+        ('search', 'GET', '/?search=Pro', None),
+        ('dashboard', 'GET', '/dashboard', None),
+        ('reports', 'GET', '/reports', None),
+        ('movements_first_page', 'GET', '/inventory_movements', None),
+        ('movements_middle_page', 'GET', f'/inventory_movements?page={middle_page}', None),
+        ('movements_filtered', 'GET',
+         f'/inventory_movements?product=Kit&movement_type=salida&date_from={period_from}&date_to={last_movement}', None),
+        ('custom_reports_form', 'GET', '/custom_reports', None),
+        ('edit_product_form', 'GET', f'/edit_product/{product_id}', None),
+        ('export_csv', 'GET', '/export_csv', None),
+    ]
+    for report_type in CUSTOM_REPORT_TYPES:
+        form = {'report_type': report_type, 'date_from': '', 'date_to': '',
+                'category': '', 'provider': '', 'stock_level': ''}
+        if report_type == 'movements_by_period':
+            form.update(date_from=period_from, date_to=last_movement)
+        elif report_type == 'stock_as_of':
+            form.update(date_to=period_from)
+        scenarios.append((f'custom_{report_type}', 'POST', '/generate_custom_report', form))
+        scenarios.append((f'export_{report_type}', 'POST', '/export_custom_report', form))
+    # Exportación del historial completo (sin fechas): el caso con más filas, donde pesa
+    # el costo por fila de leer, convertir y escribir el CSV
+    scenarios.append(('export_movements_all', 'POST', '/export_custom_report',
+                      {'report_type': 'movements_by_period', 'date_from': '', 'date_to': ''}))
+    # Escritura: ajuste de stock (entrada y salida alternadas)
+    scenarios.append(('stock_adjustment', 'POST', f'/quick_stock_adjustment/{product_id}', 'adjustment'))
+    return scenarios
+
+
+def _summary(samples):
+    """Estadísticas en milisegundos de una lista de duraciones en segundos"""
+    ordered = sorted(s * 1000 for s in samples)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    return {
+        'iterations': len(ordered),
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+        'p95_ms': round(ordered[p95_index], 3),
+        'max_ms': round(ordered[-1], 3),
+        'stdev_ms': round(statistics.stdev(ordered), 3) if len(ordered) > 1 else 0.0,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _request(client, name, method, path, data, iteration):
+    if data == 'adjustment':
+        data = {'adjustment_type': 'add' if iteration % 2 == 0 else 'subtract',
+                'quantity': '1', 'reason': 'benchmark'}
+    if method == 'GET':
+        response = client.get(path)
+    else:
+        response = client.post(path, data=data)
+    body = response.get_data()  # Incluye el tiempo de generar respuestas en streaming
+    if response.status_code >= 400:
+        raise RuntimeError(f"{name}: {method} {path} respondió {response.status_code}")
+    return body
+
+
+def _peak_kb(client, name, method, path, data):
+    """Pico de memoria reservada por Python (KB) durante una ejecución del escenario"""
+    tracemalloc.start()
+    try:
+        _request(client, name, method, path, data, 0)
+        return round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def run(client, scenarios, iterations, warmup, only=None, memory=False):
+    results = {}
+    for name, method, path, data in scenarios:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        samples = []
+        cpu_samples = []
+        size = 0
+        for iteration in range(warmup + iterations):
+            started = time.perf_counter()
+            cpu_started = time.process_time()
+            body = _request(client, name, method, path, data, iteration)
+            cpu_elapsed = time.process_time() - cpu_started
+            elapsed = time.perf_counter() - started
+            if iteration >= warmup:
+                samples.append(elapsed)
+                cpu_samples.append(cpu_elapsed)
+                size = len(body)
+        results[name] = dict(_summary(samples), cpu_ms=round(statistics.median(cpu_samples) * 1000, 3),
+                             response_bytes=size, method=method, path=path)
+        line = (f"{name:<32} mediana {results[name]['median_ms']:>10.2f} ms   p95 {results[name]['p95_ms']:>10.2f} ms"
+                f"   CPU {results[name]['cpu_ms']:>10.2f} ms")
+        if memory:
+            # Aparte de las mediciones de tiempo: tracemalloc hace más lenta cada reserva
+            results[name]['peak_kb'] = _peak_kb(client, name, method, path, data)
+            line += f"   pico {results[name]['peak_kb']:>10.1f} KB"
+        print(line)
+    return results
+
+
+def compare(current, baseline_path, threshold):
+    """
+    Compara las medianas con una ejecución anterior
+
+    Returns:
+        list: Escenarios cuya mediana empeoró más que el umbral (en %)
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nComparación con {baseline_path} (commit {baseline['metadata'].get('commit')})")
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            print(f"{name:<32} (nuevo)")
+            continue
+        change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100 if before['median_ms'] else 0.0
+        mark = ''
+        if change > threshold:
+            mark = '  <-- REGRESIÓN'
+            regressions.append(name)
+        line = f"{name:<32} {before['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms  ({change:+.1f}%)"
+        # CPU y memoria solo si las dos ejecuciones los midieron (versiones anteriores no)
+        if 'cpu_ms' in before and 'cpu_ms' in result:
+            line += f"   CPU {before['cpu_ms']:.2f} -> {result['cpu_ms']:.2f} ms"
+        if 'peak_kb' in before and 'peak_kb' in result:
+            line += f"   pico {before['peak_kb']:.0f} -> {result['peak_kb']:.0f} KB"
+        print(line + mark)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de las rutas de la aplicación")
+    parser.add_argument('--db', default='data/benchmark.db',
+                        help="Base de datos a usar (generada con generate_data.py; por defecto %(default)s)")
+    parser.add_argument('--iterations', type=int, default=20, help="Mediciones por escenario")
+    parser.add_argument('--warmup', type=int, default=2, help="Ejecuciones previas no medidas")
+    parser.add_argument('--only', nargs='*', help="Solo escenarios cuyo nombre contenga alguno de estos textos")
+    parser.add_argument('--output', help="Archivo JSON de resultados (por defecto data/benchmarks/<fecha>-<commit>.json)")
+    parser.add_argument('--compare', help="JSON de una ejecución anterior para comparar medianas")
+    parser.add_argument('--memory', action='store_true',
+                        help="Medir también el pico de memoria de cada escenario (una ejecución más, con tracemalloc)")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="Porcentaje de empeoramiento que se considera regresión (por defecto %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} no existe: generarla con scripts/generate_data.py")
+    # Debe definirse antes de importar la aplicación (database.py lee DATABASE_PATH al importarse)
+    os.environ['DATABASE_PATH'] = args.db
+
+    from app import app
+    from db import get_db
+
+    app.config['TESTING'] = True
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    if response.status_code != 302:
+        raise SystemExit("No se pudo iniciar sesión como admin")
+
+    with get_db() as db:
+        scenarios = build_scenarios(db)
+        dataset = {
+            'products': db.scalar("SELECT COUNT(*) FROM products"),
+            'users': db.scalar("SELECT COUNT(*) FROM users"),
+            'inventory_movements': db.scalar("SELECT COUNT(*) FROM inventory_movements"),
+        }
+
+    commit = _git_commit()
+    report = {
+        'metadata': {
+            'commit': commit,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': os.path.abspath(args.db),
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'dataset': dataset,
+        },
+        'results': run(client, scenarios, args.iterations, args.warmup, args.only, args.memory),
+    }
+
+    output = args.output or os.path.join(
+        'data', 'benchmarks', f"{datetime.now().strftime('%Y%m%d_%H%M%S')}-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {output}")
+
+    if args.compare and compare(report, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# Generador de datos sintéticos para pruebas de rendimiento
+#
+# Llena una base de datos con productos, usuarios y movimientos de inventario
+# con distribuciones parecidas a las de un inventario real:
+# - Categorías con pesos distintos (pocas categorías concentran la mayoría de productos)
+# - Proveedores asociados a cada categoría
+# - Popularidad de productos tipo Pareto: el 20% de los productos acumula la mayoría
+#   de los movimientos
+# - Más actividad entre semana que en fin de semana, y más en horario laboral
+# - Cantidades coherentes: quantity_before/quantity_after siguen el stock de cada producto
+#   y products.quantity termina igual al último quantity_after
+#
+# Con la misma semilla (--seed) se generan exactamente los mismos datos, así los
+# benchmarks de distintos commits se comparan sobre la misma base.
+#
+# Uso:
+#   python scripts/generate_data.py --db data/benchmark.db --products 10000 --movements 1000000
+#   python scripts/generate_data.py --products 1000000 --movements 50000000 --days 1095
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Permite ejecutar el script desde cualquier directorio
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# Categorías con su peso relativo y sus proveedores habituales
+CATEGORIES = {
+    'Electrónica': (22, ['TecnoSur', 'Distribuidora Andes', 'ImportTech']),
+    'Oficina': (18, ['Papelera Central', 'OfiMax']),
+    'Limpieza': (14, ['Químicos del Norte', 'LimpiaPro']),
+    'Herramientas': (12, ['Ferretería Industrial', 'HerraMax', 'Distribuidora Andes']),
+    'Alimentos': (10, ['Alimentos Frescos', 'Granos del Valle']),
+    'Mobiliario': (8, ['Muebles Modernos', 'OfiMax']),
+    'Repuestos': (7, ['Repuestos García', 'ImportTech']),
+    'Seguridad': (5, ['SeguriTotal']),
+    'Embalaje': (4, ['Cartones del Pacífico', 'Papelera Central']),
+}
+
+PRODUCT_WORDS = ['Kit', 'Caja', 'Paquete', 'Unidad', 'Set', 'Rollo', 'Bolsa', 'Pack']
+PRODUCT_ADJECTIVES = ['Estándar', 'Pro', 'Básico', 'Premium', 'Industrial', 'Compacto', 'XL', 'Eco']
+
+# Tipos de movimiento de la operación diaria y su proporción
+MOVEMENT_MIX = [('salida', 55), ('entrada', 35), ('ajuste', 10)]
+
+# Actividad relativa por día de la semana (lunes = 0)
+WEEKDAY_FACTOR = [1.2, 1.15, 1.1, 1.1, 1.05, 0.5, 0.2]
+
+USER_ROLES = [('admin', 5), ('editor', 60), ('viewer', 35)]
+
+
+def _weighted(rng, options):
+    """Elige un valor de una lista de (valor, peso)"""
+    values, weights = zip(*options)
+    return rng.choices(values, weights=weights)[0]
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate_users(rng, count):
+    """Usuarios adicionales a los de prueba (admin/editor/viewer), con contraseña 'bench123'"""
+    from database import hash_password
+    password_hash = hash_password('bench123')
+    return [(f'bench_user_{i:05d}', password_hash, _weighted(rng, USER_ROLES)) for i in range(1, count + 1)]
+
+
+def generate_products(rng, count, start):
+    """
+    Genera los productos y su popularidad relativa
+
+    Los productos se crean durante el primer 5% del período: el resto del período
+    es operación normal (entradas, salidas y ajustes).
+
+    Returns:
+        tuple: (lista de filas de products, lista de pesos de popularidad)
+    """
+    categories = list(CATEGORIES)
+    category_weights = [CATEGORIES[c][0] for c in categories]
+    products = []
+    popularity = []
+    for product_id in range(1, count + 1):
+        category = rng.choices(categories, weights=category_weights)[0]
+        provider = rng.choice(CATEGORIES[category][1])
+        name = f"{rng.choice(PRODUCT_WORDS)} {category} {rng.choice(PRODUCT_ADJECTIVES)} {product_id:07d}"
+        sku = f"{category[:3].upper()}-{product_id:07d}"
+        stock_min = rng.choice([0, 5, 10, 10, 20, 50])
+        quantity = rng.randint(0, max(stock_min * 4, 20))
+        price = round(rng.lognormvariate(3, 1.1), 2)   # Muchos productos baratos, pocos caros
+        created_at = start + timedelta(seconds=product_id)  # Orden de creación = orden de id
+        products.append((product_id, name, sku, category, quantity, price, provider, stock_min,
+                         created_at.strftime('%Y-%m-%d %H:%M:%S')))
+        popularity.append(rng.paretovariate(1.16))    # Regla 80/20 aproximada
+    return products, popularity
+
+
+def generate_movements(rng, products, popularity, user_rows, count, start, days):
+    """
+    Genera los movimientos en orden cronológico (los ids crecen con la fecha)
+
+    Incluye el movimiento 'creacion' de cada producto y luego `count` movimientos
+    de operación repartidos en `days` días según la actividad de cada día de la semana.
+    Actualiza la cantidad de cada producto en `products` al valor final.
+    """
+    quantities = {}
+    # Movimientos de creación: uno por producto con su cantidad inicial
+    for product in products:
+        product_id, quantity, created_at = product[0], product[4], product[8]
+        quantities[product_id] = quantity
+        yield (product_id, None, 'creacion', 0, quantity, quantity,
+               f'Producto creado con stock inicial de {quantity}', 1, 'admin', created_at)
+
+    # Reparto de los movimientos entre los días según la actividad de cada día
+    first_day = start + timedelta(days=max(1, days // 20))
+    operation_days = max(1, days - (first_day - start).days)
+    day_weights = [WEEKDAY_FACTOR[(first_day + timedelta(days=d)).weekday()] for d in range(operation_days)]
+    total_weight = sum(day_weights)
+    cumulative = []
+    running = 0.0
+    for weight in popularity:
+        running += weight
+        cumulative.append(running)
+    product_ids = [product[0] for product in products]
+    # Solo editores y administradores registran movimientos
+    writers = [(row[0], row[1]) for row in user_rows if row[2] in ('admin', 'editor')] or [(1, 'admin')]
+    movement_types, movement_weights = zip(*MOVEMENT_MIX)
+
+    generated = 0
+    for day_index, weight in enumerate(day_weights):
+        remaining_days_weight = total_weight
+        total_weight -= weight
+        # Último día: completar exactamente `count`
+        day_count = count - generated if day_index == operation_days - 1 else \
+            round((count - generated) * weight / remaining_days_weight)
+        if day_count <= 0:
+            continue
+        day = first_day + timedelta(days=day_index)
+        # Horario laboral (8-18 h) con algo de actividad fuera de horario
+        seconds = sorted(
+            int(rng.triangular(8, 18, 11) * 3600) if rng.random() < 0.9 else rng.randrange(86400)
+            for _ in range(day_count)
+        )
+        picked = rng.choices(product_ids, cum_weights=cumulative, k=day_count)
+        kinds = rng.choices(movement_types, weights=movement_weights, k=day_count)
+        for offset, product_id, movement_type in zip(seconds, picked, kinds):
+            before = quantities[product_id]
+            if movement_type == 'entrada':
+                change = rng.choice([5, 10, 12, 20, 24, 50, 100])
+                reason = f'Ajuste de inventario: +{change} - Recepción de mercancía'
+            elif movement_type == 'salida':
+                change = -min(before, rng.choice([1, 1, 2, 3, 5, 10]))
+                reason = f'Ajuste de inventario: {change} - Despacho'
+            else:
+                change = rng.randint(-3, 3)
+                change = max(change, -before)
+                reason = 'Conteo físico'
+            after = before + change
+            quantities[product_id] = after
+            user_id, username = rng.choice(writers)
+            created_at = (day + timedelta(seconds=min(offset, 86399))).strftime('%Y-%m-%d %H:%M:%S')
+            yield (product_id, None, movement_type, before, after, change, reason, user_id, username, created_at)
+        generated += day_count
+
+    for index, product in enumerate(products):
+        products[index] = product[:4] + (quantities[product[0]],) + product[5:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera datos sintéticos reproducibles para benchmarks")
+    parser.add_argument('--db', default='data/benchmark.db',
+                        help="Archivo SQLite a llenar (se usa DATABASE_PATH; por defecto %(default)s)")
+    parser.add_argument('--products', type=int, default=10000, help="Productos (por defecto %(default)s)")
+    parser.add_argument('--users', type=int, default=50, help="Usuarios adicionales (por defecto %(default)s)")
+    parser.add_argument('--movements', type=int, default=1000000,
+                        help="Movimientos de operación (por defecto %(default)s)")
+    parser.add_argument('--days', type=int, default=365, help="Días de historial (por defecto %(default)s)")
+    parser.add_argument('--seed', type=int, default=42, help="Semilla aleatoria (por defecto %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=50000, help="Filas por transacción")
+    parser.add_argument('--force', action='store_true', help="Sobrescribir el archivo si ya existe")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        if not args.force:
+            parser.error(f"{args.db} ya existe (usar --force para sobrescribirlo)")
+        os.remove(args.db)
+    os.environ['DATABASE_PATH'] = args.db
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+
+    from database import init_db
+    from db import get_db
+
+    init_db()
+    rng = random.Random(args.seed)
+    end = datetime(2024, 12, 31)  # Fecha fija: los datos no dependen del día en que se generan
+    start = end - timedelta(days=args.days)
+    began = time.perf_counter()
+
+    db = get_db()
+    if db.dialect.name == 'sqlite':
+        # Carga masiva: sin diario ni fsync (si falla, se vuelve a generar)
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+
+    user_rows = generate_users(rng, args.users)
+    db.executemany("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)", user_rows)
+    user_rows = db.query("SELECT id, username, role FROM users")
+    db.commit()
+    print(f"Usuarios: {len(user_rows)}")
+
+    products, popularity = generate_products(rng, args.products, start)
+    movement_sql = """
+        INSERT INTO inventory_movements
+        (product_id, product_name, movement_type, quantity_before, quantity_after, quantity_change,
+         reason, user_id, username, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    inserted = 0
+    movements = generate_movements(rng, products, popularity, user_rows, args.movements, start, args.days)
+    for batch in _batched(movements, args.batch_size):
+        db.executemany(movement_sql, batch)
+        db.commit()
+        inserted += len(batch)
+        print(f"\rMovimientos: {inserted:,}", end='', flush=True)
+    print()
+
+    # Los productos se insertan al final: generate_movements deja en cada uno su cantidad final
+    for batch in _batched(products, args.batch_size):
+        db.executemany("""
+            INSERT INTO products (id, name, sku, category, quantity, price, provider, stock_min, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, batch)
+        db.commit()
+    print(f"Productos: {len(products):,}")
+
+    if db.dialect.name == 'postgresql':
+        # Los ids se insertaron explícitamente: avanzar la secuencia del SERIAL
+        db.execute("SELECT setval(pg_get_serial_sequence('products', 'id'), (SELECT MAX(id) FROM products))")
+    if db.dialect.name == 'sqlite':
+        db.execute("ANALYZE")  # Estadísticas para el planificador de consultas
+    db.commit()
+    db.close()
+    print(f"Listo en {time.perf_counter() - began:.1f} s -> {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# Prueba de carga: simula un turno de bodega contra un servidor en ejecución
+#
+# Cada "usuario virtual" es una corrutina con su propia sesión (cookies) que inicia
+# sesión con su rol y luego repite acciones elegidas al azar según una mezcla
+# configurable, con una pausa ("tiempo de pensar") entre acciones:
+# - viewers: consultan el dashboard, buscan, revisan el historial, exportan
+# - editors: además hacen ajustes rápidos de stock (escrituras)
+#
+# Al final muestra, por endpoint: peticiones, throughput, latencias p50/p95/p99,
+# errores y bloqueos de la base (respuestas 503 con X-DB-Error: locked).
+#
+# Uso (con el servidor levantado, por ejemplo con los mismos workers que el Dockerfile):
+#   gunicorn --workers=4 --bind=127.0.0.1:8000 wsgi:app
+#   python scripts/load_test.py --base-url http://127.0.0.1:8000 --editors 4 --viewers 12 --duration 60
+#
+# Modo síncrono (gunicorn) contra modo ASGI (uvicorn, ver asgi.py) con clientes lentos:
+# --slow-downloads agrega descargas del historial completo leídas a --slow-rate KB/s,
+# que en modo síncrono ocupan un worker cada una mientras duran:
+#   gunicorn --workers=4 --bind=127.0.0.1:8000 wsgi:app
+#   python scripts/load_test.py --slow-downloads 6 --output sync.json
+#   uvicorn asgi:application --workers 4 --port 8000
+#   python scripts/load_test.py --slow-downloads 6 --output asgi.json --compare sync.json
+#
+# Requiere httpx (pip install httpx); no es dependencia de la aplicación.
+import sys
+import csv
+import io
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Credenciales por rol (usuarios de prueba creados por init_db)
+DEFAULT_CREDENTIALS = {
+    'admin': ('admin', 'admin123'),
+    'editor': ('editor', 'editor123'),
+    'viewer': ('viewer', 'viewer123'),
+}
+
+# Mezcla de acciones por rol: nombre -> peso relativo
+DEFAULT_MIX = {
+    'viewer': {'dashboard': 40, 'home': 15, 'search': 20, 'movements': 15, 'export_csv': 5, 'export_report': 5},
+    'editor': {'dashboard': 25, 'home': 10, 'search': 20, 'movements': 5, 'adjustment': 35,
+               'export_csv': 2, 'export_report': 3},
+}
+
+SEARCH_TERMS = ['kit', 'caja', 'pro', 'eco', 'set', 'xl', 'oficina', 'limpieza', 'a', 'electr']
+
+
+class Stats:
+    """Latencias y resultados por endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.locks = defaultdict(int)
+        self.status = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, elapsed, response=None, error=None):
+        self.latencies[endpoint].append(elapsed)
+        if error is not None:
+            self.errors[endpoint] += 1
+            self.status[endpoint][type(error).__name__] += 1
+            return
+        self.status[endpoint][response.status_code] += 1
+        if response.headers.get('X-DB-Error') == 'locked':
+            self.locks[endpoint] += 1
+        elif response.status_code >= 400:
+            self.errors[endpoint] += 1
+        elif response.status_code in (301, 302) and '/login' in response.headers.get('location', ''):
+            # Redirigido al login: la sesión se perdió o expiró
+            self.errors[endpoint] += 1
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class VirtualUser:
+    def __init__(self, number, role, args, product_ids, stats, deadline):
+        self.number = number
+        self.role = role
+        self.args = args
+        self.product_ids = product_ids
+        self.stats = stats
+        self.deadline = deadline
+        self.rng = random.Random(args.seed * 1000 + number)
+        self.logged_out = False
+        mix = args.mix[role]
+        self.actions, self.weights = zip(*mix.items())
+
+    async def request(self, client, endpoint, method, path, data=None):
+        started = time.perf_counter()
+        try:
+            if method == 'GET':
+                response = await client.get(path)
+            else:
+                response = await client.post(path, data=data)
+            await response.aread()
+        except httpx.HTTPError as error:
+            self.stats.record(endpoint, time.perf_counter() - started, error=error)
+            return None
+        self.stats.record(endpoint, time.perf_counter() - started, response=response)
+        if endpoint != 'login' and response.status_code in (301, 302) \
+                and '/login' in response.headers.get('location', ''):
+            self.logged_out = True
+        return response
+
+    async def login(self, client):
+        username, password = self.args.credentials[self.role]
+        response = await self.request(client, 'login', 'POST', '/login',
+                                      {'username': username, 'password': password})
+        # Login correcto: redirección al dashboard y cookie de sesión en el cliente
+        return response is not None and response.status_code == 302 \
+            and '/login' not in response.headers.get('location', '')
+
+    async def run(self):
+        async with httpx.AsyncClient(base_url=self.args.base_url, timeout=self.args.timeout,
+                                     follow_redirects=False) as client:
+            if not await self.login(client):
+                print(f"Usuario virtual {self.number} ({self.role}): no pudo iniciar sesión", file=sys.stderr)
+                return
+            while time.monotonic() < self.deadline:
+                if self.logged_out:
+                    # La sesión expiró o se perdió: volver a iniciar sesión como haría el usuario
+                    self.logged_out = False
+                    await self.login(client)
+                action = self.rng.choices(self.actions, weights=self.weights)[0]
+                await getattr(self, f'do_{action}')(client)
+                if self.args.think_time:
+                    await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+    async def do_dashboard(self, client):
+        await self.request(client, 'dashboard', 'GET', '/dashboard')
+
+    async def do_home(self, client):
+        await self.request(client, 'home', 'GET', '/')
+
+    async def do_search(self, client):
+        await self.request(client, 'search', 'GET', f'/?search={self.rng.choice(SEARCH_TERMS)}')
+
+    async def do_movements(self, client):
+        page = 1 if self.rng.random() < 0.7 else self.rng.randint(2, 20)
+        await self.request(client, 'inventory_movements', 'GET', f'/inventory_movements?page={page}')
+
+    async def do_adjustment(self, client):
+        if not self.product_ids:
+            return
+        product_id = self.rng.choice(self.product_ids)
+        await self.request(client, 'quick_stock_adjustment', 'POST', f'/quick_stock_adjustment/{product_id}', {
+            'adjustment_type': self.rng.choice(['add', 'subtract']),
+            'quantity': str(self.rng.randint(1, 5)),
+            'reason': 'Prueba de carga',
+        })
+
+    async def do_export_csv(self, client):
+        await self.request(client, 'export_csv', 'GET', '/export_csv')
+
+    async def do_export_report(self, client):
+        today = datetime.now()
+        await self.request(client, 'export_custom_report', 'POST', '/export_custom_report', {
+            'report_type': 'movements_by_period',
+            'date_from': (today - timedelta(days=7)).strftime('%Y-%m-%d'),
+            'date_to': today.strftime('%Y-%m-%d'),
+        })
+
+
+class SlowDownloader:
+    """Cliente lento: descarga el historial completo una y otra vez leyendo a --slow-rate KB/s"""
+
+    def __init__(self, number, args, stats, deadline):
+        self.number = number
+        self.args = args
+        self.stats = stats
+        self.deadline = deadline
+
+    async def run(self):
+        async with httpx.AsyncClient(base_url=self.args.base_url, timeout=self.args.timeout,
+                                     follow_redirects=False) as client:
+            username, password = self.args.credentials['viewer']
+            await client.post('/login', data={'username': username, 'password': password})
+            while time.monotonic() < self.deadline:
+                started = time.perf_counter()
+                try:
+                    # Sin fechas: todos los movimientos (la exportación más grande)
+                    async with client.stream('POST', '/export_custom_report',
+                                             data={'report_type': 'movements_by_period'}) as response:
+                        async for chunk in response.aiter_raw(16 * 1024):
+                            if time.monotonic() >= self.deadline:
+                                break
+                            await asyncio.sleep(len(chunk) / (self.args.slow_rate * 1024))
+                except httpx.HTTPError as error:
+                    self.stats.record('slow_download', time.perf_counter() - started, error=error)
+                    continue
+                self.stats.record('slow_download', time.perf_counter() - started, response=response)
+
+
+async def discover_products(args):
+    """IDs de productos para los ajustes, leídos de la exportación CSV (como admin)"""
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        username, password = args.credentials['admin']
+        await client.post('/login', data={'username': username, 'password': password})
+        response = await client.get('/export_csv')
+        if response.status_code != 200:
+            return []
+        reader = csv.reader(io.StringIO(response.text))
+        next(reader, None)  # Encabezados
+        return [int(row[0]) for row in reader if row and row[0].isdigit()]
+
+
+def report(stats, duration):
+    totals = {'requests': 0, 'errors': 0, 'locks': 0}
+    endpoints = {}
+    print(f"\n{'Endpoint':<24}{'Peticiones':>11}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'Errores':>9}{'Bloqueos':>10}")
+    for endpoint in sorted(stats.latencies):
+        ordered = sorted(stats.latencies[endpoint])
+        result = {
+            'requests': len(ordered),
+            'throughput_rps': round(len(ordered) / duration, 2),
+            'p50_ms': round(_percentile(ordered, 0.50) * 1000, 2),
+            'p95_ms': round(_percentile(ordered, 0.95) * 1000, 2),
+            'p99_ms': round(_percentile(ordered, 0.99) * 1000, 2),
+            'errors': stats.errors[endpoint],
+            'db_locks': stats.locks[endpoint],
+            'status': {str(code): count for code, count in stats.status[endpoint].items()},
+        }
+        endpoints[endpoint] = result
+        totals['requests'] += result['requests']
+        totals['errors'] += result['errors']
+        totals['locks'] += result['db_locks']
+        print(f"{endpoint:<24}{result['requests']:>11}{result['throughput_rps']:>9.1f}{result['p50_ms']:>10.1f}"
+              f"{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['errors']:>9}{result['db_locks']:>10}")
+    totals['throughput_rps'] = round(totals['requests'] / duration, 2)
+    print(f"\nTotal: {totals['requests']} peticiones en {duration:.1f} s ({totals['throughput_rps']} req/s), "
+          f"{totals['errors']} errores, {totals['locks']} bloqueos de la base")
+    return {'totals': totals, 'endpoints': endpoints}
+
+
+async def main_async(args):
+    product_ids = await discover_products(args)
+    if not product_ids:
+        print("AVISO: no se encontraron productos; no se harán ajustes de stock", file=sys.stderr)
+
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + args.duration
+    roles = ['editor'] * args.editors + ['viewer'] * args.viewers
+    users = []
+    for number, role in enumerate(roles):
+        users.append(VirtualUser(number, role, args, product_ids, stats, deadline))
+    # Arranque escalonado (ramp-up) para no iniciar todas las sesiones en el mismo instante
+    tasks = [asyncio.create_task(SlowDownloader(number, args, stats, deadline).run())
+             for number in range(args.slow_downloads)]
+    for user in users:
+        tasks.append(asyncio.create_task(user.run()))
+        if args.ramp_up and len(users) > 1:
+            await asyncio.sleep(args.ramp_up / len(users))
+    await asyncio.gather(*tasks)
+    return report(stats, time.monotonic() - started)
+
+
+def compare(result, baseline_path):
+    """Muestra, por endpoint, latencias y throughput de esta ejecución junto a los de otra"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nComparación con {baseline_path} ({baseline.get('config', {}).get('base_url', '?')})")
+    print(f"{'Endpoint':<24}{'p50 antes':>11}{'p50 ahora':>11}{'p95 antes':>11}{'p95 ahora':>11}"
+          f"{'req/s antes':>13}{'req/s ahora':>13}")
+    for endpoint in sorted(set(result['endpoints']) | set(baseline['endpoints'])):
+        before = baseline['endpoints'].get(endpoint, {})
+        after = result['endpoints'].get(endpoint, {})
+        print(f"{endpoint:<24}{before.get('p50_ms', 0):>11.1f}{after.get('p50_ms', 0):>11.1f}"
+              f"{before.get('p95_ms', 0):>11.1f}{after.get('p95_ms', 0):>11.1f}"
+              f"{before.get('throughput_rps', 0):>13.1f}{after.get('throughput_rps', 0):>13.1f}")
+    print(f"{'Total':<24}{'':>44}{baseline['totals']['throughput_rps']:>13.1f}"
+          f"{result['totals']['throughput_rps']:>13.1f}")
+
+
+def _parse_mix(text, role):
+    """Convierte 'dashboard=40,search=20' en {'dashboard': 40, 'search': 20}"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if not hasattr(VirtualUser, f'do_{name.strip()}'):
+            raise argparse.ArgumentTypeError(f"Acción desconocida: {name}")
+        mix[name.strip()] = float(weight or 1)
+    if role == 'viewer' and 'adjustment' in mix:
+        raise argparse.ArgumentTypeError("Los viewers no pueden hacer ajustes de stock")
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga con tráfico de un turno de bodega")
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000', help="URL del servidor")
+    parser.add_argument('--editors', type=int, default=4, help="Usuarios virtuales con rol editor")
+    parser.add_argument('--viewers', type=int, default=12, help="Usuarios virtuales con rol viewer")
+    parser.add_argument('--duration', type=float, default=60, help="Duración en segundos")
+    parser.add_argument('--ramp-up', type=float, default=5, help="Segundos para arrancar a todos los usuarios")
+    parser.add_argument('--think-time', type=float, default=1.0,
+                        help="Pausa media entre acciones de un usuario (0 = sin pausa)")
+    parser.add_argument('--timeout', type=float, default=30, help="Timeout por petición en segundos")
+    parser.add_argument('--editor-mix', help="Mezcla de editores, ej: dashboard=25,search=20,adjustment=35")
+    parser.add_argument('--viewer-mix', help="Mezcla de viewers, ej: dashboard=40,search=20,export_csv=5")
+    parser.add_argument('--credentials', help="JSON con {rol: [usuario, contraseña]} (por defecto los de prueba)")
+    parser.add_argument('--seed', type=int, default=1, help="Semilla para elegir las acciones")
+    parser.add_argument('--output', help="Guardar el resultado en un archivo JSON")
+    parser.add_argument('--slow-downloads', type=int, default=0,
+                        help="Clientes lentos descargando el historial completo durante la prueba")
+    parser.add_argument('--slow-rate', type=float, default=64,
+                        help="Velocidad de lectura de los clientes lentos en KB/s")
+    parser.add_argument('--compare', help="JSON de una ejecución anterior (--output) para comparar")
+    args = parser.parse_args()
+
+    if httpx is None:
+        raise SystemExit("Este script requiere httpx: pip install httpx")
+
+    args.mix = dict(DEFAULT_MIX)
+    try:
+        if args.editor_mix:
+            args.mix['editor'] = _parse_mix(args.editor_mix, 'editor')
+        if args.viewer_mix:
+            args.mix['viewer'] = _parse_mix(args.viewer_mix, 'viewer')
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    credentials = dict(DEFAULT_CREDENTIALS)
+    if args.credentials:
+        with open(args.credentials, 'r', encoding='utf-8') as f:
+            credentials.update({role: tuple(pair) for role, pair in json.load(f).items()})
+    args.credentials = credentials
+
+    result = asyncio.run(main_async(args))
+    if args.output:
+        result['config'] = {
+            'base_url': args.base_url, 'editors': args.editors, 'viewers': args.viewers,
+            'duration': args.duration, 'think_time': args.think_time, 'mix': args.mix,
+            'slow_downloads': args.slow_downloads, 'slow_rate': args.slow_rate,
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -52,6 +52,8 @@ document.addEventListener('DOMContentLoaded', function() {
         const reportType = reportTypeSelect.value;     // Tipo de reporte actualmente seleccionado
         const dateFields = document.querySelectorAll('.date-fields'); // Campos relacionados con fechas
         const stockFields = document.querySelectorAll('.stock-fields'); // Campos de niveles de stock
+        const abcFields = document.querySelectorAll('.abc-fields'); // Campos de clase ABC
+        const locationFields = document.querySelectorAll('.location-fields'); // Campo de ubicación
         
         // FASE 1: OCULTAMIENTO - Primero ocultamos todos los campos opcionales
         dateFields.forEach(field => {
@@ -81,6 +83,16 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         });
         
+        // Los campos de clase ABC solo aplican a la clasificación ABC
+        abcFields.forEach(field => {
+            field.style.display = 'none';
+        });
+        
+        // La ubicación solo aplica al inventario general y a los movimientos
+        locationFields.forEach(field => {
+            field.style.display = 'none';
+        });
+        
         // FASE 2: VISUALIZACIÓN SELECTIVA - Mostrar solo campos relevantes según tipo
         
         // Para reportes de movimientos, necesitamos campos de fecha
@@ -117,6 +129,18 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
         
+        // Para el stock a una fecha, solo se necesita la fecha de corte ("Fecha Hasta")
+        if (reportType === 'stock_as_of') {
+            const dateTo = document.getElementById('date_to');
+            dateTo.closest('.date-fields').style.display = 'block';
+            dateTo.setAttribute('title', 'Fecha en la que se quiere conocer el stock');
+            
+            // Por defecto: hoy
+            if (!dateTo.value) {
+                dateTo.value = new Date().toISOString().split('T')[0];
+            }
+        }
+        
         // Para reportes de inventario general, necesitamos campos de nivel de stock
         if (reportType === 'inventory_general') {
             stockFields.forEach(field => {
@@ -124,6 +148,20 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         }
         
+        // Inventario de una ubicación o movimientos de una ubicación
+        if (reportType === 'inventory_general' || reportType === 'movements_by_period') {
+            locationFields.forEach(field => {
+                field.style.display = 'block';
+            });
+        }
+        
+        // Para la clasificación ABC, filtros por clase de valor y de velocidad
+        if (reportType === 'abc_classification') {
+            abcFields.forEach(field => {
+                field.style.display = 'block';
+            });
+        }
+        
         // FASE 4: ACTUALIZACIÓN DE INTERFAZ RELACIONADA
         // Actualiza el texto del botón para reflejar la acción específica
         updateSubmitButton(reportType);
@@ -159,7 +197,9 @@ document.addEventListener('DOMContentLoaded', function() {
             'inventory_by_category': 'Generar por Categoría',
             'low_stock': 'Generar Stock Bajo',
             'movements_by_period': 'Generar Movimientos',
-            'value_by_provider': 'Generar por Proveedor'
+            'value_by_provider': 'Generar por Proveedor',
+            'stock_as_of': 'Generar Stock a la Fecha',
+            'abc_classification': 'Generar Clasificación ABC'
         };
         
         // Si hay un tipo de reporte válido y tenemos texto específico para él
@@ -0,0 +1,91 @@
+# Alertas de stock bajo mantenidas de forma incremental
+#
+# Antes cada página calculaba "stock bajo" recorriendo toda la tabla products, y no
+# todas usaban el mismo límite (unas quantity < stock_min, otras quantity <= stock_min).
+# Ahora el estado de cada producto se guarda en la tabla stock_alerts:
+#
+#     normal    quantity > stock_min
+#     warning   0 < quantity <= stock_min      (llegó al mínimo: hay que reponer)
+#     critical  quantity = 0                   (sin stock)
+#
+# La tabla la mantienen triggers de la base (ver alert_triggers en db.py): al insertar un
+# producto, al cambiar su quantity o stock_min y al eliminarlo. Solo se evalúa la fila que
+# cambió, y solo se escribe en stock_alerts si el estado es otro; changed_at guarda cuándo
+# pasó al estado actual y previous_state de cuál venía. Así cuenta cualquier escritura
+# (rutas, escaneos, scripts) sin tener que recordarlo en el código.
+#
+# Las páginas leen de stock_alerts (índice por estado) en lugar de comparar columnas en
+# todos los productos:
+#     SELECT ... FROM products WHERE id IN (SELECT product_id FROM stock_alerts WHERE state IN ('warning', 'critical'))
+#
+# Si la tabla se desincroniza (ej: datos cargados con los triggers desactivados), el comando
+#     flask --app wsgi reevaluate-alerts
+# recalcula el estado de todos los productos.
+from db import get_db
+
+STATES = ('normal', 'warning', 'critical')
+
+# Subconsulta con los ids de productos en alerta (stock bajo o sin stock)
+ALERTED_PRODUCT_IDS = "SELECT product_id FROM stock_alerts WHERE state IN ('warning', 'critical')"
+
+
+def state_sql(prefix=''):
+    """
+    Expresión SQL del estado de alerta de una fila de products
+
+    Args:
+        prefix (str): Prefijo de las columnas (ej: 'NEW.' en un trigger, 'p.' con alias)
+    """
+    return (f"CASE WHEN {prefix}quantity = 0 THEN 'critical' "
+            f"WHEN {prefix}quantity <= {prefix}stock_min THEN 'warning' "
+            f"ELSE 'normal' END")
+
+
+def reevaluate_all(db):
+    """
+    Recalcula el estado de todos los productos (sin commit)
+
+    Solo modifica las filas cuyo estado cambió, así que no altera changed_at de las demás.
+
+    Returns:
+        dict: Filas agregadas, actualizadas y eliminadas de stock_alerts
+    """
+    state = state_sql('p.')
+    added = db.execute(f"""
+        INSERT INTO stock_alerts (product_id, state, changed_at)
+        SELECT p.id, {state}, CURRENT_TIMESTAMP
+        FROM products p
+        WHERE NOT EXISTS (SELECT 1 FROM stock_alerts a WHERE a.product_id = p.id)
+    """).rowcount
+    updated = db.execute(f"""
+        UPDATE stock_alerts
+        SET previous_state = state,
+            state = (SELECT {state} FROM products p WHERE p.id = stock_alerts.product_id),
+            changed_at = CURRENT_TIMESTAMP
+        WHERE state <> (SELECT {state} FROM products p WHERE p.id = stock_alerts.product_id)
+    """).rowcount
+    removed = db.execute("""
+        DELETE FROM stock_alerts
+        WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.id = stock_alerts.product_id)
+    """).rowcount
+    return {'added': added, 'updated': updated, 'removed': removed}
+
+
+def counts(db):
+    """Cantidad de productos por estado: {'normal': n, 'warning': n, 'critical': n}"""
+    result = dict.fromkeys(STATES, 0)
+    for row in db.query("SELECT state, COUNT(*) AS total FROM stock_alerts GROUP BY state"):
+        result[row['state']] = row['total']
+    return result
+
+
+def reevaluate_command():
+    """Recalcula las alertas de stock de todos los productos"""
+    with get_db() as db:
+        db.begin_write()
+        changes = reevaluate_all(db)
+        db.commit()
+        print(f"Alertas de stock: {changes['added']} agregadas, {changes['updated']} cambiaron de estado, "
+              f"{changes['removed']} eliminadas")
+        print(', '.join(f"{state}: {total}" for state, total in counts(db).items()))
+
@@ -0,0 +1,226 @@
+# Reconstrucción del stock en una fecha pasada ("¿cuánto había de cada producto el día X?")
+#
+# El historial de movimientos guarda quantity_before/quantity_after en cada cambio,
+# así que en teoría basta con recorrer todo el historial para saber el stock de
+# cualquier día. En la práctica eso significa leer el ledger completo en cada consulta.
+#
+# Este módulo combina dos fuentes para acotar el trabajo:
+# - FOTOS DE STOCK (snapshots): una tarea programada copia periódicamente la cantidad
+#   de todos los productos en stock_snapshots / stock_snapshot_items
+# - REPRODUCCIÓN (replay): para una fecha X se toma la foto más reciente anterior a X
+#   y se aplican solo los movimientos ocurridos entre la foto y X
+#
+# Como quantity_after es un valor absoluto, "aplicar" los movimientos se reduce a
+# quedarse con el último movimiento de cada producto dentro del intervalo.
+# El costo de una consulta es: una foto + un intervalo de movimientos.
+from movement_archive import movement_source
+
+# Cantidad de fotos que se conservan al tomar una nueva (0 = conservar todas)
+DEFAULT_KEEP_SNAPSHOTS = 400
+
+
+def _normalize_as_of(as_of):
+    """
+    Convierte una fecha 'YYYY-MM-DD' en el último instante de ese día
+
+    Los timestamps de SQLite (CURRENT_TIMESTAMP) tienen el formato
+    'YYYY-MM-DD HH:MM:SS', así que se comparan correctamente como texto.
+    """
+    as_of = str(as_of).strip()
+    if len(as_of) == 10:
+        return as_of + ' 23:59:59'
+    return as_of.replace('T', ' ')[:19]
+
+
+def take_stock_snapshot(db, keep=DEFAULT_KEEP_SNAPSHOTS):
+    """
+    Guarda una foto completa del stock actual de todos los productos
+
+    La foto registra también el último id de movimiento visible en ese momento.
+    Al reproducir, los movimientos con id mayor y fecha posterior a la foto son
+    los que faltan aplicar; los que se registren tarde con una fecha anterior
+    (ya reflejados en products.quantity) no se vuelven a aplicar.
+
+    Args:
+        db: Conexión a la base de datos principal (db.Database)
+        keep (int): Fotos a conservar; las más antiguas se eliminan (0 = todas)
+
+    Returns:
+        int: ID de la foto creada
+    """
+    # Transacción de escritura (BEGIN IMMEDIATE en SQLite): la lectura de productos
+    # y del último movimiento ocurre sin que otro proceso pueda escribir en medio
+    db.begin_write()
+    try:
+        last_movement_id = db.scalar("SELECT COALESCE(MAX(id), 0) FROM inventory_movements")
+        product_count = db.scalar("SELECT COUNT(*) FROM products")
+
+        snapshot_id = db.insert("""
+            INSERT INTO stock_snapshots (taken_at, last_movement_id, product_count)
+            VALUES (CURRENT_TIMESTAMP, ?, ?)
+        """, (last_movement_id, product_count))
+
+        # INSERT ... SELECT copia todas las cantidades dentro de la base, sin pasar por Python
+        db.execute("""
+            INSERT INTO stock_snapshot_items (snapshot_id, product_id, quantity)
+            SELECT ?, id, quantity FROM products
+        """, (snapshot_id,))
+
+        if keep:
+            # Se conservan las "keep" fotos más recientes
+            db.execute("""
+                DELETE FROM stock_snapshot_items WHERE snapshot_id NOT IN (
+                    SELECT id FROM stock_snapshots ORDER BY taken_at DESC, id DESC LIMIT ?
+                )
+            """, (keep,))
+            db.execute("""
+                DELETE FROM stock_snapshots WHERE id NOT IN (
+                    SELECT id FROM stock_snapshots ORDER BY taken_at DESC, id DESC LIMIT ?
+                )
+            """, (keep,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return snapshot_id
+
+
+def stock_as_of(db, as_of):
+    """
+    Reconstruye el stock de todos los productos en una fecha/hora pasada
+
+    Proceso:
+    1. Buscar la foto más reciente tomada antes o en as_of
+    2. Partir de sus cantidades
+    3. Aplicar el último movimiento de cada producto entre la foto y as_of
+       (solo se leen las particiones archivadas que se solapan con ese intervalo)
+    4. Quitar los productos cuyo último movimiento fue su eliminación
+
+    Sin ninguna foto anterior, se reproduce el historial desde el principio; un producto
+    sin movimientos hasta as_of toma la cantidad previa a su primer movimiento posterior,
+    y solo los que nunca tuvieron movimientos toman la cantidad actual.
+
+    Args:
+        db: Conexión a la base de datos principal (db.Database)
+        as_of (str): Fecha 'YYYY-MM-DD' (fin del día) o timestamp 'YYYY-MM-DD HH:MM:SS'
+
+    Returns:
+        list: Diccionarios con product_id, name, category, provider y quantity,
+              ordenados por nombre
+    """
+    as_of = _normalize_as_of(as_of)
+
+    snapshot = db.query_one("""
+        SELECT id, taken_at, last_movement_id FROM stock_snapshots
+        WHERE taken_at <= ?
+        ORDER BY taken_at DESC, id DESC
+        LIMIT 1
+    """, (as_of,))
+
+    quantities = {}
+    if snapshot:
+        quantities = {
+            row['product_id']: row['quantity']
+            for row in db.query("SELECT product_id, quantity FROM stock_snapshot_items WHERE snapshot_id = ?",
+                                (snapshot['id'],))
+        }
+        window_from = str(snapshot['taken_at'])  # PostgreSQL/MySQL devuelven datetime
+        window_sql = "created_at >= ? AND id > ? AND created_at <= ?"
+        window_params = [window_from, snapshot['last_movement_id'], as_of]
+    else:
+        window_from = None
+        window_sql = "created_at <= ?"
+        window_params = [as_of]
+
+    # Sin foto se lee todo el historial: también hace falta el primer movimiento posterior
+    # a as_of de los productos que no tuvieron movimientos hasta entonces (ver más abajo)
+    source = movement_source(db, window_from[:10], as_of[:10]) if snapshot else movement_source(db)
+
+    # Último movimiento de cada producto dentro del intervalo
+    # ROW_NUMBER() numera los movimientos de cada producto del más reciente al más antiguo
+    latest_movements = db.query(f"""
+        SELECT product_id, movement_type, quantity_after
+        FROM (
+            SELECT product_id, movement_type, quantity_after,
+                   ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY created_at DESC, id DESC) as rn
+            FROM {source}
+            WHERE {window_sql}
+        ) ranked
+        WHERE rn = 1
+    """, window_params)
+    for row in latest_movements:
+        if row['movement_type'] == 'eliminacion':
+            quantities.pop(row['product_id'], None)
+        else:
+            quantities[row['product_id']] = row['quantity_after']
+
+    if not snapshot:
+        # Productos sin movimientos hasta as_of: tenían la cantidad previa a su primer
+        # movimiento posterior (salvo que ese movimiento sea su creación: aún no existían)
+        moved = {row['product_id'] for row in latest_movements}
+        created_later = {row['id'] for row in db.query("SELECT id FROM products WHERE created_at > ?", (as_of,))}
+        first_later = db.query(f"""
+            SELECT product_id, movement_type, quantity_before
+            FROM (
+                SELECT product_id, movement_type, quantity_before,
+                       ROW_NUMBER() OVER (PARTITION BY product_id ORDER BY created_at ASC, id ASC) as rn
+                FROM {source}
+                WHERE created_at > ?
+            ) ranked
+            WHERE rn = 1
+        """, (as_of,))
+        for row in first_later:
+            if (row['product_id'] not in moved and row['product_id'] not in created_later
+                    and row['movement_type'] != 'creacion'):
+                quantities[row['product_id']] = row['quantity_before']
+        moved.update(row['product_id'] for row in first_later)
+
+        # Productos sin ningún movimiento registrado: su cantidad nunca cambió
+        for row in db.query("SELECT id, quantity FROM products WHERE created_at <= ?", (as_of,)):
+            if row['id'] not in moved:
+                quantities[row['id']] = row['quantity']
+
+    # Datos descriptivos de los productos: product_dim incluye a los eliminados
+    # con su último nombre conocido; el proveedor solo existe para los vigentes
+    products = {row['product_id']: row for row in db.query("""
+        SELECT d.product_id, d.name, d.category, p.provider
+        FROM product_dim d
+        LEFT JOIN products p ON p.id = d.product_id
+    """)}
+
+    results = []
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        results.append({
+            'product_id': product_id,
+            'name': product['name'] if product else f'Producto #{product_id}',
+            'category': product['category'] if product else None,
+            'provider': product['provider'] if product else None,
+            'quantity': quantity,
+        })
+    results.sort(key=lambda r: (r['name'] or '').lower())
+    return results
+
+
+# Ejecución como script:
+#   python stock_history.py snapshot [--keep N]   -> tarea programada (ej: diaria con cron)
+#   python stock_history.py as-of 2024-12-31      -> imprime el stock en esa fecha
+if __name__ == "__main__":
+    import argparse
+    from db import get_db
+
+    parser = argparse.ArgumentParser(description="Fotos de stock y consultas de stock a una fecha")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = subparsers.add_parser('snapshot', help="Guarda una foto del stock actual")
+    snapshot_parser.add_argument('--keep', type=int, default=DEFAULT_KEEP_SNAPSHOTS,
+                                 help="Fotos a conservar (0 = todas, por defecto %(default)s)")
+    as_of_parser = subparsers.add_parser('as-of', help="Muestra el stock en una fecha")
+    as_of_parser.add_argument('date', help="Fecha YYYY-MM-DD o timestamp YYYY-MM-DD HH:MM:SS")
+    args = parser.parse_args()
+
+    with get_db() as database:
+        if args.command == 'snapshot':
+            print(f"Foto de stock creada: #{take_stock_snapshot(database, keep=args.keep)}")
+        else:
+            for item in stock_as_of(database, args.date):
+                print(f"{item['product_id']:>6}  {item['quantity']:>8}  {item['name']}")
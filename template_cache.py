@@ -0,0 +1,135 @@
+# Caché de plantillas Jinja2
+#
+# Dos niveles:
+#
+# 1. BYTECODE EN DISCO: Jinja2 compila cada plantilla a código Python la primera vez que
+#    se usa. Con FileSystemBytecodeCache el resultado se guarda en data/jinja_cache y los
+#    demás workers (y los reinicios) lo cargan en lugar de volver a compilar plantillas
+#    grandes como report.html.
+#
+# 2. FRAGMENTOS: bloques costosos de renderizar (tablas largas, datos de gráficos con
+#    |tojson) se guardan ya renderizados con la etiqueta {% cache %}:
+#
+#        {% cache 'report_tables' %}
+#            ... tablas ...
+#        {% endcache %}
+#
+#        {% cache 'dashboard_alerts', session.role %}   {# varía según el rol #}
+#            ... lista con botones solo para editores ...
+#        {% endcache %}
+#
+#    La clave incluye la generación de los datos (tabla data_generation, la incrementan
+#    triggers en cada cambio de productos o movimientos) y la fecha: cuando cambian los
+#    datos o el día (reportes de "últimos 30 días"), la clave es otra y se vuelve a
+#    renderizar. Todo lo que haga variar el fragmento (rol, filtros) debe pasarse como
+#    argumento después del nombre.
+#
+#    La generación se lee ANTES de consultar los datos y en la MISMA conexión de la que
+#    la vista los lee (decorador @uses_fragment_cache + get_db(readonly=True), ver db.py):
+#    con réplica de lectura es la generación de la copia, que puede estar atrasada respecto
+#    del primario. Si los datos cambian durante la petición, lo peor que pasa es guardar
+#    datos más nuevos bajo la generación anterior, que ya no se volverá a pedir.
+#    Sin el decorador, {% cache %} simplemente renderiza el bloque sin guardarlo.
+import os
+import threading
+from datetime import date
+from functools import wraps
+from collections import OrderedDict
+
+from flask import g, has_request_context
+from jinja2 import nodes, FileSystemBytecodeCache
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+import metrics
+
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', 'data/jinja_cache')
+# Fragmentos guardados por proceso (se descartan los menos usados)
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', '256'))
+# 0 desactiva la caché de fragmentos (útil al editar plantillas)
+FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', '1') == '1'
+
+
+def uses_fragment_cache(f):
+    """
+    Decorador para vistas cuyas plantillas usan {% cache %}
+
+    La vista debe leer sus datos de get_db(readonly=True): esa conexión (réplica o
+    primario) deja en g.data_generation su generación (ver explicación arriba).
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if FRAGMENT_CACHE_ENABLED:
+            g.fragment_cache = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+class FragmentCache:
+    """Diccionario con límite de tamaño: al llenarse descarta el fragmento usado hace más tiempo"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+fragments = FragmentCache(FRAGMENT_CACHE_SIZE)
+
+
+class FragmentCacheExtension(Extension):
+    """Etiqueta {% cache 'nombre', variable1, ... %} ... {% endcache %}"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render_fragment', [nodes.List(key_parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, key_parts, caller):
+        generation = g.get('data_generation') if has_request_context() else None
+        if generation is None:
+            return caller()
+        # Las partes se convierten a texto: los valores de la clave deben ser simples
+        # (nombres, roles, filtros), no listas de filas
+        key = (generation, date.today().isoformat()) + tuple(str(part) for part in key_parts)
+        html = fragments.get(key)
+        if html is not None:
+            metrics.CACHE_HITS.inc(cache='template_fragment')
+            return html
+        metrics.CACHE_MISSES.inc(cache='template_fragment')
+        html = Markup(caller())
+        fragments.set(key, html)
+        return html
+
+
+def init_app(app):
+    """Activa la caché de bytecode en disco y la etiqueta {% cache %}"""
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+    except OSError as e:
+        print(f"AVISO: No se pudo crear {TEMPLATE_CACHE_DIR}, plantillas sin caché de bytecode: {e}")
+    app.jinja_env.add_extension(FragmentCacheExtension)
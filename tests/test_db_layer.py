@@ -0,0 +1,203 @@
+# Pruebas de la capa de consultas (db.py) con las mismas consultas en SQLite y PostgreSQL
+#
+# Cubren lo que cambia según el motor: marcadores de parámetros, filas con acceso por
+# nombre, ids generados (RETURNING), expresiones de fecha del dialecto y los triggers
+# que mantienen data_generation, stock_alerts y stock_levels.
+from datetime import datetime, timedelta
+
+import pytest
+
+import query_builder
+from conftest import TEST_REASON
+from db import current_generation, get_db
+from locations import MAIN_LOCATION_ID
+from stock_history import stock_as_of
+
+
+def add_movement(db, product_id, created_at=None, change=1, before=0):
+    """Inserta un movimiento de prueba (created_at None = CURRENT_TIMESTAMP de la base)"""
+    columns = "product_id, movement_type, quantity_before, quantity_after, quantity_change, " \
+              "reason, user_id, username, location_id, location_delta"
+    params = [product_id, 'entrada', before, before + change, change, TEST_REASON, 1, 'admin', MAIN_LOCATION_ID, change]
+    if created_at is not None:
+        columns += ", created_at"
+        params.append(created_at)
+    db.execute(f"INSERT INTO inventory_movements ({columns}) VALUES ({', '.join('?' * len(params))})", params)
+    db.commit()
+
+
+def test_query_rows_by_name_and_position(db, add_product):
+    product_id = add_product('Tornillo', 12)
+    row = db.query_one("SELECT id, name, quantity FROM products WHERE id = ?", (product_id,))
+    assert row['name'] == 'Tornillo'
+    assert row[2] == 12
+    assert list(row.keys()) == ['id', 'name', 'quantity']
+
+    rows = db.query("SELECT name FROM products WHERE id = ?", (product_id,))
+    assert [r['name'] for r in rows] == ['Tornillo']
+    assert db.query_one("SELECT id FROM products WHERE id = ?", (-1,)) is None
+
+
+def test_insert_returns_generated_id(db, add_product):
+    first = add_product('Tuerca', 1)
+    second = add_product('Arandela', 1)
+    assert second > first
+    assert db.scalar("SELECT name FROM products WHERE id = ?", (second,)) == 'Arandela'
+
+
+def test_question_marks_and_percent_inside_literals(db, add_product):
+    # Los ? y % dentro de comillas no son parámetros (psycopg2 usa %s)
+    add_product('Clavo', 3)
+    count = db.scalar("SELECT COUNT(*) FROM products WHERE name = ? AND sku NOT LIKE '?%'", ('Clavo',))
+    assert count == 1
+
+
+def test_iterate_plain_tuples(db, add_product):
+    for number in range(5):
+        add_product(f'Serie {number}', number)
+    rows = list(db.iterate("SELECT name, quantity FROM products WHERE name LIKE ? ORDER BY name",
+                           ('Serie %',), size=2, plain=True))
+    assert [tuple(row) for row in rows] == [(f'Serie {number}', number) for number in range(5)]
+
+
+def test_days_ago_and_to_date(db, add_product):
+    product_id = add_product('Cable', 10)
+    old = (datetime.utcnow() - timedelta(days=40)).strftime('%Y-%m-%d %H:%M:%S')
+    add_movement(db, product_id, created_at=old)
+    add_movement(db, product_id)
+
+    recent = db.scalar(f"""
+        SELECT COUNT(*) FROM inventory_movements
+        WHERE product_id = ? AND {db.dialect.to_date('created_at')} >= {db.dialect.days_ago(30)}
+    """, (product_id,))
+    assert recent == 1
+
+    # to_date compara contra una fecha sin hora pasada como parámetro
+    day = old[:10]
+    same_day = db.scalar(f"""
+        SELECT COUNT(*) FROM inventory_movements
+        WHERE product_id = ? AND {db.dialect.to_date('created_at')} = ?
+    """, (product_id, day))
+    assert same_day == 1
+
+
+def test_month_key(db, add_product):
+    product_id = add_product('Brocha', 4)
+    add_movement(db, product_id, created_at='2024-03-15 10:30:00')
+    add_movement(db, product_id, created_at='2024-03-31 23:00:00')
+    add_movement(db, product_id, created_at='2024-04-01 08:00:00')
+    month = db.dialect.month_key('created_at')
+    rows = db.query(f"""
+        SELECT {month} AS month, COUNT(*) AS total FROM inventory_movements
+        WHERE product_id = ? GROUP BY {month} ORDER BY month
+    """, (product_id,))
+    assert [(row['month'], row['total']) for row in rows] == [('2024-03', 2), ('2024-04', 1)]
+
+
+def test_generation_increases_with_each_write(db, add_product):
+    product_id = add_product('Pintura', 8)
+    before = current_generation(db)
+    db.execute("UPDATE products SET quantity = ? WHERE id = ?", (9, product_id))
+    db.commit()
+    after_update = current_generation(db)
+    assert after_update > before
+
+    add_movement(db, product_id)
+    assert current_generation(db) > after_update
+
+    # Una lectura no cambia la generación
+    generation = current_generation(db)
+    db.query("SELECT * FROM products WHERE id = ?", (product_id,))
+    db.commit()
+    assert current_generation(db) == generation
+
+
+def test_concurrent_write_transactions(db, add_product):
+    # Dos transacciones de escritura sobre productos distintos no deben chocar (antes,
+    # en PostgreSQL, ambas actualizaban la fila de data_generation y una fallaba con 40001)
+    if db.dialect.name == 'sqlite':
+        pytest.skip('SQLite serializa las escrituras con BEGIN IMMEDIATE')
+    first = add_product('Escalera', 5)
+    second = add_product('Balde', 5)
+    other = get_db()
+    try:
+        # Con un bloqueo en espera la prueba falla en lugar de quedarse colgada
+        other.execute("SET lock_timeout = '2s'")
+        other.commit()
+        db.begin_write()
+        other.begin_write()
+        db.execute("UPDATE products SET quantity = 6 WHERE id = ?", (first,))
+        other.execute("UPDATE products SET quantity = 7 WHERE id = ?", (second,))
+        db.commit()
+        other.commit()
+    finally:
+        other.close()
+    assert db.scalar("SELECT quantity FROM products WHERE id = ?", (second,)) == 7
+
+
+def test_stock_alert_triggers(db, add_product):
+    product_id = add_product('Lija', 3, stock_min=5)
+    alert = db.query_one("SELECT state, previous_state FROM stock_alerts WHERE product_id = ?", (product_id,))
+    assert alert['state'] == 'warning'
+
+    db.execute("UPDATE products SET quantity = 0 WHERE id = ?", (product_id,))
+    db.commit()
+    alert = db.query_one("SELECT state, previous_state FROM stock_alerts WHERE product_id = ?", (product_id,))
+    assert (alert['state'], alert['previous_state']) == ('critical', 'warning')
+
+    db.execute("UPDATE products SET quantity = 50 WHERE id = ?", (product_id,))
+    db.commit()
+    assert db.scalar("SELECT state FROM stock_alerts WHERE product_id = ?", (product_id,)) == 'normal'
+
+    db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    db.commit()
+    assert db.query_one("SELECT * FROM stock_alerts WHERE product_id = ?", (product_id,)) is None
+
+
+def test_stock_levels_follow_product_quantity(db, add_product):
+    product_id = add_product('Martillo', 7)
+    level = "SELECT quantity FROM stock_levels WHERE product_id = ? AND location_id = ?"
+    assert db.scalar(level, (product_id, MAIN_LOCATION_ID)) == 7
+
+    db.execute("UPDATE products SET quantity = 10 WHERE id = ?", (product_id,))
+    db.commit()
+    assert db.scalar(level, (product_id, MAIN_LOCATION_ID)) == 10
+
+    db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    db.commit()
+    assert db.scalar("SELECT COUNT(*) FROM stock_levels WHERE product_id = ?", (product_id,)) == 0
+
+
+def test_report_queries(db, add_product):
+    llave = add_product('Llave', 2, stock_min=5, category='Herramientas', provider='Ferretería')
+    add_product('Pinza', 40, stock_min=5, category='Herramientas', provider='Ferretería')
+
+    sql, params = query_builder.build('low_stock', db.dialect, {'category': 'Herramientas'})
+    assert [row['name'] for row in db.query(sql, params)] == ['Llave']
+
+    sql, params = query_builder.build('inventory_by_category', db.dialect, {'category': 'Herramientas'})
+    row = db.query_one(sql, params)
+    assert (row['total_products'], row['total_quantity']) == (2, 42)
+
+    sql, params = query_builder.build('general', db.dialect, {'provider': 'Ferretería', 'stock_high': True})
+    assert [row['name'] for row in db.query(sql, params)] == ['Pinza']
+
+    # Búsqueda sin distinguir mayúsculas en los dos motores (LIKE / ILIKE)
+    add_movement(db, llave)
+    sql, params = query_builder.build('movement_history', db.dialect, {'product': '%llave%'}, count=True)
+    assert db.scalar(sql, params) == 1
+
+
+def test_stock_as_of_without_snapshot(db, add_product):
+    # Sin fotos: un producto cuyo primer movimiento es posterior a la fecha tenía la
+    # cantidad previa a ese movimiento; uno sin movimientos, la cantidad actual
+    if db.scalar("SELECT COUNT(*) FROM stock_snapshots"):
+        pytest.skip('La base de prueba ya tiene fotos de stock')
+    later = add_product('Serrucho', 7)
+    add_movement(db, later, created_at=(datetime.utcnow() + timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S'),
+                 change=4, before=3)
+    untouched = add_product('Lima', 9)
+
+    quantities = {row['product_id']: row['quantity'] for row in stock_as_of(db, datetime.utcnow().strftime('%Y-%m-%d'))}
+    assert quantities[later] == 3
+    assert quantities[untouched] == 9
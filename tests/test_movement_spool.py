@@ -0,0 +1,191 @@
+# Pruebas del spool de movimientos (movement_spool.py)
+#
+# El spool guarda los movimientos en archivos locales y los vuelca en lotes. Estas pruebas
+# cubren lo que no se ve en un uso normal: que un movimiento transaccional no pase por el
+# spool (una transacción revertida no debe dejar un movimiento fantasma) y la recuperación
+# de archivos que dejó un proceso caído.
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import database
+import movement_spool
+from conftest import TEST_REASON
+from locations import MAIN_LOCATION_ID
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Proceso que escribe en el spool (con el bloqueo de fcntl tomado) y muere sin volcar,
+# como tras un kill -9: el sistema libera el bloqueo y el archivo queda huérfano
+CRASHED_WRITER = """
+import json, os, sys
+sys.path.insert(0, sys.argv[1])
+import movement_spool
+spool = movement_spool.MovementSpool(spool_dir=sys.argv[2], flush_interval=3600, max_batch=10**6, max_lag=3600)
+for record in json.loads(sys.argv[3]):
+    spool.append(record)
+os._exit(0)
+"""
+
+# Proceso que arranca su spool (recupera los huérfanos), vuelca y termina. Espera una
+# línea en stdin para arrancar: así los dos procesos de la prueba compiten de verdad
+RECOVERER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import movement_spool
+spool = movement_spool.MovementSpool(spool_dir=sys.argv[2], flush_interval=3600)
+print('ready', flush=True)
+sys.stdin.readline()
+spool._ensure_started()
+spool.flush()
+print(spool.recovered_segments)
+spool.close()
+"""
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    """Spool en modo activo sobre un directorio temporal (sin volcado periódico)"""
+    instance = movement_spool.MovementSpool(spool_dir=str(tmp_path / 'spool'), flush_interval=3600)
+    monkeypatch.setattr(movement_spool, 'WRITE_MODE', 'spool')
+    monkeypatch.setattr(movement_spool, 'spool', instance)
+    yield instance
+    instance.close()
+
+
+def make_records(product_id, count, first=0):
+    """Movimientos de prueba; quantity_after identifica a cada uno"""
+    return [{
+        'product_id': product_id, 'movement_type': 'entrada', 'quantity_before': number,
+        'quantity_after': number + 1, 'quantity_change': 1, 'reason': TEST_REASON, 'user_id': 1,
+        'username': 'admin', 'created_at': movement_spool.utc_timestamp(),
+        'location_id': MAIN_LOCATION_ID, 'location_delta': 1,
+    } for number in range(first, first + count)]
+
+
+def applied_quantities(db, product_id):
+    rows = db.query("SELECT quantity_after FROM inventory_movements WHERE product_id = ? AND reason = ?",
+                    (product_id, TEST_REASON))
+    return sorted(row[0] for row in rows)
+
+
+@pytest.fixture
+def subprocess_env(db, monkeypatch):
+    """Entorno para que los procesos hijos usen la misma base que la prueba"""
+    if db.dialect.name == 'sqlite':
+        monkeypatch.setenv('DATABASE_PATH', database.DB_NAME)
+    return dict(os.environ)
+
+
+def count_movements(db, product_id):
+    return db.scalar("SELECT COUNT(*) FROM inventory_movements WHERE product_id = ? AND reason = ?",
+                     (product_id, TEST_REASON))
+
+
+def test_rolled_back_movement_is_not_spooled(db, add_product, spool):
+    # Transferencia o ajuste rápido que falla después de registrar el movimiento
+    import app
+    product_id = add_product('Taladro', 5)
+    db.begin_write()
+    app.log_inventory_movement(product_id, None, 'transferencia', 5, 5, TEST_REASON, actor=(1, 'admin'),
+                               db=db, location_id=MAIN_LOCATION_ID, location_delta=-2)
+    db.rollback()
+    spool.flush()
+    assert spool.stats()['pending_records'] == 0
+    assert count_movements(db, product_id) == 0
+
+    # Confirmado, el movimiento queda en la misma transacción que el cambio de stock
+    db.begin_write()
+    app.log_inventory_movement(product_id, None, 'entrada', 5, 6, TEST_REASON, actor=(1, 'admin'), db=db)
+    db.commit()
+    assert spool.stats()['pending_records'] == 0
+    assert count_movements(db, product_id) == 1
+
+
+def test_recovery_applies_crashed_file_once(db, add_product, tmp_path):
+    product_id = add_product('Cincel', 0)
+    spool_dir = str(tmp_path / 'spool')
+    subprocess.run([sys.executable, '-c', CRASHED_WRITER, ROOT, spool_dir,
+                    json.dumps(make_records(product_id, 5))], check=True)
+    (path,) = glob.glob(os.path.join(spool_dir, 'movements-*.log'))
+
+    # El proceso murió a mitad del volcado: el primer movimiento y su checkpoint ya
+    # estaban confirmados (en la misma transacción)
+    segment = os.path.basename(path)
+    with open(path, 'rb') as f:
+        first = movement_spool._spooled_row(json.loads(f.readline()))
+    db.execute(f"INSERT INTO inventory_movements ({', '.join(movement_spool.MOVEMENT_FIELDS)}) "
+               f"VALUES ({', '.join('?' * len(movement_spool.MOVEMENT_FIELDS))})", first)
+    db.execute("INSERT INTO movement_spool_checkpoints (segment, lines_applied) VALUES (?, ?)", (segment, 1))
+    db.commit()
+
+    recovering = movement_spool.MovementSpool(spool_dir=spool_dir, flush_interval=3600)
+    recovering._ensure_started()
+    recovering.flush()
+    assert recovering.recovered_segments == 1
+    assert recovering.flushed_records == 4
+    recovering.close()
+
+    assert applied_quantities(db, product_id) == [1, 2, 3, 4, 5]
+    assert glob.glob(os.path.join(spool_dir, 'movements-*.log*')) == []
+    assert db.scalar("SELECT COUNT(*) FROM movement_spool_checkpoints WHERE segment = ?", (segment,)) == 0
+
+    # Un proceso posterior no encuentra nada que recuperar
+    later = movement_spool.MovementSpool(spool_dir=spool_dir, flush_interval=3600)
+    later._ensure_started()
+    assert later.flush() == 0
+    later.close()
+    assert applied_quantities(db, product_id) == [1, 2, 3, 4, 5]
+
+
+def test_live_writer_files_are_not_recovered(db, add_product, tmp_path):
+    product_id = add_product('Gubia', 0)
+    spool_dir = str(tmp_path / 'spool')
+    writer = movement_spool.MovementSpool(spool_dir=spool_dir, flush_interval=3600)
+    for record in make_records(product_id, 3):
+        writer.append(record)
+
+    other = movement_spool.MovementSpool(spool_dir=spool_dir, flush_interval=3600)
+    other._ensure_started()
+    other.flush()
+    assert other.recovered_segments == 0
+    assert applied_quantities(db, product_id) == []
+    other.close()
+
+    writer.close()
+    assert applied_quantities(db, product_id) == [1, 2, 3]
+
+
+def test_two_processes_race_for_orphans(db, add_product, tmp_path, subprocess_env):
+    product_id = add_product('Escofina', 0)
+    spool_dir = tmp_path / 'spool'
+    spool_dir.mkdir()
+    # Archivos de procesos muertos (sin bloqueo), con lotes de 4 movimientos cada uno
+    files = 40
+    for number in range(files):
+        lines = [json.dumps([record.get(field) for field in movement_spool.MOVEMENT_FIELDS])
+                 for record in make_records(product_id, 4, first=number * 4)]
+        (spool_dir / f'movements-99999-{number}-000001.log').write_text('\n'.join(lines) + '\n')
+
+    processes = [subprocess.Popen([sys.executable, '-c', RECOVERER, ROOT, str(spool_dir)],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=subprocess_env)
+                 for _ in range(2)]
+    for process in processes:
+        assert process.stdout.readline().strip() == 'ready'
+    for process in processes:
+        process.stdin.write('\n')
+        process.stdin.flush()
+    recovered = []
+    for process in processes:
+        output, _ = process.communicate(timeout=60)
+        assert process.returncode == 0
+        recovered.append(int(output.split()[-1]))
+
+    # Cada archivo lo recuperó un solo proceso y cada movimiento se aplicó una vez
+    assert sum(recovered) == files
+    assert applied_quantities(db, product_id) == list(range(1, files * 4 + 1))
+    assert list(spool_dir.glob('movements-*.log*')) == []
@@ -0,0 +1,14 @@
+# Punto de entrada WSGI para servidores de producción (gunicorn, uwsgi)
+#
+#   flask --app wsgi migrate                                      # una vez por despliegue
+#   gunicorn --preload --workers=4 --bind=0.0.0.0:8000 wsgi:app
+#
+# Importar la aplicación no abre la base de datos ni inicia hilos: el esquema se migra
+# con el comando "migrate" y los hilos (spool de movimientos, métricas) arrancan en la
+# primera petición de cada worker. Por eso es seguro usar --preload: gunicorn importa
+# la aplicación una sola vez en el proceso maestro y los workers la heredan con fork(),
+# sin repetir la importación de Flask, Jinja2 y los módulos de la aplicación.
+from app import app
+
+if __name__ == "__main__":
+    app.run()